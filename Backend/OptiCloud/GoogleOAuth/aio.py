@@ -0,0 +1,97 @@
+import asyncio
+import functools
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+# boto3 and pymongo have no asyncio API, so async views hand their calls to a bounded
+# pool instead of the event loop. One pool per process, like the job pool.
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_blocking_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'OPTICLOUD_ASYNC_IO_WORKERS', 32),
+                    thread_name_prefix='opticloud-io'
+                )
+                _executor_pid = os.getpid()
+    return _executor
+
+
+# The event loop of the ASGI server (asgi.py). Under WSGI and runserver, async views run
+# on a loop of their own that is torn down with the request, tasks included.
+_server_loop = None
+
+
+def set_server_loop():
+    global _server_loop
+    _server_loop = asyncio.get_running_loop()
+
+
+def on_server_loop():
+    # Whether a task created now may outlive the request
+    try:
+        return _server_loop is not None and asyncio.get_running_loop() is _server_loop
+    except RuntimeError:
+        return False
+
+
+async def run_blocking(func, *args, **kwargs):
+    # Await a blocking call without holding the event loop. Calls queue up once every
+    # pool thread is busy, which bounds the load on AWS and MongoDB.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_blocking_executor(), functools.partial(func, *args, **kwargs))
+
+
+class ProgressQueue:
+    # Progress events handed from the threads running a refresh to the one stream that
+    # sends them: get() blocks (WSGI), aget() awaits on the reader's event loop (ASGI).
+    # Both raise queue.Empty after `timeout` seconds without an event.
+
+    def __init__(self):
+        self._events = queue.Queue()
+        self._waiter = None  # (loop, future) of a reader waiting in aget()
+
+    def __call__(self, event, data):
+        # The progress callback
+        self._events.put((event, data))
+        waiter = self._waiter
+        if waiter is not None:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_wake, future)
+
+    def get(self, timeout):
+        return self._events.get(timeout=timeout)
+
+    async def aget(self, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Registered before looking at the queue, so an event put in between still wakes us
+        self._waiter = (loop, future)
+        try:
+            try:
+                return self._events.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise queue.Empty
+            return self._events.get_nowait()
+        finally:
+            self._waiter = None
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -13,4 +13,19 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'GoogleOAuth.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    # Refreshes started by async views run as tasks on this loop (jobs.aenqueue_refresh)
+    from GoogleOAuth.aio import set_server_loop
+    set_server_loop()
+    await django_application(scope, receive, send)
+
+
+# Indexes are created by `manage.py ensure_indexes` on deploy, not by every worker
+
+# Optionally load the SDKs and open connections now rather than on the first requests
+from GoogleOAuth.warmup import warm_up_if_enabled  # noqa: E402
+
+warm_up_if_enabled()
@@ -0,0 +1,186 @@
+# async_views.py
+# Async versions of the API views, for serving under asgi.py. Under ASGI Django runs
+# every sync view on one shared thread, so these await instead: MongoDB and boto3 calls
+# go to the bounded pool in aio.py and refreshes run as tasks on the event loop, with
+# the OpenAI call awaited on the async client. Served any other way (runserver, WSGI),
+# they still work, with refreshes on the job pool (jobs.aenqueue_refresh).
+import logging
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import get_conditional_response
+import json
+from .aio import run_blocking
+from .fleet import FleetQueryError, query_fleet
+from .jobs import aenqueue_refresh, get_job
+from .mongodb import get_database, insert_user_data
+from .views import (
+    NOT_FOUND, HistoryQueryError, find_metrics_version, get_metrics_field, metrics_validators, parse_history_query,
+    read_metric_history, read_user_metrics, set_metrics_validators, update_user_role_arn
+)
+
+logger = logging.getLogger(__name__)
+
+
+def find_user(user_id, projection=None):
+    return get_database()['test_collection'].find_one({"id": user_id}, projection)
+
+
+@csrf_exempt
+async def get_user_role_arn(request):
+    if request.method != 'POST':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+    try:
+        body = json.loads(request.body)
+        user_id = body.get('user_id')
+        if not user_id:
+            return JsonResponse({'message': 'User ID not provided'}, status=400)
+
+        user = await run_blocking(find_user, user_id, {"roleArn": 1})
+        if not user or 'roleArn' not in user:
+            return JsonResponse({'message': 'User or Role ARN not found'}, status=404)
+
+        if not body.get('refresh', True):
+            return JsonResponse({'roleArn': user['roleArn']}, status=200)
+        job_id = await aenqueue_refresh(user['roleArn'], user_id)
+        return JsonResponse({'roleArn': user['roleArn'], 'job_id': job_id}, status=202)
+
+    except json.JSONDecodeError:
+        return JsonResponse({'message': 'Invalid JSON'}, status=400)
+    except Exception as e:
+        logger.exception("Error fetching Role ARN")
+        return JsonResponse({'message': 'Internal server error', 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+async def get_user_metrics(request):
+    if request.method != 'POST':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+    try:
+        body = json.loads(request.body)
+        user_id = body.get('user_id')
+        if not user_id:
+            return JsonResponse({'message': 'User ID not provided'}, status=400)
+
+        instance_id = body.get('instance_id')
+        metric = body.get('metric')
+        field = get_metrics_field(instance_id, metric)
+        if field is None:
+            return JsonResponse({'message': 'Invalid instance or metric'}, status=400)
+
+        aws_metrics = await run_blocking(read_user_metrics, user_id, field, instance_id, metric)
+        if aws_metrics is NOT_FOUND:
+            return JsonResponse({'message': 'User or Metrics not found'}, status=404)
+        return JsonResponse({'aws_metrics': aws_metrics}, status=200)
+
+    except json.JSONDecodeError:
+        return JsonResponse({'message': 'Invalid JSON'}, status=400)
+    except Exception as e:
+        logger.exception("Error fetching metrics")
+        return JsonResponse({'message': 'Internal server error', 'error': str(e)}, status=500)
+
+
+async def get_user_metrics_cached(request, user_id):
+    if request.method != 'GET':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+
+    instance_id = request.GET.get('instance_id')
+    metric = request.GET.get('metric')
+    field = get_metrics_field(instance_id, metric)
+    if field is None:
+        return JsonResponse({'message': 'Invalid instance or metric'}, status=400)
+
+    user = await run_blocking(find_metrics_version, user_id, field)
+    if not user:
+        return JsonResponse({'message': 'User or Metrics not found'}, status=404)
+
+    etag, last_modified = metrics_validators(user, instance_id, metric)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        aws_metrics = await run_blocking(read_user_metrics, user_id, field, instance_id, metric)
+        if aws_metrics is NOT_FOUND:
+            return JsonResponse({'message': 'User or Metrics not found'}, status=404)
+        response = JsonResponse({'aws_metrics': aws_metrics}, status=200)
+    return set_metrics_validators(response, etag, last_modified)
+
+
+async def get_fleet(request, user_id):
+    if request.method != 'GET':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+    try:
+        return JsonResponse(await run_blocking(query_fleet, user_id, request.GET), status=200)
+    except FleetQueryError as e:
+        return JsonResponse({'message': str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Error querying the fleet")
+        return JsonResponse({'message': 'Internal server error', 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+async def get_metric_history(request):
+    if request.method != 'POST':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+    try:
+        user_id, instance_id, metric, granularity, start_time = parse_history_query(json.loads(request.body))
+
+        user = await run_blocking(find_user, user_id, {"roleArn": 1})
+        if not user or 'roleArn' not in user:
+            return JsonResponse({'message': 'User or Role ARN not found'}, status=404)
+
+        datapoints = await run_blocking(
+            read_metric_history, user['roleArn'], instance_id, metric, granularity, start_time
+        )
+        return JsonResponse({'datapoints': datapoints}, status=200)
+
+    except HistoryQueryError as e:
+        return JsonResponse({'message': str(e)}, status=400)
+    except json.JSONDecodeError:
+        return JsonResponse({'message': 'Invalid JSON'}, status=400)
+    except Exception as e:
+        logger.exception("Error fetching metric history")
+        return JsonResponse({'message': 'Internal server error', 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+async def user_data_view(request):
+    if request.method == 'OPTIONS':
+        return JsonResponse({'status': 'OK'})
+    if request.method != 'POST':
+        return JsonResponse({'status': 'Error', 'message': 'Method not allowed'}, status=405)
+    try:
+        data = json.loads(request.body)
+        user_data = data.get('user', {})
+        user_id = await run_blocking(insert_user_data, user_data)
+        user_data['_id'] = str(user_id)
+        return JsonResponse({'status': 'Success', 'data': user_data})
+    except Exception as e:
+        logger.warning("Failed to store user data: %s", e)
+        return JsonResponse({'status': 'Error', 'message': str(e)}, status=400)
+
+
+@csrf_exempt
+async def receive_role_arn(request):
+    if request.method != 'POST':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+    try:
+        body = json.loads(request.body)
+        role_arn = body.get('roleArn')
+        user_id = body.get('user', {}).get('id')
+        if not role_arn or not user_id:
+            return JsonResponse({'message': 'Role ARN or user not provided'}, status=400)
+
+        await run_blocking(update_user_role_arn, user_id, role_arn)
+        job_id = await aenqueue_refresh(role_arn, user_id, fresh_credentials=True)
+        return JsonResponse({'message': 'Role ARN received successfully', 'job_id': job_id}, status=202)
+
+    except json.JSONDecodeError:
+        return JsonResponse({'message': 'Invalid JSON'}, status=400)
+
+
+async def refresh_job_status(request, job_id):
+    if request.method != 'GET':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+    job = await run_blocking(get_job, job_id)
+    if not job:
+        return JsonResponse({'message': 'Job not found'}, status=404)
+    job['job_id'] = job.pop('_id')
+    return JsonResponse(job, status=200)
@@ -0,0 +1,177 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+
+from .instrumentation import instrument_boto3_session
+
+logger = logging.getLogger(__name__)
+
+
+# One boto3 session shared by every client we build, so endpoint and service models are
+# loaded once per process instead of once per client. Sessions are not thread-safe,
+# so client construction goes through _session_lock.
+_session = None
+_session_lock = threading.Lock()
+
+# Least recently assumed credentials keyed by role ARN: {role_arn: credentials}. STS
+# calls for one role ARN are serialized on one of a fixed set of locks, picked by hash,
+# so the locks stay bounded however many tenants come and go.
+_credentials_cache = OrderedDict()
+_credentials_cache_lock = threading.Lock()
+_credentials_locks = [threading.Lock() for _ in range(64)]
+
+# Least recently used customer clients keyed by (access key, service, region)
+_client_cache = OrderedDict()
+_client_cache_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # boto3 takes a while to import, so workers only pay for it once they
+                # talk to AWS (or in warmup.py)
+                import boto3
+                session = boto3.session.Session()
+                instrument_boto3_session(session)
+                _session = session
+    return _session
+
+
+def _new_client(service_name, **kwargs):
+    session = get_session()
+    with _session_lock:
+        return session.client(service_name, **kwargs)
+
+
+def preload_service_models(service_names=('sts', 'ec2', 'cloudwatch'), region_name=None):
+    # Build and drop one client per service: the shared session keeps the service models
+    # and endpoint data it loaded, so the first refresh doesn't read them from disk.
+    # Placeholder keys keep this from looking up real credentials.
+    for service_name in service_names:
+        _new_client(
+            service_name, region_name=region_name or get_default_region(),
+            aws_access_key_id='warmup', aws_secret_access_key='warmup'
+        )
+
+
+def get_account_id(role_arn):
+    # arn:aws:iam::123456789012:role/OptiCloudRole -> 123456789012
+    parts = (role_arn or '').split(':')
+    return parts[4] if len(parts) > 5 and parts[4] else None
+
+
+def _credentials_are_fresh(credentials):
+    margin = timedelta(seconds=getattr(settings, 'OPTICLOUD_CREDENTIALS_REFRESH_MARGIN', 300))
+    return credentials['expiration'] - margin > datetime.now(timezone.utc)
+
+
+# Function to assume the customer's IAM role and get temporary credentials.
+# Credentials are reused until shortly before they expire; concurrent callers for the
+# same role ARN wait for a single STS call instead of each making their own.
+def assume_customer_role(customer_role_arn):
+    credentials = _credentials_cache.get(customer_role_arn)
+    if credentials and _credentials_are_fresh(credentials):
+        return credentials
+
+    with _credentials_locks[hash(customer_role_arn) % len(_credentials_locks)]:
+        credentials = _credentials_cache.get(customer_role_arn)
+        if credentials and _credentials_are_fresh(credentials):
+            return credentials
+
+        sts_client = _new_client('sts')  # Using OptiCloud's AWS credentials
+        from boto3.exceptions import Boto3Error  # loaded with the session
+        try:
+            assumed_role = sts_client.assume_role(
+                RoleArn=customer_role_arn,  # Customer-provided role ARN
+                RoleSessionName="OptiCloudSession"
+            )
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            logger.warning("Failed to assume role %s: %s", customer_role_arn, e)
+            return None
+
+        # Extract the temporary credentials from the response
+        credentials = assumed_role['Credentials']
+        credentials = {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'session_token': credentials['SessionToken'],
+            'expiration': credentials['Expiration'],
+            'account_id': get_account_id(customer_role_arn)
+        }
+        with _credentials_cache_lock:
+            _credentials_cache[customer_role_arn] = credentials
+            _credentials_cache.move_to_end(customer_role_arn)
+            while len(_credentials_cache) > getattr(settings, 'OPTICLOUD_CLIENT_CACHE_SIZE', 256):
+                _credentials_cache.popitem(last=False)
+        return credentials
+
+
+def forget_customer_role(customer_role_arn):
+    # Drop cached credentials, e.g. after the customer changed or revoked the role
+    with _credentials_cache_lock:
+        credentials = _credentials_cache.pop(customer_role_arn, None)
+    if credentials:
+        with _client_cache_lock:
+            for key in [key for key in _client_cache if key[0] == credentials['access_key']]:
+                del _client_cache[key]
+
+
+# Function to create an AWS client using the customer's temporary credentials.
+# Clients are cached per credentials/service/region and evicted least recently used first.
+def create_customer_client(service_name, customer_credentials, region_name=None):
+    key = (customer_credentials['access_key'], service_name, region_name)
+    with _client_cache_lock:
+        client = _client_cache.get(key)
+        if client is not None:
+            _client_cache.move_to_end(key)
+            return client
+
+    client = _new_client(
+        service_name,
+        region_name=region_name,
+        aws_access_key_id=customer_credentials['access_key'],
+        aws_secret_access_key=customer_credentials['secret_key'],
+        aws_session_token=customer_credentials['session_token']
+    )
+
+    with _client_cache_lock:
+        _client_cache[key] = client
+        _client_cache.move_to_end(key)
+        while len(_client_cache) > getattr(settings, 'OPTICLOUD_CLIENT_CACHE_SIZE', 256):
+            _client_cache.popitem(last=False)
+    return client
+
+
+def get_default_region():
+    return get_session().region_name or 'us-east-1'
+
+
+# Regions the customer's account has enabled (opt-in regions are only listed once opted in)
+def get_enabled_regions(customer_credentials):
+    ec2_client = create_customer_client('ec2', customer_credentials, get_default_region())
+    response = ec2_client.describe_regions(
+        Filters=[{'Name': 'opt-in-status', 'Values': ['opt-in-not-required', 'opted-in']}]
+    )
+    return sorted(region['RegionName'] for region in response['Regions'])
+
+
+# Every instance in a region, following describe_instances pagination
+def describe_ec2_instances(ec2_client):
+    instances = []
+    paginator = ec2_client.get_paginator('describe_instances')
+    for page in paginator.paginate():
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instances.append({
+                    'instance_id': instance['InstanceId'],
+                    'instance_type': instance.get('InstanceType'),
+                    'state': instance.get('State', {}).get('Name')
+                })
+    return instances
+
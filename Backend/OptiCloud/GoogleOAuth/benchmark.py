@@ -0,0 +1,406 @@
+import json
+import math
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from botocore.awsrequest import AWSResponse
+from django.test import Client
+from pymongo import UpdateOne
+
+from . import pipeline
+from .aws import get_session
+from .cloudwatch import METRICS_TO_FETCH
+
+
+# Building blocks for manage.py bench_pipeline: an OpenAI-compatible HTTP server and a
+# CloudWatch stand-in with configurable latency and drift, a counter for AWS API calls
+# and a driver that runs refreshes concurrently through the API, the way the dashboard
+# does, and times their stages from the streamed progress events.
+
+
+# Characters per streamed chunk, roughly a few tokens
+STREAM_PIECE = 16
+
+
+class FakeOpenAIServer:
+    # Answers /v1/chat/completions with a reworded recommendation per row of the
+    # prompt's findings table, after sleeping `latency` seconds (spread over the chunks
+    # when the request asks for a stream). With `concurrency_limit`, requests beyond that
+    # many in flight get a 429 with a Retry-After header, like a rate-limited account.
+    # Like a real model, the wording rounds figures, and a `misquote` share of the rows
+    # quotes a figure that is not in the table.
+
+    def __init__(self, latency=1.0, concurrency_limit=None, retry_after=1, misquote=0.1):
+        self.latency = latency
+        self.concurrency_limit = concurrency_limit
+        self.retry_after = retry_after
+        self.misquote = misquote
+        self.requests = 0
+        self.prompt_chars = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                prompt = body['messages'][-1]['content']
+                with server._lock:
+                    limited = server.concurrency_limit and server.in_flight >= server.concurrency_limit
+                    if limited:
+                        server.rate_limited += 1
+                    else:
+                        server.requests += 1
+                        server.prompt_chars += len(prompt)
+                        server.in_flight += 1
+                        server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+                if limited:
+                    self.rate_limit()
+                    return
+                try:
+                    self.answer(body, prompt)
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def rate_limit(self):
+                payload = json.dumps({'error': {
+                    'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded',
+                }})
+                self.send_response(429)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Retry-After', str(server.retry_after))
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload.encode('utf-8'))
+
+            def answer(self, body, prompt):
+                content = fake_recommendations(prompt, server.misquote)
+                if body.get('stream'):
+                    self.stream(body.get('model'), content)
+                    return
+                time.sleep(server.latency)
+                payload = json.dumps(completion_response(body.get('model'), content))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload.encode('utf-8'))
+
+            def stream(self, model, content):
+                # The latency is spread over the pieces, like tokens being generated
+                pieces = [content[offset:offset + STREAM_PIECE] for offset in range(0, len(content), STREAM_PIECE)]
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                try:
+                    for piece in pieces:
+                        time.sleep(server.latency / len(pieces))
+                        chunk = completion_chunk(model, piece)
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client stopped reading early
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def fake_recommendations(prompt, misquote=0.0):
+    # Rows of the findings table start with the instance id and carry the numbers and the
+    # draft wording. Which rows are misquoted only depends on the row's instance and
+    # metric, so a row misquoted once is misquoted every time it is asked for.
+    instances = {}
+    for line in prompt.splitlines():
+        if not line.startswith('i-'):
+            continue
+        instance_id, instance_type, _, _, metric_name, current, optimized, draft = line.split('|', 7)
+        text = f"{draft.rstrip('.')}, for {instance_type} at roughly {float(current):.0f} now"
+        if float(optimized) != float(current):
+            text += f" and {float(optimized):.0f} after the change"
+        if zlib.crc32(f"{instance_id}:{metric_name}".encode('utf-8')) % 1000 < misquote * 1000:
+            text += f", about {float(current) * 1.5 + 7:.1f} at peak"
+        recommendations = instances.setdefault(instance_id, {'Optimization_Recommendations': {}})
+        recommendations['Optimization_Recommendations'][metric_name] = {'Recommendation': text + "."}
+    return json.dumps({'Instances': instances})
+
+
+def completion_response(model, content):
+    return {
+        'id': 'chatcmpl-bench',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model or 'bench',
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+    }
+
+
+def completion_chunk(model, content):
+    return {
+        'id': 'chatcmpl-bench',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model or 'bench',
+        'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': None}],
+    }
+
+
+class ApiCallCounter:
+    # Counts AWS API calls made through the shared boto3 session, per service.operation.
+    # Clients copy the session's event handlers when they are built, so install() has to
+    # run before the first client is created. Counted before parameters are built, since
+    # a stubbed before-call handler ends the call before less specific handlers run.
+
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def install(self):
+        get_session().events.register('before-parameter-build', self._count)
+        return self
+
+    def _count(self, model, **kwargs):
+        name = f"{model.service_model.service_name}.{model.name}"
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.calls)
+
+
+def patch_mongomock_bulk_write(mongomock):
+    # pymongo 4.11+ hands bulk updates a sort argument that mongomock's bulk builder does
+    # not accept, so apply UpdateOne operations one by one instead
+    bulk_write = mongomock.Collection.bulk_write
+
+    def compatible_bulk_write(collection, requests, ordered=True, **kwargs):
+        if not all(isinstance(request, UpdateOne) for request in requests):
+            return bulk_write(collection, requests, ordered=ordered, **kwargs)
+        for request in requests:
+            collection.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    mongomock.Collection.bulk_write = compatible_bulk_write
+
+
+def seed_instances(instance_count, region='us-east-1', instance_type='m5.large'):
+    # Launch the instances to collect from. Meant to run against moto.
+    ec2 = get_session().client('ec2', region_name=region)
+    image_id = ec2.describe_images()['Images'][0]['ImageId']
+    instance_ids = []
+    while len(instance_ids) < instance_count:
+        count = min(instance_count - len(instance_ids), 100)
+        response = ec2.run_instances(ImageId=image_id, MinCount=count, MaxCount=count, InstanceType=instance_type)
+        instance_ids.extend(instance['InstanceId'] for instance in response['Instances'])
+    return instance_ids
+
+
+class FakeCloudWatch:
+    # Answers GetMetricData in place of CloudWatch, the way botocore's Stubber does, with
+    # an hourly value for every hour asked for. moto's GetMetricData is slow enough to
+    # dominate any measurement, so only EC2 and STS go to moto.
+    #
+    # The first `metric_count` metrics have datapoints; values are derived from the
+    # instance, metric and hour so repeated refreshes see the same series. Each series
+    # also trends up, down or not at all by `drift` per hour, so a window that slides
+    # (shift_collection_window) sees its figures move a little. With `profiles`,
+    # instances share one of that many series, like members of an autoscaling group.
+
+    def __init__(self, metric_count=len(METRICS_TO_FETCH), latency=0.0, profiles=None, drift=0.0):
+        self.metrics_with_data = set(METRICS_TO_FETCH[:metric_count])
+        self.latency = latency
+        self.profiles = profiles
+        self.drift = drift
+        self.origin = datetime.now(timezone.utc)
+
+    def install(self):
+        events = get_session().events
+        events.register('before-parameter-build.cloudwatch.GetMetricData', self._remember_params)
+        events.register('before-call.cloudwatch.GetMetricData', self._respond)
+        return self
+
+    def _remember_params(self, params, context, **kwargs):
+        context['bench_params'] = params
+
+    def _respond(self, context, **kwargs):
+        params = context['bench_params']
+        if self.latency:
+            time.sleep(self.latency)
+        start = params['StartTime'].replace(minute=0, second=0, microsecond=0)
+        end = params['EndTime']
+        results = []
+        for query in params['MetricDataQueries']:
+            metric_stat = query['MetricStat']
+            metric_name = metric_stat['Metric']['MetricName']
+            instance_id = metric_stat['Metric']['Dimensions'][0]['Value']
+            if self.profiles:
+                instance_id = f"profile-{zlib.crc32(instance_id.encode('utf-8')) % self.profiles}"
+            timestamps = []
+            values = []
+            if metric_name in self.metrics_with_data:
+                timestamp = start
+                while timestamp < end:
+                    timestamps.append(timestamp)
+                    values.append(fake_value(
+                        instance_id, metric_name, metric_stat['Stat'], timestamp,
+                        self.drift * (timestamp - self.origin) / timedelta(hours=1)
+                    ))
+                    timestamp += timedelta(seconds=metric_stat['Period'])
+            results.append({
+                'Id': query['Id'], 'Label': metric_name, 'Timestamps': timestamps,
+                'Values': values, 'StatusCode': 'Complete',
+            })
+        parsed = {
+            'MetricDataResults': results,
+            'Messages': [],
+            'ResponseMetadata': {'HTTPStatusCode': 200, 'HTTPHeaders': {}, 'RetryAttempts': 0},
+        }
+        return AWSResponse(None, 200, {}, None), parsed
+
+
+def fake_value(instance_id, metric_name, statistic, timestamp, drift=0.0):
+    if metric_name.startswith('StatusCheck'):
+        return 0.0
+    seed = zlib.crc32(f"{instance_id}:{metric_name}".encode('utf-8'))
+    base = seed % 60
+    trend = ((seed >> 4) % 3 - 1) * drift
+    return round(max(0.0, base + 10 * math.sin(timestamp.hour / 24 * 2 * math.pi) + (seed >> 8) % 5 + trend), 2)
+
+
+def shift_collection_window(hours):
+    # Refreshes collect the window they would collect `hours` from now, as if the
+    # scheduler came back later: the window slides and only the new hours are fetched
+    collection_window = getattr(pipeline.get_collection_window, 'func', pipeline.get_collection_window)
+    pipeline.get_collection_window = partial(collection_window, datetime.now(timezone.utc) + timedelta(hours=hours))
+
+
+class StageRecorder:
+    # Progress callback for one refresh: remembers when each pipeline event first fired
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = {}
+        self.job_id = None
+
+    def __call__(self, event, data):
+        self.events.setdefault(event, time.perf_counter())
+        if event == 'queued':
+            self.job_id = data['job_id']
+
+    def stages(self):
+        # Time spent between consecutive milestones
+        milestones = [
+            ('assume_role', 'role_assumed'),
+            ('collect', 'metrics_collected'),
+            ('recommend', 'recommendations_ready'),
+            ('narrate', 'narration_ready'),
+            ('store', 'done'),
+        ]
+        stages = {}
+        previous = self.started
+        for stage, event in milestones:
+            if event not in self.events:
+                continue
+            stages[stage] = self.events[event] - previous
+            previous = self.events[event]
+        # How long the first recommendation takes to show up once metrics are collected
+        if 'metrics_collected' in self.events and 'instance_recommendation' in self.events:
+            stages['first_result'] = self.events['instance_recommendation'] - self.events['metrics_collected']
+        return stages
+
+
+def read_events(response):
+    # (event, data) of a server-sent event stream as the chunks arrive
+    for chunk in response.streaming_content:
+        event = data = None
+        for line in chunk.decode('utf-8').splitlines():
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: '):
+                data = json.loads(line[len('data: '):])
+        if event:
+            yield event, data
+
+
+def refresh_through_api(user_id, role_arn):
+    # One refresh the way the dashboard drives it: POST receive-role-arn stores the role,
+    # enqueues the job and claims the refresh, then GET refresh-stream joins that refresh
+    # (single-flight) and streams its events. Returns the recorder and the job id of the
+    # POST, which the stream's 'queued' event repeats when it joined.
+    recorder = StageRecorder()
+    client = Client()
+    response = client.post(
+        '/api/receive-role-arn/', json.dumps({'roleArn': role_arn, 'user': {'id': user_id}}),
+        content_type='application/json'
+    )
+    if response.status_code != 202:
+        recorder('failed', {'error': f"receive-role-arn returned {response.status_code}"})
+        return recorder, None
+    job_id = response.json()['job_id']
+    stream = client.get('/api/refresh-stream/', {'user_id': user_id})
+    try:
+        if stream.status_code != 200:
+            recorder('failed', {'error': f"refresh-stream returned {stream.status_code}"})
+            return recorder, job_id
+        for event, data in read_events(stream):
+            recorder(event, data)
+    finally:
+        stream.close()
+    return recorder, job_id
+
+
+def run_round(users, concurrency):
+    # Refresh every (user id, role ARN) through the API, `concurrency` at a time.
+    # Returns (wall time, recorders, failures, streams that joined their POST's refresh).
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda user: refresh_through_api(*user), users))
+    elapsed = time.perf_counter() - started
+    recorders = [recorder for recorder, _ in results]
+    failures = sum(1 for recorder in recorders if 'failed' in recorder.events)
+    joined = sum(1 for recorder, job_id in results if job_id and recorder.job_id == job_id)
+    return elapsed, recorders, failures, joined
+
+
+def summarize_timings(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'mean': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from django.conf import settings
+
+from .clustering import FEATURE_TOLERANCES, cluster_key, instance_profile
+from .llm import PROMPT_VERSION
+from .recommendations import narrate_instance
+
+
+# Change detection between refreshes. An instance's wording only has to come from the LLM
+# again when its behaviour has materially changed since the wording was generated; for
+# every other instance the stored wording is rendered with the freshly computed numbers. Every narrated instance records what its texts were written for:
+#
+#   'Narration': {'profile': [floats], 'prompt_version': int, 'generated_at': datetime,
+#                 'templates': {metric: template}}
+#
+# and the texts are rendered again from its templates, with the new figures, while:
+#   - the type, rightsizing action, target type and set of metrics are the same,
+#   - every feature of the profile is within OPTICLOUD_CHANGE_TOLERANCE times its
+#     clustering tolerance of the recorded one (measured against the narration, not the
+#     last refresh, so slow drift adds up until it triggers),
+#   - the prompt has not changed and the narration is younger than
+#     OPTICLOUD_NARRATION_MAX_AGE days,
+#   - every template still fits the new drafts (recommendations.render_template), so a
+#     change of units or clauses gets new wording.
+
+
+def mark_narrated(document, templates, generated_at=None):
+    # `templates` are the wordings the document's texts were rendered from
+    return dict(document, Narration={
+        'profile': instance_profile(document),
+        'prompt_version': PROMPT_VERSION,
+        'generated_at': generated_at or datetime.now(timezone.utc),
+        'templates': templates,
+    })
+
+
+def _aware(value):
+    # MongoDB hands datetimes back without a timezone; they are stored in UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def has_changed(document, previous, tolerance=None, max_age=None, now=None):
+    # Whether the computed `document` needs new wording, given the stored `previous` one
+    narration = previous.get('Narration') if isinstance(previous, dict) else None
+    if not narration or narration.get('prompt_version') != PROMPT_VERSION or not narration.get('templates'):
+        return True
+    if tolerance is None:
+        tolerance = getattr(settings, 'OPTICLOUD_CHANGE_TOLERANCE', 0.5)
+    if max_age is None:
+        max_age = getattr(settings, 'OPTICLOUD_NARRATION_MAX_AGE', 7)
+    now = now or datetime.now(timezone.utc)
+    generated_at = narration.get('generated_at')
+    if not isinstance(generated_at, datetime) or now - _aware(generated_at) > timedelta(days=max_age):
+        return True
+    try:
+        if cluster_key(document) != cluster_key(previous):
+            return True
+        drift = np.abs(np.array(instance_profile(document)) - np.array(narration['profile'], dtype=float))
+    except (KeyError, TypeError, ValueError):
+        return True  # stored in an older shape
+    return bool((drift > FEATURE_TOLERANCES * tolerance).any())
+
+
+def reuse_narration(document, previous):
+    # The computed document with the stored wording rendered for its new figures and the
+    # record of its narration, or None when a template no longer fits it
+    templates = previous['Narration']['templates']
+    narrated, applied = narrate_instance(document, templates)
+    if applied.keys() != templates.keys():
+        return None
+    return dict(narrated, Narration=previous['Narration'])
+
+
+def apply_previous_narrations(documents, previous_instances):
+    # {instance_id: document} with the stored wording carried over for every instance
+    # that has not changed; the others keep their draft texts and no 'Narration'
+    if not previous_instances or not getattr(settings, 'OPTICLOUD_LLM_NARRATION', True):
+        return documents
+    now = datetime.now(timezone.utc)
+    reused = {}
+    for instance_id, document in documents.items():
+        previous = previous_instances.get(instance_id)
+        if document['Optimization_Recommendations'] and not has_changed(document, previous, now=now):
+            document = reuse_narration(document, previous) or document
+        reused[instance_id] = document
+    return reused
+
+
+def needs_narration(documents):
+    # The documents that have recommendations but no wording from the LLM yet
+    return {
+        instance_id: document for instance_id, document in documents.items()
+        if document['Optimization_Recommendations'] and 'Narration' not in document
+    }
+
+
+def fully_narrated(documents):
+    # Every recommendation is worded by the LLM, whether in this refresh or an earlier one
+    with_recommendations = [document for document in documents.values() if document['Optimization_Recommendations']]
+    return bool(with_recommendations) and all('Narration' in document for document in with_recommendations)
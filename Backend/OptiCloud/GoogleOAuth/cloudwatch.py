@@ -0,0 +1,113 @@
+from botocore.exceptions import BotoCoreError, ClientError
+
+from .instrumentation import span
+from .series import MetricSeries
+
+
+# List of metrics to retrieve for every EC2 instance
+METRICS_TO_FETCH = [
+    'CPUUtilization',
+    'DiskReadOps',
+    'DiskWriteOps',
+    'DiskReadBytes',
+    'DiskWriteBytes',
+    'NetworkIn',
+    'NetworkOut',
+    'StatusCheckFailed',
+    'StatusCheckFailed_Instance',
+    'StatusCheckFailed_System'
+]
+
+STATISTICS = ['Average', 'Minimum', 'Maximum', 'Sum', 'SampleCount']
+
+# GetMetricData accepts at most 500 queries per request
+MAX_QUERIES_PER_REQUEST = 500
+
+PERIOD = 3600
+
+
+def build_metric_queries(instance_ids, metrics=METRICS_TO_FETCH, statistics=STATISTICS, period=PERIOD):
+    # One query per instance/metric/statistic combination. The query Id has to start
+    # with a lowercase letter, so we keep our own lookup from Id back to the combination.
+    queries = []
+    lookup = {}
+    for instance_id in instance_ids:
+        for metric_name in metrics:
+            for stat in statistics:
+                query_id = f"q{len(queries)}"
+                lookup[query_id] = (instance_id, metric_name, stat)
+                queries.append({
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/EC2',
+                            'MetricName': metric_name,
+                            'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]
+                        },
+                        'Period': period,
+                        'Stat': stat
+                    },
+                    'ReturnData': True
+                })
+    return queries, lookup
+
+
+def chunk_instance_ids(instance_ids, metrics=METRICS_TO_FETCH, statistics=STATISTICS):
+    # Pack as many whole instances as fit under the per-request query limit
+    per_instance = max(len(metrics) * len(statistics), 1)
+    size = max(MAX_QUERIES_PER_REQUEST // per_instance, 1)
+    return [instance_ids[i:i + size] for i in range(0, len(instance_ids), size)]
+
+
+def get_metric_data_batch(cloudwatch_client, instance_ids, start_time, end_time,
+                          metrics=METRICS_TO_FETCH, statistics=STATISTICS, period=PERIOD):
+    # Fetch every metric/statistic for a batch of instances, following NextToken pages.
+    # Returns {instance_id: {metric_name: MetricSeries}}.
+    queries, lookup = build_metric_queries(instance_ids, metrics, statistics, period)
+    results = {}  # (instance_id, metric_name) -> {stat: (timestamps, values)}
+
+    kwargs = {
+        'MetricDataQueries': queries,
+        'StartTime': start_time,
+        'EndTime': end_time,
+        'ScanBy': 'TimestampAscending'
+    }
+    while True:
+        response = cloudwatch_client.get_metric_data(**kwargs)
+        for result in response.get('MetricDataResults', []):
+            instance_id, metric_name, stat = lookup[result['Id']]
+            # A result can continue on the next page
+            timestamps, values = results.setdefault((instance_id, metric_name), {}).setdefault(stat, ([], []))
+            timestamps.extend(result.get('Timestamps', []))
+            values.extend(result.get('Values', []))
+
+        next_token = response.get('NextToken')
+        if not next_token:
+            break
+        kwargs['NextToken'] = next_token
+
+    return {
+        instance_id: {
+            metric_name: MetricSeries.from_results(results.get((instance_id, metric_name), {}))
+            for metric_name in metrics
+        }
+        for instance_id in instance_ids
+    }
+
+
+def get_metric_data_for_instances(cloudwatch_client, instance_ids, start_time, end_time,
+                                  metrics=METRICS_TO_FETCH, statistics=STATISTICS, period=PERIOD):
+    # Collect metrics for any number of instances using as few GetMetricData calls as possible.
+    # A failed batch is reported per instance instead of failing the whole collection.
+    metrics_by_instance = {}
+    errors = {}
+    for batch in chunk_instance_ids(instance_ids, metrics, statistics):
+        try:
+            with span('cloudwatch.batch'):
+                metrics_by_instance.update(
+                    get_metric_data_batch(cloudwatch_client, batch, start_time, end_time, metrics, statistics, period)
+                )
+        except (BotoCoreError, ClientError) as e:
+            for instance_id in batch:
+                errors[instance_id] = str(e)
+    return metrics_by_instance, errors
@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+from django.conf import settings
+
+from .recommendations import draft_shape
+
+
+# Groups instances that behave alike (autoscaling groups, fleets of idle dev boxes) so the
+# LLM words one representative per group and the wording is fanned back out to the
+# members. Numbers are never shared: the representative's wording is fanned out as
+# templates (recommendations.make_template) and rendered with each member's own figures.
+#
+# Instances only share a cluster when they have the same type, rightsizing action,
+# target type and set of metrics, their drafts read the same but for the numbers (so
+# every template fits every member), and every feature of their profile is within its
+# tolerance of the cluster's first member (scaled by OPTICLOUD_CLUSTER_TOLERANCE; 0
+# only groups identical profiles).
+
+# Profile feature -> tolerance at a scale of 1
+FEATURE_TOLERANCES = np.array([
+    5.0,    # mean CPU, percentage points
+    0.1,    # fraction of hours that could be scheduled off
+    0.5,    # disk operations per hour, log10
+    0.5,    # network bytes per hour, log10
+    5.0,    # share of hours with passing status checks, percentage points
+])
+
+
+def _usage(document, metric_name):
+    entry = document['Optimization_Recommendations'].get(metric_name)
+    return entry['Current_Usage'] if entry else 0.0
+
+
+def instance_profile(document):
+    return [
+        _usage(document, 'CPU_Utilization'),
+        document['Rightsizing']['scheduled_fraction'],
+        math.log10(1 + max(_usage(document, 'Disk_IO'), 0.0)),
+        math.log10(1 + max(_usage(document, 'Network_Usage'), 0.0)),
+        _usage(document, 'Instance_Health'),
+    ]
+
+
+def cluster_key(document):
+    rightsizing = document['Rightsizing']
+    return (
+        document.get('instance_type'), rightsizing['action'], rightsizing['target_type'],
+        tuple(sorted(document['Optimization_Recommendations'])),
+    )
+
+
+def cluster_documents(documents, tolerance=None):
+    # {representative instance id: [member instance ids, representative included]} for
+    # every instance with recommendations. The representative is the member closest to
+    # its cluster's mean profile.
+    if tolerance is None:
+        tolerance = getattr(settings, 'OPTICLOUD_CLUSTER_TOLERANCE', 1.0)
+
+    groups = {}
+    for instance_id, document in documents.items():
+        if document['Optimization_Recommendations']:
+            shapes = tuple(draft_shape(entry) for _, entry in sorted(document['Optimization_Recommendations'].items()))
+            groups.setdefault((cluster_key(document), shapes), []).append(instance_id)
+
+    clusters = {}
+    for instance_ids in groups.values():
+        profiles = np.array([instance_profile(documents[instance_id]) for instance_id in instance_ids])
+        profiles /= FEATURE_TOLERANCES
+        unassigned = np.ones(len(instance_ids), dtype=bool)
+        while unassigned.any():
+            leader = np.flatnonzero(unassigned)[0]
+            members = unassigned & (np.abs(profiles - profiles[leader]).max(axis=1) <= tolerance)
+            indices = np.flatnonzero(members)
+            centroid = profiles[indices].mean(axis=0)
+            representative = indices[np.abs(profiles[indices] - centroid).max(axis=1).argmin()]
+            clusters[instance_ids[representative]] = [instance_ids[index] for index in indices]
+            unassigned &= ~members
+    return clusters
+
+
+def fan_out(templates, clusters):
+    # Give every member of a cluster the wording templates ({instance_id: {metric:
+    # template}}) of its representative
+    return {
+        instance_id: templates[representative]
+        for representative, members in clusters.items() if representative in templates
+        for instance_id in members
+    }
@@ -0,0 +1,126 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+
+from .aws import create_customer_client, describe_ec2_instances, get_default_region, get_enabled_regions
+from .cloudwatch import chunk_instance_ids, get_metric_data_for_instances
+
+logger = logging.getLogger(__name__)
+
+
+def notify(progress, event, data):
+    # Progress reporting must never break collection
+    if progress is None:
+        return
+    try:
+        progress(event, data)
+    except Exception as e:
+        logger.warning("Progress callback failed for %s: %s", event, e)
+
+
+def get_collection_regions(customer_credentials):
+    # Either the default region only, or every region enabled on the customer's account
+    if not getattr(settings, 'OPTICLOUD_COLLECT_ALL_REGIONS', False):
+        return [get_default_region()]
+    try:
+        return get_enabled_regions(customer_credentials)
+    except (BotoCoreError, ClientError) as e:
+        logger.warning("Failed to list enabled regions, using the default region: %s", e)
+        return [get_default_region()]
+
+
+def collect_ec2_metrics(customer_credentials, start_time, end_time, regions=None, max_workers=None,
+                        start_time_for=None, progress=None):
+    # Collect instances and their metrics for a single account.
+    if regions is None:
+        regions = get_collection_regions(customer_credentials)
+    account_id = customer_credentials.get('account_id')
+    return collect_ec2_metrics_for_accounts(
+        {account_id: customer_credentials}, start_time, end_time, {account_id: regions}, max_workers,
+        start_time_for, progress
+    )
+
+
+def collect_ec2_metrics_for_accounts(credentials_by_account, start_time, end_time,
+                                     regions_by_account=None, max_workers=None, start_time_for=None,
+                                     progress=None):
+    # Fan out DescribeInstances over every account/region and GetMetricData over every
+    # instance batch on one bounded thread pool. Clients are created on the calling
+    # thread; boto3 clients are safe to share between threads once built.
+    #
+    # Returns a list of instance records sorted by (account, region, instance id) so the
+    # result does not depend on which request happened to finish first:
+    #   {'account_id', 'region', 'instance_id', 'instance_type', 'state', 'metrics', 'error'}
+    # where 'metrics' is {metric_name: MetricSeries}.
+    #
+    # start_time_for(account_id, instance_id), when given, returns a later start time per
+    # instance for incremental collection; instances that are already up to date are
+    # listed with empty metrics and no CloudWatch call is made for them.
+    #
+    # progress(event, data), when given, is called from this thread as each region's
+    # instances are discovered and as each instance's metrics arrive.
+    if max_workers is None:
+        max_workers = getattr(settings, 'OPTICLOUD_COLLECTION_WORKERS', 8)
+    regions_by_account = regions_by_account or {}
+
+    records = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        describe_futures = {}
+        for account_id, credentials in credentials_by_account.items():
+            regions = regions_by_account.get(account_id) or get_collection_regions(credentials)
+            for region in regions:
+                ec2_client = create_customer_client('ec2', credentials, region)
+                future = executor.submit(describe_ec2_instances, ec2_client)
+                describe_futures[future] = (account_id, credentials, region)
+
+        batch_futures = {}
+        for future in as_completed(describe_futures):
+            account_id, credentials, region = describe_futures[future]
+            try:
+                instances = future.result()
+            except (BotoCoreError, ClientError) as e:
+                logger.warning("Failed to fetch EC2 instances in %s: %s", region, e)
+                continue
+            if not instances:
+                continue
+
+            for instance in instances:
+                records[(account_id, region, instance['instance_id'])] = dict(
+                    instance, account_id=account_id, region=region, metrics={}, error=None
+                )
+            notify(progress, 'instances_discovered', {'region': region, 'count': len(instances)})
+
+            # GetMetricData takes one time range per request, so batch instances that
+            # share a start time together
+            ids_by_start = {}
+            for instance in instances:
+                instance_start = start_time_for(account_id, instance['instance_id']) if start_time_for else start_time
+                if instance_start < end_time:
+                    ids_by_start.setdefault(instance_start, []).append(instance['instance_id'])
+
+            cloudwatch_client = create_customer_client('cloudwatch', credentials, region)
+            for instance_start, instance_ids in ids_by_start.items():
+                for batch in chunk_instance_ids(instance_ids):
+                    future = executor.submit(get_metric_data_for_instances, cloudwatch_client, batch, instance_start, end_time)
+                    batch_futures[future] = (account_id, region)
+
+        for future in as_completed(batch_futures):
+            account_id, region = batch_futures[future]
+            metrics_by_instance, errors = future.result()
+            for instance_id, metrics in metrics_by_instance.items():
+                records[(account_id, region, instance_id)]['metrics'] = metrics
+            for instance_id, error in errors.items():
+                records[(account_id, region, instance_id)]['error'] = error
+            for instance_id in list(metrics_by_instance) + list(errors):
+                record = records[(account_id, region, instance_id)]
+                notify(progress, 'instance_collected', {
+                    'instance_id': instance_id,
+                    'region': region,
+                    'instance_type': record['instance_type'],
+                    'datapoints': sum(len(series) for series in record['metrics'].values()),
+                    'error': record['error'],
+                })
+
+    return [records[key] for key in sorted(records, key=lambda k: (k[0] or '', k[1], k[2]))]
@@ -0,0 +1,210 @@
+import base64
+import binascii
+import json
+import logging
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+from .mongodb import create_index, get_database
+from .rightsizing import ACTIONS, units_saved
+
+logger = logging.getLogger(__name__)
+
+
+# One document per user and instance, mirroring aws_metrics.instances so fleet queries
+# filter, sort and page with indexes instead of loading a user's whole aws_metrics:
+#
+# {
+#   '_id': '<user id>:<instance id>',
+#   'user_id': str, 'instance_id': str, 'region': str, 'instance_type': str,
+#   'action': str, 'target_type': str or None,
+#   'cpu_mean': float or None, 'cpu_p95': float or None,
+#   'savings_percent': float, 'savings_units': float or None,
+#   'generated_at': datetime,
+#   'recommendation': {...the per-instance document...},
+# }
+#
+# Missing numbers are stored as null so keyset pagination can page past them.
+FLEET_COLLECTION = 'instance_recommendations'
+
+# Sortable fields; every one has an index led by user_id
+SORT_FIELDS = ['savings_percent', 'savings_units', 'cpu_p95', 'cpu_mean', 'instance_id']
+DEFAULT_SORT = '-savings_percent'
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Fields returned per instance
+FLEET_PROJECTION = {
+    '_id': 1, 'instance_id': 1, 'region': 1, 'instance_type': 1, 'action': 1, 'target_type': 1,
+    'cpu_mean': 1, 'cpu_p95': 1, 'savings_percent': 1, 'savings_units': 1, 'recommendation': 1,
+}
+
+
+class FleetQueryError(ValueError):
+    pass
+
+
+def get_fleet_collection(db=None):
+    return (db if db is not None else get_database())[FLEET_COLLECTION]
+
+
+def ensure_fleet_indexes(db=None):
+    collection = get_fleet_collection(db)
+    # The _id tie-break follows the sort direction, so one index serves both directions
+    created = [
+        create_index(collection, [('user_id', ASCENDING), (field, ASCENDING), ('_id', ASCENDING)], name=f'user_{field}')
+        for field in SORT_FIELDS
+    ]
+    created += [
+        create_index(
+            collection,
+            [('user_id', ASCENDING), ('region', ASCENDING), ('instance_type', ASCENDING), ('_id', ASCENDING)],
+            name='user_region_type'
+        ),
+        create_index(collection, [('user_id', ASCENDING), ('action', ASCENDING), ('_id', ASCENDING)], name='user_action'),
+        create_index(collection, [('user_id', ASCENDING), ('generated_at', ASCENDING)], name='user_generated_at'),
+    ]
+    return all(created)
+
+
+def fleet_record(user_id, instance_id, document, generated_at):
+    cpu = document['Optimization_Recommendations'].get('CPU_Utilization')
+    rightsizing = document.get('Rightsizing') or {}
+    return {
+        'user_id': user_id,
+        'instance_id': instance_id,
+        'region': document.get('region'),
+        'instance_type': document.get('instance_type'),
+        'action': rightsizing.get('action'),
+        'target_type': rightsizing.get('target_type'),
+        'cpu_mean': cpu['Current_Usage'] if cpu else None,
+        'cpu_p95': rightsizing.get('cpu_p95'),
+        'savings_percent': document['Carbon_Footprint_Reduction']['Reduction_Percentage'],
+        'savings_units': units_saved(document),
+        'generated_at': generated_at,
+        'recommendation': document,
+    }
+
+
+def replace_fleet(user_id, aws_metrics):
+    # Mirror a stored aws_metrics document: upsert every instance, then drop the ones
+    # that were not part of this refresh
+    collection = get_fleet_collection()
+    if not aws_metrics:
+        collection.delete_many({'user_id': user_id})
+        return
+    generated_at = aws_metrics.get('generated_at') or datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {'_id': f"{user_id}:{instance_id}"},
+            {'$set': fleet_record(user_id, instance_id, document, generated_at)},
+            upsert=True
+        )
+        for instance_id, document in aws_metrics['instances'].items()
+    ]
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    collection.delete_many({'user_id': user_id, 'generated_at': {'$ne': generated_at}})
+
+
+def update_fleet_recommendation(user_id, instance_id, document):
+    # A narrated recommendation for an instance that is already in the fleet
+    get_fleet_collection().update_one({'_id': f"{user_id}:{instance_id}"}, {'$set': {'recommendation': document}})
+
+
+def _number(value, name):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise FleetQueryError(f"{name} must be a number")
+
+
+def encode_cursor(value, document_id):
+    return base64.urlsafe_b64encode(json.dumps([value, document_id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        value, document_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, binascii.Error):
+        raise FleetQueryError("Invalid cursor")
+    # Anything but a plain value could smuggle query operators in
+    if not isinstance(document_id, str) or not (value is None or isinstance(value, (int, float, str))):
+        raise FleetQueryError("Invalid cursor")
+    return value, document_id
+
+
+def _after(field, descending, value, document_id):
+    # Keyset condition for the documents after (value, _id) in sort order. Nulls sort
+    # before every number ascending and after every number descending.
+    same = {field: value, '_id': {'$lt' if descending else '$gt': document_id}}
+    if value is None:
+        return same if descending else {'$or': [same, {field: {'$ne': None}}]}
+    later = {field: {'$lt' if descending else '$gt': value}}
+    if descending:
+        return {'$or': [later, same, {field: None}]}
+    return {'$or': [later, same]}
+
+
+def build_fleet_query(user_id, params):
+    # (filter, sort, page size) from the query string parameters:
+    #   region, instance_type, action, max_cpu_p95, min_savings,
+    #   sort (a SORT_FIELDS name, '-' for descending), limit, cursor
+    query = {'user_id': user_id}
+    for field in ('region', 'instance_type'):
+        if params.get(field):
+            query[field] = params[field]
+    if params.get('action'):
+        if params['action'] not in ACTIONS:
+            raise FleetQueryError(f"action must be one of {', '.join(ACTIONS)}")
+        query['action'] = params['action']
+    max_cpu_p95 = _number(params.get('max_cpu_p95'), 'max_cpu_p95')
+    if max_cpu_p95 is not None:
+        query['cpu_p95'] = {'$lte': max_cpu_p95}
+    min_savings = _number(params.get('min_savings'), 'min_savings')
+    if min_savings is not None:
+        query['savings_percent'] = {'$gte': min_savings}
+
+    sort = params.get('sort') or DEFAULT_SORT
+    descending = sort.startswith('-')
+    field = sort.lstrip('-')
+    if field not in SORT_FIELDS:
+        raise FleetQueryError(f"sort must be one of {', '.join(SORT_FIELDS)}")
+
+    limit = _number(params.get('limit'), 'limit')
+    limit = DEFAULT_PAGE_SIZE if limit is None else int(limit)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise FleetQueryError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    if params.get('cursor'):
+        value, document_id = decode_cursor(params['cursor'])
+        query = {'$and': [query, _after(field, descending, value, document_id)]}
+    direction = DESCENDING if descending else ASCENDING
+    return query, [(field, direction), ('_id', direction)], limit
+
+
+def query_fleet(user_id, params):
+    # One page of a user's instances: {'instances': [...], 'next_cursor': str or None}
+    query, sort, limit = build_fleet_query(user_id, params)
+    field = sort[0][0]
+    # One extra document tells whether there is a next page
+    documents = list(get_fleet_collection().find(query, FLEET_PROJECTION).sort(sort).limit(limit + 1))
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1].get(field), documents[-1]['_id'])
+    for document in documents:
+        del document['_id']
+    return {'instances': documents, 'next_cursor': next_cursor}
+
+
+def sync_fleet(user_id, aws_metrics):
+    # The fleet is a read model: failing to update it must not fail a refresh
+    try:
+        replace_fleet(user_id, aws_metrics)
+    except PyMongoError as e:
+        logger.warning("Failed to update the fleet records of %s: %s", user_id, e)
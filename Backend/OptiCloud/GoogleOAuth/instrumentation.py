@@ -0,0 +1,189 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+from pymongo import monitoring
+
+
+# Per-process latency histograms and call/error/throttle/byte counters for every external
+# call the pipeline makes, rendered in the Prometheus text format by the /metrics view.
+#
+# Series are labelled by stage: 'aws.<service>.<operation>' and 'mongo.<command>' are
+# recorded from botocore events and a pymongo command listener, everything else
+# ('openai.chat_completion', 'cloudwatch.batch', 'pipeline.collect', ...) by span().
+# Each worker process keeps its own numbers, so scrape every worker.
+
+# Seconds; covers a cached Mongo lookup up to a slow LLM completion
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+THROTTLING_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'TooManyRequestsException', 'RequestLimitExceeded',
+    'ProvisionedThroughputExceededException', 'SlowDown', 'PriorRequestNotComplete',
+}
+
+
+class Registry:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}  # stage -> [bucket counts..., +Inf count, sum]
+        self._counters = {}  # (name, stage) -> value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[index] += 1
+            histogram[len(self.buckets)] += 1
+            histogram[-1] += seconds
+
+    def inc(self, name, stage, amount=1):
+        with self._lock:
+            self._counters[(name, stage)] = self._counters.get((name, stage), 0) + amount
+
+    def render(self):
+        with self._lock:
+            histograms = {stage: list(values) for stage, values in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = [
+            '# HELP opticloud_stage_duration_seconds Time spent per pipeline stage or external call.',
+            '# TYPE opticloud_stage_duration_seconds histogram',
+        ]
+        for stage in sorted(histograms):
+            values = histograms[stage]
+            for index, bound in enumerate(self.buckets):
+                lines.append(f'opticloud_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {values[index]}')
+            lines.append(f'opticloud_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {values[len(self.buckets)]}')
+            lines.append(f'opticloud_stage_duration_seconds_sum{{stage="{stage}"}} {values[-1]}')
+            lines.append(f'opticloud_stage_duration_seconds_count{{stage="{stage}"}} {values[len(self.buckets)]}')
+
+        for name, help_text in COUNTERS:
+            series = sorted((stage, value) for (counter, stage), value in counters.items() if counter == name)
+            if not series:
+                continue
+            lines.append(f'# HELP opticloud_{name}_total {help_text}')
+            lines.append(f'# TYPE opticloud_{name}_total counter')
+            for stage, value in series:
+                lines.append(f'opticloud_{name}_total{{stage="{stage}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+COUNTERS = [
+    ('calls', 'Calls per stage.'),
+    ('errors', 'Failed calls per stage.'),
+    ('throttles', 'Attempts rejected by rate limiting, retries included, per stage.'),
+    ('bytes', 'Response bytes received per stage.'),
+]
+
+registry = Registry()
+
+
+def record(stage, seconds, error=None, throttled=False, response_bytes=0):
+    registry.observe(stage, seconds)
+    registry.inc('calls', stage)
+    if error is not None:
+        registry.inc('errors', stage)
+    if throttled:
+        registry.inc('throttles', stage)
+    if response_bytes:
+        registry.inc('bytes', stage, response_bytes)
+
+
+def is_throttling_error(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+    # openai.RateLimitError and anything else that carries an HTTP 429
+    return getattr(error, 'status_code', None) == 429
+
+
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.response_bytes = 0
+
+    def add_bytes(self, count):
+        self.response_bytes += count
+
+
+@contextmanager
+def span(stage):
+    # Time a block and count it under `stage`; exceptions are counted and re-raised
+    current = Span(stage)
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        record(stage, time.perf_counter() - started, error=e, throttled=is_throttling_error(e),
+               response_bytes=current.response_bytes)
+        raise
+    record(stage, time.perf_counter() - started, response_bytes=current.response_bytes)
+
+
+# botocore: one observation per API call, including the time spent on retries. Throttled
+# attempts are counted as they happen, since a retried call may still succeed.
+
+def _aws_stage(model):
+    return f"aws.{model.service_model.service_name}.{model.name}"
+
+
+def _before_aws_call(model, context, **kwargs):
+    context['opticloud_stage'] = _aws_stage(model)
+    context['opticloud_started'] = time.perf_counter()
+
+
+def _after_aws_call(http_response, parsed, context, **kwargs):
+    if 'opticloud_started' not in context:
+        return
+    error = parsed.get('Error') if isinstance(parsed, dict) else None
+    # Stubbed responses have no body to measure
+    response_bytes = len(http_response.content or b'') if getattr(http_response, 'raw', None) is not None else 0
+    record(context['opticloud_stage'], time.perf_counter() - context['opticloud_started'],
+           error=error or None, response_bytes=response_bytes)
+
+
+def _after_aws_call_error(exception, context, **kwargs):
+    if 'opticloud_started' not in context:
+        return
+    record(context['opticloud_stage'], time.perf_counter() - context['opticloud_started'], error=exception)
+
+
+def _aws_attempt(operation, response, **kwargs):
+    if response is None:
+        return
+    code = response[1].get('Error', {}).get('Code') if isinstance(response[1], dict) else None
+    if code in THROTTLING_ERROR_CODES:
+        registry.inc('throttles', _aws_stage(operation))
+
+
+def instrument_boto3_session(session):
+    # Clients copy the session's handlers when they are built, so call this before
+    # creating any client from the session. Timing starts at parameter building so calls
+    # answered by a before-call handler (botocore's Stubber) are measured too.
+    session.events.register('before-parameter-build', _before_aws_call)
+    session.events.register('after-call', _after_aws_call)
+    session.events.register('after-call-error', _after_aws_call_error)
+    session.events.register('needs-retry', _aws_attempt)
+
+
+# pymongo: one observation per command sent to the server
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record(f"mongo.{event.command_name}", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record(f"mongo.{event.command_name}", event.duration_micros / 1e6, error=event.failure)
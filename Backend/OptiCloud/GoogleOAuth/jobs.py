@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from django.conf import settings
+from pymongo.errors import PyMongoError
+
+from .aio import on_server_loop, run_blocking
+from .collector import notify
+from .llm_queue import BACKGROUND, INTERACTIVE
+from .mongodb import get_database
+from .pipeline import arefresh_metrics, refresh_metrics
+from .singleflight import acquire_lease, lease_is_held, refresh_key, release_lease, start_or_join
+
+logger = logging.getLogger(__name__)
+
+
+# Local worker pool that runs refresh jobs off the request thread, one per process
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# Refreshes started from async views under asgi.py run as tasks on the server's event
+# loop. The loop only keeps weak references to tasks, so hold on to them until they
+# finish.
+_async_jobs = set()
+
+# Seconds between checks on a refresh that another process is running
+REMOTE_POLL_INTERVAL = 2
+
+
+def get_jobs_collection():
+    return get_database()['refresh_jobs']
+
+
+def get_executor():
+    global _executor, _executor_pid
+    # Threads don't survive a fork, so a forked worker needs its own pool
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'OPTICLOUD_JOB_WORKERS', 4),
+                    thread_name_prefix='opticloud-refresh'
+                )
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def create_job(role_arn, user_id=None, job_id=None):
+    job_id = job_id or uuid.uuid4().hex
+    get_jobs_collection().insert_one({
+        '_id': job_id,
+        'kind': 'refresh',
+        'user_id': user_id,
+        'role_arn': role_arn,
+        'status': 'queued',
+        'created_at': datetime.now(timezone.utc),
+    })
+    return job_id
+
+
+def mark_job_running(job_id):
+    get_jobs_collection().update_one(
+        {'_id': job_id},
+        {'$set': {'status': 'running', 'started_at': datetime.now(timezone.utc)}}
+    )
+
+
+def mark_job_failed(job_id, error):
+    get_jobs_collection().update_one(
+        {'_id': job_id},
+        {'$set': {'status': 'failed', 'error': str(error), 'finished_at': datetime.now(timezone.utc)}}
+    )
+
+
+def mark_job_succeeded(job_id, user_id=None, result=None):
+    update = {'status': 'succeeded', 'finished_at': datetime.now(timezone.utc)}
+    if not user_id:
+        update['result'] = result
+    get_jobs_collection().update_one({'_id': job_id}, {'$set': update})
+
+
+def start_refresh(role_arn, user_id=None, progress=None):
+    # (flight, started): joins the refresh already in flight for this user and role, or
+    # claims it. A started flight either runs here or follows the refresh that holds the
+    # lease in another process (flight.remote).
+    key = refresh_key(role_arn, user_id)
+    flight, started = start_or_join(key, uuid.uuid4().hex, progress)
+    if not started:
+        flight.ready.wait()
+        return flight, False
+    try:
+        remote_job_id = acquire_lease(key, flight.job_id)
+        if remote_job_id:
+            flight.job_id = remote_job_id
+            flight.remote = True
+        else:
+            create_job(role_arn, user_id, flight.job_id)
+    except Exception as e:
+        release_lease(key, flight.job_id)
+        flight.publish('failed', {'job_id': flight.job_id, 'error': str(e)})
+        raise
+    finally:
+        flight.ready.set()
+    return flight, True
+
+
+def enqueue_refresh(role_arn, user_id=None, fresh_credentials=False, progress=None):
+    # Record the job, hand it to the worker pool and return its id straight away.
+    # The result is only kept on the job when there is no user document to store it on.
+    # Concurrent requests for the same user and role share one refresh and its job id.
+    flight, started = start_refresh(role_arn, user_id, progress)
+    if started and flight.remote:
+        get_executor().submit(follow_remote_job, flight)
+    elif started:
+        get_executor().submit(run_flight, flight, role_arn, user_id, fresh_credentials)
+    return flight.job_id
+
+
+def refresh_and_wait(role_arn, user_id=None, fresh_credentials=False, priority=BACKGROUND):
+    # Blocking version for the scheduler: runs the refresh on the calling thread, or
+    # waits for the one in flight. Returns the error of a failed refresh, or None.
+    # Nobody is watching a scheduled refresh, so its LLM call yields to interactive ones.
+    flight, started = start_refresh(role_arn, user_id)
+    if started and flight.remote:
+        follow_remote_job(flight)
+    elif started:
+        run_flight(flight, role_arn, user_id, fresh_credentials, priority)
+    if not flight.finished.wait(flight.remaining()):
+        return 'The refresh timed out'
+    return flight.error
+
+
+def run_flight(flight, role_arn, user_id=None, fresh_credentials=False, priority=INTERACTIVE):
+    try:
+        run_refresh_job(flight.job_id, role_arn, user_id, fresh_credentials, flight.publish, priority)
+    except Exception as e:
+        # Only bookkeeping failures get here
+        logger.exception("Refresh job %s failed", flight.job_id)
+        abandon_flight(flight, str(e))
+    finally:
+        # The flight must land whatever happened, or every later request would join it
+        abandon_flight(flight, 'The refresh was interrupted')
+        release_lease(flight.key, flight.job_id)
+
+
+def abandon_flight(flight, error):
+    # The refresh stopped without an outcome: fail its job (unless another process runs
+    # it) and land the flight, so later requests start a new refresh. No-op once the
+    # flight has finished.
+    if flight.finished.is_set():
+        return
+    if not flight.remote:
+        try:
+            mark_job_failed(flight.job_id, error)
+        except PyMongoError as e:
+            logger.warning("Failed to record the failure of refresh job %s: %s", flight.job_id, e)
+    flight.publish('failed', {'job_id': flight.job_id, 'error': error})
+
+
+def run_refresh_job(job_id, role_arn, user_id=None, fresh_credentials=False, progress=None, priority=INTERACTIVE):
+    mark_job_running(job_id)
+    try:
+        result = refresh_metrics(role_arn, user_id, fresh_credentials, progress, priority)
+    except Exception as e:
+        logger.exception("Refresh job %s failed", job_id)
+        mark_job_failed(job_id, e)
+        notify(progress, 'failed', {'job_id': job_id, 'error': str(e)})
+        return
+
+    mark_job_succeeded(job_id, user_id, result)
+    notify(progress, 'done', {'job_id': job_id})
+
+
+def remote_job_outcome(flight):
+    # ('done' | 'failed', data) once the other process's job has finished, else None
+    job = get_job(flight.job_id)
+    if job and job['status'] == 'succeeded':
+        return 'done', {'job_id': flight.job_id}
+    if job and job['status'] == 'failed':
+        return 'failed', {'job_id': flight.job_id, 'error': job.get('error')}
+    if not lease_is_held(flight.key, flight.job_id):
+        # The lease may have been released right after the job finished
+        job = get_job(flight.job_id)
+        if job and job['status'] in ('succeeded', 'failed'):
+            return remote_job_outcome(flight)
+        return 'failed', {'job_id': flight.job_id, 'error': 'The refresh was abandoned'}
+    return None
+
+
+def follow_remote_job(flight):
+    # The refresh runs in another process; pass its outcome on when its job finishes
+    flight.publish('joined', {'job_id': flight.job_id})
+    try:
+        outcome = remote_job_outcome(flight)
+        while outcome is None:
+            time.sleep(REMOTE_POLL_INTERVAL)
+            outcome = remote_job_outcome(flight)
+    except Exception as e:
+        outcome = 'failed', {'job_id': flight.job_id, 'error': str(e)}
+    flight.publish(*outcome)
+
+
+async def aenqueue_refresh(role_arn, user_id=None, fresh_credentials=False, progress=None):
+    # enqueue_refresh for async views. Under asgi.py the refresh runs as a task on the
+    # server's event loop; elsewhere (runserver, WSGI) the view's loop is torn down with
+    # the request, cancelling its tasks, so the refresh goes to the job pool instead.
+    if not on_server_loop():
+        return await run_blocking(enqueue_refresh, role_arn, user_id, fresh_credentials, progress)
+    flight, started = await run_blocking(start_refresh, role_arn, user_id, progress)
+    if started:
+        if flight.remote:
+            task = asyncio.create_task(afollow_remote_job(flight))
+        else:
+            task = asyncio.create_task(arun_flight(flight, role_arn, user_id, fresh_credentials))
+        _async_jobs.add(task)
+        task.add_done_callback(_async_jobs.discard)
+    return flight.job_id
+
+
+async def arun_flight(flight, role_arn, user_id=None, fresh_credentials=False):
+    cancelled = False
+    try:
+        await arun_refresh_job(flight.job_id, role_arn, user_id, fresh_credentials, flight.publish)
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    except Exception as e:
+        logger.exception("Refresh job %s failed", flight.job_id)
+        await run_blocking(abandon_flight, flight, str(e))
+    finally:
+        # The flight must land whatever happened, or every later request would join it
+        if cancelled:
+            # e.g. the server is shutting down; a cancelled task can't wait on the pool
+            abandon_flight(flight, 'The refresh was cancelled')
+            release_lease(flight.key, flight.job_id)
+        else:
+            await run_blocking(abandon_flight, flight, 'The refresh was interrupted')
+            await run_blocking(release_lease, flight.key, flight.job_id)
+
+
+async def arun_refresh_job(job_id, role_arn, user_id=None, fresh_credentials=False, progress=None):
+    await run_blocking(mark_job_running, job_id)
+    try:
+        result = await arefresh_metrics(role_arn, user_id, fresh_credentials, progress)
+    except Exception as e:
+        logger.exception("Refresh job %s failed", job_id)
+        await run_blocking(mark_job_failed, job_id, e)
+        notify(progress, 'failed', {'job_id': job_id, 'error': str(e)})
+        return
+
+    await run_blocking(mark_job_succeeded, job_id, user_id, result)
+    notify(progress, 'done', {'job_id': job_id})
+
+
+async def afollow_remote_job(flight):
+    flight.publish('joined', {'job_id': flight.job_id})
+    try:
+        outcome = await run_blocking(remote_job_outcome, flight)
+        while outcome is None:
+            await asyncio.sleep(REMOTE_POLL_INTERVAL)
+            outcome = await run_blocking(remote_job_outcome, flight)
+    except asyncio.CancelledError:
+        abandon_flight(flight, 'Stopped following the refresh')  # touches no job of ours
+        raise
+    except Exception as e:
+        outcome = 'failed', {'job_id': flight.job_id, 'error': str(e)}
+    flight.publish(*outcome)
+
+
+def get_job(job_id):
+    return get_jobs_collection().find_one({'_id': job_id}, {'role_arn': 0})
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+
+from .aio import run_blocking
+from .instrumentation import span
+from .llm_cache import get_recommendation_cache, make_cache_key
+from .llm_queue import INTERACTIVE, LLMRequest
+from .recommendations import RecommendationParseError, parse_llm_output
+
+logger = logging.getLogger(__name__)
+
+
+MODEL = "gpt-3.5-turbo"
+
+# Output budget: the model's limit, and what a narration needs per instance
+MAX_TOKENS = 4096
+TOKENS_BASE = 256
+TOKENS_PER_INSTANCE = 256
+# For the token budget of the dispatch queue, before the API says what a call used
+CHARS_PER_TOKEN = 4
+
+# Bump whenever PROMPT_TEMPLATE changes so cached recommendations are not reused
+PROMPT_VERSION = 4
+
+PROMPT_TEMPLATE = r"""You are an AWS optimization and sustainability expert. The table below lists EC2 instances with the rightsizing already worked out from their CloudWatch metrics over the last 24 hours: one row per instance and metric with the suggested action (stop, downsize, upsize, schedule or keep), the target instance type, the current and optimized usage, and a draft recommendation.
+
+Rewrite each draft recommendation as one clear, specific line that explains the action and how it reduces cost, energy usage and the carbon footprint. Mention AWS features such as auto-scaling, instance scheduling or more efficient instance types where they fit. Keep every number and instance type exactly as given and do not invent new ones.
+
+{final_output}
+Provide your response as valid JSON (double-quoted keys and strings) with one entry per instance id and one Recommendation per metric in the table, in the following specific format:
+{
+  "Instances": {
+    "i-0123456789abcdef0": {
+      "Optimization_Recommendations": {
+        "CPU_Utilization": {
+          "Recommendation": "CPU peaks at 14% of an m5.xlarge; moving to an m5.large halves the vCPUs the workload keeps powered."
+        },
+        "Disk_IO": {
+          "Recommendation": "No disk activity in the last 24 hours; snapshot and remove unused EBS volumes."
+        }
+      }
+    }
+  }
+}"""
+
+
+def build_prompt(final_output):
+    return PROMPT_TEMPLATE.replace("{final_output}", final_output)
+
+
+def max_tokens_for(instance_count):
+    # Room for one recommendation per instance and no more, so a runaway generation is
+    # cut off by the API instead of running to the model's limit
+    return min(MAX_TOKENS, TOKENS_BASE + TOKENS_PER_INSTANCE * max(instance_count, 1))
+
+
+def estimate_tokens(prompt, max_tokens):
+    return len(prompt) // CHARS_PER_TOKEN + max_tokens
+
+
+def tokens_used(response):
+    usage = getattr(response, 'usage', None)
+    return getattr(usage, 'total_tokens', None) or None
+
+
+# The dispatch queue retries rate-limited calls itself (llm_queue.py), so the clients
+# must not retry on their own. openai is imported with the first client: it is the
+# slowest import of the app and most requests never reach it.
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                import openai
+                _client = openai.OpenAI(max_retries=0)
+                _client_pid = os.getpid()
+    return _client
+
+
+def is_complete_answer(text):
+    # Only complete answers are cached; a cut-off stream would be served again otherwise
+    try:
+        parse_llm_output(text)
+        return True
+    except RecommendationParseError:
+        return False
+
+
+def generate_text_from_gpt(final_output, on_delta=None, max_tokens=MAX_TOKENS, tenant=None, priority=INTERACTIVE):
+    # Identical metrics (same model and prompt) get the cached recommendation back.
+    # With on_delta the completion is streamed: on_delta(text) gets every piece as it
+    # arrives and can return False to stop reading, and a cached answer is handed to it
+    # in one piece. Calls wait for a slot in the dispatch queue as `tenant` with
+    # `priority` (llm_queue.py).
+    cache = get_recommendation_cache()
+    cache_key = make_cache_key(final_output, MODEL, PROMPT_VERSION)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        if on_delta:
+            on_delta(cached)
+        return cached
+
+    try:
+        logger.debug("LLM input: %s", final_output)
+        # Prepare the prompt
+        prompt = build_prompt(final_output)
+
+        # Sending POST request to GPT-3.5
+        with LLMRequest(tenant, priority, estimate_tokens(prompt, max_tokens)) as request, \
+                span('openai.chat_completion') as call:
+            response = request.call(
+                get_client().chat.completions.create,
+                model=MODEL,
+                messages=[
+                    {"role": "user", "content": f"{prompt}"}
+                ],
+                max_tokens=max_tokens,
+                temperature=0.5,
+                stream=on_delta is not None,
+            )
+            if on_delta is None:
+                refined_text = response.choices[0].message.content
+                request.tokens_used = tokens_used(response)
+            else:
+                parts = []
+                try:
+                    for chunk in response:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            parts.append(delta)
+                            if on_delta(delta) is False:
+                                break
+                finally:
+                    response.close()
+                refined_text = ''.join(parts)
+            call.add_bytes(len(refined_text or ''))
+        logger.debug("LLM output: %s", refined_text)
+        if is_complete_answer(refined_text):
+            cache.set(cache_key, refined_text)
+        return refined_text
+    except Exception as e:
+        logger.error("OpenAI completion failed: %s", e)
+        return None
+
+
+# AsyncOpenAI keeps an HTTP connection pool tied to the event loop it was first used
+# on, so each loop gets its own client
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        import openai
+        client = _async_clients[loop] = openai.AsyncOpenAI(max_retries=0)
+    return client
+
+
+async def agenerate_text_from_gpt(final_output, on_delta=None, max_tokens=MAX_TOKENS, tenant=None,
+                                  priority=INTERACTIVE):
+    # Same as generate_text_from_gpt, but the completion is awaited on the event loop
+    # so a request waiting on OpenAI holds no thread. on_delta runs on the loop.
+    cache = get_recommendation_cache()
+    cache_key = make_cache_key(final_output, MODEL, PROMPT_VERSION)
+    # The cache may go to MongoDB
+    cached = await run_blocking(cache.get, cache_key)
+    if cached is not None:
+        if on_delta:
+            on_delta(cached)
+        return cached
+
+    try:
+        prompt = build_prompt(final_output)
+        async with LLMRequest(tenant, priority, estimate_tokens(prompt, max_tokens)) as request:
+            with span('openai.chat_completion') as call:
+                response = await request.acall(
+                    get_async_client().chat.completions.create,
+                    model=MODEL,
+                    messages=[
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=max_tokens,
+                    temperature=0.5,
+                    stream=on_delta is not None,
+                )
+                if on_delta is None:
+                    refined_text = response.choices[0].message.content
+                    request.tokens_used = tokens_used(response)
+                else:
+                    parts = []
+                    try:
+                        async for chunk in response:
+                            delta = chunk.choices[0].delta.content if chunk.choices else None
+                            if delta:
+                                parts.append(delta)
+                                if on_delta(delta) is False:
+                                    break
+                    finally:
+                        await response.close()
+                    refined_text = ''.join(parts)
+                call.add_bytes(len(refined_text or ''))
+        logger.debug("LLM output: %s", refined_text)
+        if is_complete_answer(refined_text):
+            await run_blocking(cache.set, cache_key, refined_text)
+        return refined_text
+    except Exception as e:
+        logger.error("OpenAI completion failed: %s", e)
+        return None
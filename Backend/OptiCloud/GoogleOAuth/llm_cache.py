@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from pymongo.errors import PyMongoError
+
+from .mongodb import get_database
+
+logger = logging.getLogger(__name__)
+
+
+_NUMBER = re.compile(r'-?\d+\.\d+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_metrics_text(text):
+    # Metrics that only differ in float noise or whitespace should share a cache entry
+    text = _NUMBER.sub(lambda m: f"{float(m.group()):.2f}", text)
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def make_cache_key(metrics_text, model, prompt_version):
+    normalized = normalize_metrics_text(metrics_text)
+    return hashlib.sha256(f"{model}\0{prompt_version}\0{normalized}".encode('utf-8')).hexdigest()
+
+
+class RecommendationCache:
+    # LLM responses keyed by a content hash of their input. A bounded in-memory LRU with
+    # a TTL sits in front of an optional MongoDB tier shared by every worker.
+
+    def __init__(self, max_entries=1024, ttl=21600, use_mongo=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.use_mongo = use_mongo
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get_collection(self):
+        return get_database()['llm_recommendations']
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        if not self.use_mongo:
+            return None
+        try:
+            document = self.get_collection().find_one(
+                {'_id': key, 'expires_at': {'$gt': datetime.now(timezone.utc)}}
+            )
+        except PyMongoError as e:
+            logger.warning("Failed to read recommendation cache: %s", e)
+            return None
+        if document is None:
+            return None
+        self._remember(key, document['value'])
+        return document['value']
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if not self.use_mongo:
+            return
+        try:
+            self.get_collection().replace_one(
+                {'_id': key},
+                {'value': value, 'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl)},
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.warning("Failed to write recommendation cache: %s", e)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_recommendation_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RecommendationCache(
+                    max_entries=getattr(settings, 'OPTICLOUD_LLM_CACHE_SIZE', 1024),
+                    ttl=getattr(settings, 'OPTICLOUD_LLM_CACHE_TTL', 21600),
+                    use_mongo=getattr(settings, 'OPTICLOUD_LLM_CACHE_MONGO', False),
+                )
+    return _cache
@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Local dispatch queue in front of OpenAI. Every completion takes a slot first:
+#   - at most OPTICLOUD_LLM_WORKERS calls run at a time in this process,
+#   - interactive calls (a user waiting on a refresh) are served before background ones
+#     (scheduled refreshes),
+#   - within a priority, tenants (AWS accounts) take turns, so one account with many
+#     users cannot hold every slot,
+#   - a slot is only granted while the tokens granted over the last minute stay within
+#     OPTICLOUD_LLM_TOKENS_PER_MINUTE (0: no budget); a call larger than the whole
+#     budget still goes once the window is empty,
+#   - a 429 pauses the whole queue for the Retry-After time (or an exponential backoff)
+#     and the call is retried, up to OPTICLOUD_LLM_MAX_RETRIES times.
+#
+# Slots are granted by one dispatcher thread per process, so time-based waits (budget,
+# backoff) don't depend on another call finishing. Callers wait on a threading.Event,
+# or on a future of their event loop.
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+
+BUDGET_WINDOW = 60
+
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+class Ticket:
+    # One call's place in the queue
+
+    def __init__(self, tenant, priority, tokens):
+        self.tenant = tenant
+        self.priority = priority
+        self.tokens = tokens
+        self.granted = False
+        self.queued_at = None
+        self.spent = None  # [granted at, tokens] entry of the budget window
+        self._event = threading.Event()
+        self._loop = None
+        self._future = None
+
+    def grant(self):
+        # Called by the dispatcher with its lock held
+        self.granted = True
+        if self._future is not None:
+            self._loop.call_soon_threadsafe(_resolve, self._future)
+        else:
+            self._event.set()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMDispatcher:
+
+    def __init__(self, workers=4, tokens_per_minute=0, clock=time.monotonic):
+        self.workers = workers
+        self.tokens_per_minute = tokens_per_minute
+        self.clock = clock
+        self._condition = threading.Condition()
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}  # tenant -> deque of tickets
+        self._running = 0
+        self._spent = deque()  # [granted at, tokens] per slot granted within the window
+        self._spent_tokens = 0
+        self._paused_until = 0.0
+        self._thread = None
+
+    def submit(self, ticket, front=False):
+        # front: a retried call goes back to the head of its tenant's queue
+        with self._condition:
+            ticket.queued_at = self.clock()
+            tickets = self._queues[ticket.priority].setdefault(ticket.tenant, deque())
+            if front:
+                tickets.appendleft(ticket)
+            else:
+                tickets.append(ticket)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='opticloud-llm-dispatch', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def acquire(self, ticket, front=False):
+        ticket._event.clear()
+        self.submit(ticket, front)
+        ticket._event.wait()
+
+    async def aacquire(self, ticket, front=False):
+        ticket._loop = asyncio.get_running_loop()
+        ticket._future = ticket._loop.create_future()
+        self.submit(ticket, front)
+        try:
+            await ticket._future
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+
+    def cancel(self, ticket):
+        # Leave the queue, or give the slot back if it was granted in the meantime
+        with self._condition:
+            if not ticket.granted:
+                tickets = self._queues[ticket.priority].get(ticket.tenant)
+                if tickets and ticket in tickets:
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self._queues[ticket.priority][ticket.tenant]
+                return
+        self.release(ticket)
+
+    def release(self, ticket, tokens=None):
+        # tokens: what the call actually used, when known, replaces the estimate
+        with self._condition:
+            self._running -= 1
+            ticket.granted = False
+            # The estimate may already have left the window
+            if tokens is not None and any(entry is ticket.spent for entry in self._spent):
+                self._spent_tokens += tokens - ticket.spent[1]
+                ticket.spent[1] = tokens
+            self._condition.notify()
+
+    def backoff(self, seconds):
+        # The provider is rate limiting: grant nothing for `seconds`
+        with self._condition:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'running': self._running,
+                'queued': {
+                    priority: sum(len(tickets) for tickets in queue.values())
+                    for priority, queue in self._queues.items()
+                },
+                'tokens_last_minute': self._spent_tokens,
+            }
+
+    def _run(self):
+        with self._condition:
+            while True:
+                self._condition.wait(self._dispatch())
+
+    def _next_tenant(self):
+        for priority in PRIORITIES:
+            if self._queues[priority]:
+                return priority, next(iter(self._queues[priority]))
+        return None, None
+
+    def _dispatch(self):
+        # Grant every slot that can be granted now; returns how long to sleep before
+        # trying again (None: until submit / release / backoff)
+        while self._running < self.workers:
+            priority, tenant = self._next_tenant()
+            if priority is None:
+                return None
+            now = self.clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+            while self._spent and self._spent[0][0] <= now - BUDGET_WINDOW:
+                self._spent_tokens -= self._spent.popleft()[1]
+
+            queue = self._queues[priority]
+            tickets = queue[tenant]
+            ticket = tickets[0]
+            if self.tokens_per_minute and self._spent and self._spent_tokens + ticket.tokens > self.tokens_per_minute:
+                return self._spent[0][0] + BUDGET_WINDOW - now
+
+            tickets.popleft()
+            # Round robin: the tenant goes to the back of its priority's line
+            del queue[tenant]
+            if tickets:
+                queue[tenant] = tickets
+            ticket.spent = [now, ticket.tokens]
+            self._spent.append(ticket.spent)
+            self._spent_tokens += ticket.tokens
+            self._running += 1
+            waited = now - ticket.queued_at
+            if waited > 1:
+                logger.debug("LLM call for %s waited %.1fs for a slot", tenant, waited)
+            ticket.grant()
+        return None
+
+
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher, _dispatcher_pid
+    # The dispatcher thread doesn't survive a fork
+    if _dispatcher is None or _dispatcher_pid != os.getpid():
+        with _dispatcher_lock:
+            if _dispatcher is None or _dispatcher_pid != os.getpid():
+                _dispatcher = LLMDispatcher(
+                    workers=getattr(settings, 'OPTICLOUD_LLM_WORKERS', 4),
+                    tokens_per_minute=getattr(settings, 'OPTICLOUD_LLM_TOKENS_PER_MINUTE', 0),
+                )
+                _dispatcher_pid = os.getpid()
+    return _dispatcher
+
+
+def is_rate_limited(error):
+    # openai.RateLimitError, without importing openai
+    return getattr(error, 'status_code', None) == 429
+
+
+def retry_delay(error, attempt):
+    # Seconds to wait after a 429: what the provider asks for, else exponential backoff
+    # with jitter
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        try:
+            return min(float(headers[header]) * scale, BACKOFF_MAX)
+        except (KeyError, TypeError, ValueError):
+            continue
+    return min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+
+
+class LLMRequest:
+    # Holds a slot for the duration of a `with` (or `async with`) block:
+    #
+    #   with LLMRequest(tenant, priority, tokens) as request:
+    #       response = request.call(client.chat.completions.create, ...)
+    #       ...read the response...
+    #
+    # call() retries on 429, giving the slot back while the queue is paused.
+
+    def __init__(self, tenant=None, priority=INTERACTIVE, tokens=0, dispatcher=None, max_retries=None):
+        self.dispatcher = dispatcher or get_dispatcher()
+        self.ticket = Ticket(tenant, priority, tokens)
+        self.max_retries = (
+            max_retries if max_retries is not None else getattr(settings, 'OPTICLOUD_LLM_MAX_RETRIES', 4)
+        )
+        self.tokens_used = None
+
+    def __enter__(self):
+        self.dispatcher.acquire(self.ticket)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.ticket.granted:
+            self.dispatcher.release(self.ticket, self.tokens_used)
+
+    async def __aenter__(self):
+        await self.dispatcher.aacquire(self.ticket)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.ticket.granted:
+            self.dispatcher.release(self.ticket, self.tokens_used)
+
+    def _rate_limited(self, error, attempt):
+        if attempt >= self.max_retries:
+            raise error
+        delay = retry_delay(error, attempt)
+        logger.warning("Rate limited by OpenAI, retrying in %.1fs (attempt %d)", delay, attempt + 1)
+        self.dispatcher.release(self.ticket)
+        self.dispatcher.backoff(delay)
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                self._rate_limited(e, attempt)
+            attempt += 1
+            self.dispatcher.acquire(self.ticket, front=True)
+
+    async def acall(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                self._rate_limited(e, attempt)
+            attempt += 1
+            await self.dispatcher.aacquire(self.ticket, front=True)
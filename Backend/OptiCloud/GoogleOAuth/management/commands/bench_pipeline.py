@@ -0,0 +1,151 @@
+import logging
+import os
+
+import openai
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from GoogleOAuth import mongodb
+from GoogleOAuth.benchmark import (
+    ApiCallCounter, FakeCloudWatch, FakeOpenAIServer, patch_mongomock_bulk_write, run_round, seed_instances,
+    shift_collection_window, summarize_timings
+)
+from GoogleOAuth.cloudwatch import METRICS_TO_FETCH
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the refresh pipeline offline: moto for STS and EC2, a stubbed CloudWatch, "
+        "mongomock (or --mongo-uri) for MongoDB and a local fake OpenAI server"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--instances', type=int, default=20, help="EC2 instances in the fake account")
+        parser.add_argument('--metrics', type=int, default=len(METRICS_TO_FETCH),
+                            help="How many of the collected metrics have datapoints")
+        parser.add_argument('--profiles', type=int,
+                            help="Distinct metric series shared by the instances (default: one per instance)")
+        parser.add_argument('--users', type=int, default=4, help="Users refreshed per round, one role each")
+        parser.add_argument('--concurrency', type=int, default=4, help="Refreshes running at the same time")
+        parser.add_argument('--rounds', type=int, default=2,
+                            help="Rounds to run; later rounds show the effect of the caches")
+        parser.add_argument('--llm-latency', type=float, default=1.0, help="Seconds the fake OpenAI server waits")
+        parser.add_argument('--llm-misquote', type=float, default=0.1,
+                            help="Share of rows the fake model words with a figure that is not in the table")
+        parser.add_argument('--llm-server-limit', type=int,
+                            help="Concurrent requests the fake OpenAI server accepts before answering 429")
+        parser.add_argument('--llm-workers', type=int, help="LLM calls the dispatch queue runs at once")
+        parser.add_argument('--llm-tpm', type=int, help="Token budget per minute of the dispatch queue")
+        parser.add_argument('--cloudwatch-latency', type=float, default=0.1,
+                            help="Seconds each stubbed GetMetricData call takes")
+        parser.add_argument('--drift', type=float, default=0.3,
+                            help="How much each metric series trends up or down per hour")
+        parser.add_argument('--hours-between-rounds', type=int, default=1,
+                            help="How far the collection window slides from one round to the next")
+        parser.add_argument('--mongo-uri', help="Use this MongoDB (e.g. a local mongod) instead of mongomock")
+        parser.add_argument('--verbose', action='store_true', help="Log the pipeline at DEBUG level")
+
+    def handle(self, *args, **options):
+        try:
+            from moto import mock_aws
+        except ImportError:
+            raise CommandError("bench_pipeline needs moto: pip install moto")
+
+        if options['verbose']:
+            logging.getLogger('GoogleOAuth').setLevel(logging.DEBUG)
+
+        if options['mongo_uri']:
+            os.environ['MONGODB_URI'] = options['mongo_uri']
+        else:
+            try:
+                import mongomock
+            except ImportError:
+                raise CommandError("bench_pipeline needs mongomock or --mongo-uri: pip install mongomock")
+            patch_mongomock_bulk_write(mongomock)
+            mongodb._client = mongomock.MongoClient()
+            mongodb._client_pid = os.getpid()
+            # mongomock has no time-series collections
+            settings.OPTICLOUD_DATAPOINT_STORE = 'memory'
+
+        # moto only needs credentials to be present
+        for name, value in (('AWS_ACCESS_KEY_ID', 'bench'), ('AWS_SECRET_ACCESS_KEY', 'bench'),
+                            ('AWS_DEFAULT_REGION', 'us-east-1')):
+            os.environ.setdefault(name, value)
+
+        # Every refresh goes through the API with the test client; the job pool and the
+        # stream cap must let `concurrency` of them run at once
+        from django.test.utils import setup_test_environment
+        setup_test_environment()
+        settings.OPTICLOUD_JOB_WORKERS = max(settings.OPTICLOUD_JOB_WORKERS, options['concurrency'])
+        settings.OPTICLOUD_WSGI_REFRESH_STREAMS = max(settings.OPTICLOUD_WSGI_REFRESH_STREAMS, options['concurrency'])
+        if options['llm_workers']:
+            settings.OPTICLOUD_LLM_WORKERS = options['llm_workers']
+        if options['llm_tpm'] is not None:
+            settings.OPTICLOUD_LLM_TOKENS_PER_MINUTE = options['llm_tpm']
+
+        server = FakeOpenAIServer(
+            latency=options['llm_latency'], concurrency_limit=options['llm_server_limit'],
+            misquote=options['llm_misquote']
+        ).start()
+        openai.base_url = server.base_url
+        openai.api_key = 'bench'
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+        os.environ['OPENAI_API_KEY'] = 'bench'
+
+        try:
+            with mock_aws():
+                seed_instances(options['instances'])
+                counter = ApiCallCounter().install()
+                FakeCloudWatch(
+                    options['metrics'], options['cloudwatch_latency'], options['profiles'], options['drift']
+                ).install()
+                self.run_rounds(options, server, counter)
+        finally:
+            server.stop()
+
+    def run_rounds(self, options, server, counter):
+        users = options['users']
+        bench_users = [(f"bench-user-{index}", f"arn:aws:iam::123456789012:role/bench-{index}") for index in range(users)]
+        collection = mongodb.get_database()['test_collection']
+        for user_id, _ in bench_users:
+            collection.update_one({'id': user_id}, {'$set': {'id': user_id}}, upsert=True)
+
+        self.stdout.write(
+            f"{options['instances']} instances, {options['metrics']} metrics with data, {users} users, "
+            f"concurrency {options['concurrency']}, LLM latency {options['llm_latency']}s, "
+            f"GetMetricData latency {options['cloudwatch_latency']}s, drift {options['drift']}/h, "
+            f"{options['hours_between_rounds']}h between rounds"
+        )
+        for round_number in range(1, options['rounds'] + 1):
+            shift_collection_window((round_number - 1) * options['hours_between_rounds'])
+            calls_before = counter.snapshot()
+            llm_before = server.requests
+            prompt_chars_before = server.prompt_chars
+            rate_limited_before = server.rate_limited
+            server.peak_in_flight = 0
+            elapsed, recorders, failures, joined = run_round(bench_users, options['concurrency'])
+            calls = {
+                name: count - calls_before.get(name, 0)
+                for name, count in counter.snapshot().items()
+                if count - calls_before.get(name, 0)
+            }
+
+            self.stdout.write(f"\nRound {round_number}: {elapsed:.2f}s, "
+                              f"{users / elapsed:.2f} refreshes/s, "
+                              f"{users * options['instances'] / elapsed:.1f} instances/s, "
+                              f"{failures} failed, {joined} of {users} streams joined the refresh their POST started")
+            stage_names = ['assume_role', 'collect', 'recommend', 'narrate', 'first_result', 'store']
+            for stage in stage_names:
+                timings = summarize_timings([r.stages()[stage] for r in recorders if stage in r.stages()])
+                if timings:
+                    self.stdout.write(
+                        f"  {stage:<12} mean {timings['mean'] * 1000:8.1f}ms  p50 {timings['p50'] * 1000:8.1f}ms  "
+                        f"p95 {timings['p95'] * 1000:8.1f}ms  max {timings['max'] * 1000:8.1f}ms"
+                    )
+            for name in sorted(calls):
+                self.stdout.write(f"  {name:<32} {calls[name]:6d} calls")
+            self.stdout.write(
+                f"  {'openai.chat.completions':<32} {server.requests - llm_before:6d} calls, "
+                f"{server.prompt_chars - prompt_chars_before} prompt characters, "
+                f"{server.rate_limited - rate_limited_before} rate limited, {server.peak_in_flight} at most at once"
+            )
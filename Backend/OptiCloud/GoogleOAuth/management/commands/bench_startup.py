@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Nothing heavy is imported here: the child processes measure what a worker loads itself
+
+MEASUREMENTS = (
+    ('boot', "Worker boot (wsgi.py)"),
+    ('warmup', "Warm-up"),
+    ('first_request', "First request"),
+    ('second_request', "Second request"),
+    ('first_aws_client', "First AWS client"),
+    ('first_openai_client', "First OpenAI client"),
+    ('process', "Whole process"),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark worker startup: each run is a fresh process that boots the WSGI application, "
+        "serves two requests and builds its first AWS and OpenAI clients, with and without "
+        "OPTICLOUD_WARMUP"
+    )
+    # The system checks would import the URLconf (and with it the views) before we measure
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3, help="Fresh processes per configuration")
+        parser.add_argument('--mongo-uri', help="Use this MongoDB (e.g. a local mongod) instead of mongomock")
+        # Internal: run one measurement in this process and print it as JSON
+        parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+        parser.add_argument('--warmup', action='store_true', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['child']:
+            self.stdout.write(json.dumps(self.measure(options)))
+            return
+
+        self.stdout.write(f"{options['runs']} runs per configuration, "
+                          f"{'MongoDB at ' + options['mongo_uri'] if options['mongo_uri'] else 'mongomock'}")
+        results = {}
+        for warmup in (False, True):
+            results[warmup] = [self.run_child(options, warmup) for _ in range(options['runs'])]
+
+        self.stdout.write(f"\n  {'':<24} {'without warm-up':>16} {'with warm-up':>16}")
+        for key, label in MEASUREMENTS:
+            row = []
+            for warmup in (False, True):
+                values = [run[key] for run in results[warmup] if run.get(key) is not None]
+                row.append(f"{sum(values) / len(values) * 1000:14.1f}ms" if values else f"{'-':>16}")
+            self.stdout.write(f"  {label:<24} {row[0]} {row[1]}")
+
+    def run_child(self, options, warmup):
+        command = [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'bench_startup', '--child']
+        if warmup:
+            command.append('--warmup')
+        if options['mongo_uri']:
+            command += ['--mongo-uri', options['mongo_uri']]
+        started = time.perf_counter()
+        completed = subprocess.run(command, capture_output=True, text=True)
+        elapsed = time.perf_counter() - started
+        if completed.returncode:
+            raise CommandError(f"Startup run failed:\n{completed.stderr}")
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result['process'] = elapsed
+        return result
+
+    def measure(self, options):
+        # Placeholder credentials: nothing here talks to AWS or OpenAI
+        for name, value in (('AWS_ACCESS_KEY_ID', 'bench'), ('AWS_SECRET_ACCESS_KEY', 'bench'),
+                            ('AWS_DEFAULT_REGION', 'us-east-1'), ('OPENAI_API_KEY', 'bench')):
+            os.environ.setdefault(name, value)
+
+        from GoogleOAuth import mongodb
+        if options['mongo_uri']:
+            os.environ['MONGODB_URI'] = options['mongo_uri']
+        else:
+            try:
+                import mongomock
+            except ImportError:
+                raise CommandError("bench_startup needs mongomock or --mongo-uri: pip install mongomock")
+            mongodb._client = mongomock.MongoClient()
+            mongodb._client_pid = os.getpid()
+            settings.OPTICLOUD_DATAPOINT_STORE = 'memory'
+
+        user_id = 'bench-startup-user'
+        mongodb.get_database()['test_collection'].update_one(
+            {'id': user_id},
+            {'$set': {'aws_metrics': {'generated_at': None, 'instances': {}}, 'aws_metrics_version': 1}},
+            upsert=True,
+        )
+
+        # Warm-up is timed on its own below rather than as part of the boot
+        settings.OPTICLOUD_WARMUP = False
+        result = {}
+        started = time.perf_counter()
+        import GoogleOAuth.wsgi  # noqa: F401
+        result['boot'] = time.perf_counter() - started
+
+        if options['warmup']:
+            from GoogleOAuth.warmup import warm_up
+            started = time.perf_counter()
+            warm_up()
+            result['warmup'] = time.perf_counter() - started
+
+        from django.test import Client
+        from django.test.utils import setup_test_environment
+        setup_test_environment()
+        client = Client()
+        for key in ('first_request', 'second_request'):
+            started = time.perf_counter()
+            response = client.get(f'/api/user-metrics/{user_id}/')
+            result[key] = time.perf_counter() - started
+            if response.status_code != 200:
+                raise CommandError(f"GET /api/user-metrics/{user_id}/ returned {response.status_code}")
+
+        # What the first refresh of this worker pays before its first AWS / OpenAI call
+        from GoogleOAuth.aws import preload_service_models
+        from GoogleOAuth.llm import get_client
+        started = time.perf_counter()
+        preload_service_models(('sts',))
+        result['first_aws_client'] = time.perf_counter() - started
+        started = time.perf_counter()
+        get_client()
+        result['first_openai_client'] = time.perf_counter() - started
+        return result
+
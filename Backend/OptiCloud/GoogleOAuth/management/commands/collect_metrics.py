@@ -0,0 +1,46 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from GoogleOAuth.mongodb import ensure_indexes
+from GoogleOAuth.scheduler import RefreshScheduler
+
+
+class Command(BaseCommand):
+    help = "Refresh the metrics of every user with a role ARN on a fixed cadence"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, help="Seconds between refreshes of a user")
+        parser.add_argument('--jitter', type=int, help="Up to this many seconds are added to each interval")
+        parser.add_argument('--concurrency', type=int, help="Refreshes running at the same time")
+        parser.add_argument('--per-account', type=int, help="Refreshes running at the same time per AWS account")
+        parser.add_argument('--once', action='store_true', help="Refresh the users that are due now and exit")
+
+    def handle(self, *args, **options):
+        # The scheduler looks up due users by index; a failure is logged and collection goes on
+        ensure_indexes()
+        scheduler = RefreshScheduler(
+            interval=options['interval'],
+            jitter=options['jitter'],
+            concurrency=options['concurrency'],
+            per_account=options['per_account'],
+        )
+
+        # Finish the refreshes in flight on Ctrl-C / SIGTERM instead of dropping them
+        def shutdown(signum, frame):
+            self.stdout.write("Stopping after the running refreshes finish...")
+            scheduler.stop()
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        def on_finished(user_id, error):
+            if error:
+                self.stderr.write(f"Refresh of {user_id} failed: {error}")
+            else:
+                self.stdout.write(f"Refreshed {user_id}")
+
+        self.stdout.write(
+            f"Collecting metrics every {scheduler.interval}s (+{scheduler.jitter}s jitter), "
+            f"{scheduler.concurrency} at a time, {scheduler.per_account} per account"
+        )
+        scheduler.run(once=options['once'], on_finished=on_finished)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from GoogleOAuth.mongodb import ensure_indexes
+
+
+class Command(BaseCommand):
+    help = "Create the MongoDB indexes and collections the app relies on; run once per deploy"
+
+    def handle(self, *args, **options):
+        if not ensure_indexes():
+            raise CommandError("Some MongoDB indexes or collections could not be created, see the log above")
+        self.stdout.write("MongoDB indexes are in place")
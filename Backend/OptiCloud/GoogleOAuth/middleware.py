@@ -0,0 +1,43 @@
+import re
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli  # optional; without it responses fall back to gzip
+except ImportError:
+    brotli = None
+
+
+re_accepts_brotli = re.compile(r'\bbr\b')
+
+
+class CompressionMiddleware(GZipMiddleware):
+    # Brotli when the client accepts it and the brotli package is installed, gzip otherwise.
+    # Responses below min_length bytes are not worth compressing.
+
+    min_length = 1024
+
+    def process_response(self, request, response):
+        if response.streaming or len(response.content) < self.min_length:
+            return response
+        if response.has_header('Content-Encoding'):
+            return response
+
+        accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if brotli is None or not re_accepts_brotli.search(accept_encoding):
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        compressed_content = brotli.compress(response.content, quality=5)
+        if len(compressed_content) >= len(response.content):
+            return response
+        response.content = compressed_content
+        response.headers['Content-Length'] = str(len(response.content))
+
+        # Same as GZipMiddleware: a strong ETag no longer matches the encoded bytes
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = 'br'
+        return response
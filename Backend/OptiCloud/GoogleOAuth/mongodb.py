@@ -1,35 +1,133 @@
-from pymongo import MongoClient
+import logging
+import os
+import threading
 from urllib.parse import quote_plus
 
+from pymongo import ASCENDING, MongoClient, ReturnDocument
+from pymongo.errors import ConnectionFailure, PyMongoError
 
-def get_database():
-    # Connect to your MongoDB server
+from .instrumentation import MongoCommandListener
+
+logger = logging.getLogger(__name__)
+
+
+db_name = 'OptiCloud_DB'  # specify your database name here
+
+# One client (and connection pool) per worker process, created on first use
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_connection_uri():
+    if os.getenv('MONGODB_URI'):
+        return os.getenv('MONGODB_URI')
     username = 'user1'
     password = quote_plus('user1@OptiCloud')
     cluster_dns = 'cluster0.mg0hq.mongodb.net'
-    db_name = 'OptiCloud_DB'  # specify your database name here
+    return f"mongodb+srv://{username}:{password}@{cluster_dns}/{db_name}?retryWrites=true&w=majority&appName=Cluster0"
 
-    connection_uri = f"mongodb+srv://{username}:{password}@{cluster_dns}/{db_name}?retryWrites=true&w=majority&appName=Cluster0"
 
-    client = MongoClient(connection_uri)
-    db = client[db_name]
-    return db
+def get_client():
+    global _client, _client_pid
+    # A MongoClient is not fork-safe: a worker forked from a process that already
+    # connected (e.g. gunicorn --preload) must build its own pool.
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = MongoClient(
+                    get_connection_uri(),
+                    maxPoolSize=int(os.getenv('MONGODB_MAX_POOL_SIZE', '50')),
+                    minPoolSize=int(os.getenv('MONGODB_MIN_POOL_SIZE', '0')),
+                    maxIdleTimeMS=int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', '300000')),
+                    connect=False,
+                    event_listeners=[MongoCommandListener()],
+                )
+                _client_pid = os.getpid()
+    return _client
+
+
+def get_database():
+    # Connect to your MongoDB server
+    return get_client()[db_name]
+
+
+def create_index(collection, keys, **kwargs):
+    # Each index is created on its own: one that cannot be built (e.g. a unique index
+    # over duplicate legacy users) is logged and doesn't keep the others from being
+    # created. Losing the connection stops the whole run instead of waiting out the
+    # server selection timeout once per index.
+    try:
+        collection.create_index(keys, **kwargs)
+        return True
+    except ConnectionFailure:
+        raise
+    except PyMongoError as e:
+        logger.error("Failed to create MongoDB index %s on %s: %s", kwargs.get('name'), collection.name, e)
+        return False
+
+
+def ensure_indexes():
+    # Run on deploy by `manage.py ensure_indexes` and when the collector starts, never
+    # by web workers; lookups by id and email are on every request path.
+    # Partial filters keep documents without the field out of the unique constraint.
+    # Returns whether every index and collection is in place.
+    db = get_database()
+    collection = db['test_collection']
+    try:
+        created = [
+            create_index(
+                collection, [('id', ASCENDING)], unique=True, name='id_unique',
+                partialFilterExpression={'id': {'$type': 'string'}}
+            ),
+            create_index(
+                collection, [('email', ASCENDING)], unique=True, name='email_unique',
+                partialFilterExpression={'email': {'$type': 'string'}}
+            ),
+            # The scheduled collector looks for users whose next refresh is due
+            create_index(
+                collection, [('metrics_refresh.next_run_at', ASCENDING)], name='refresh_due',
+                partialFilterExpression={'roleArn': {'$type': 'string'}}
+            ),
+            # Refresh job records are only polled for a short while after they finish
+            create_index(
+                db['refresh_jobs'], [('created_at', ASCENDING)], name='created_at_ttl', expireAfterSeconds=86400
+            ),
+            # Leases of refreshes whose process died go away once they expire
+            create_index(
+                db['refresh_leases'], [('lease_until', ASCENDING)], name='lease_until_ttl', expireAfterSeconds=0
+            ),
+            # Cached LLM recommendations expire at their own expires_at
+            create_index(
+                db['llm_recommendations'], [('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0
+            ),
+        ]
+        # Per-instance recommendations behind the fleet endpoint
+        from .fleet import ensure_fleet_indexes
+        created.append(ensure_fleet_indexes(db))
+        # Raw CloudWatch datapoints and their rollups
+        from .timeseries import ensure_timeseries_collections
+        created.append(ensure_timeseries_collections(db))
+    except ConnectionFailure as e:
+        logger.error("Failed to create MongoDB indexes, MongoDB is unavailable: %s", e)
+        return False
+    return all(created)
 
 
 def insert_user_data(user_data):
-    db = get_database()  # Assuming get_database() gives the correct DB connection
+    db = get_database()
     collection = db['test_collection']  # A specific collection for users
-    
-    # Check if the user already exists by a unique field, e.g., 'email'
-    existing_user = collection.find_one({"email": user_data.get("email")})
-    
-    if existing_user:
-        # If the user exists, return the existing user's ObjectId
-        return existing_user["_id"]
-    else:
-        # If the user does not exist, insert the new user data
-        result = collection.insert_one(user_data)
-        return result.inserted_id  # Return the ObjectId of the inserted document
+
+    # Insert the user only if no document with this email exists yet, and return the
+    # ObjectId of the stored user either way, in a single round trip
+    user = collection.find_one_and_update(
+        {"email": user_data.get("email")},
+        {"$setOnInsert": user_data},
+        upsert=True,
+        projection={"_id": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    return user["_id"]
 
 
 # def insert_data():
@@ -0,0 +1,395 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+from django.conf import settings
+from pymongo.errors import PyMongoError
+
+from .aio import get_blocking_executor, run_blocking
+from .aws import assume_customer_role, forget_customer_role
+from .changes import apply_previous_narrations, fully_narrated, mark_narrated, needs_narration
+from .clustering import cluster_documents, fan_out
+from .cloudwatch import METRICS_TO_FETCH
+from .collector import collect_ec2_metrics, notify
+from .fleet import sync_fleet, update_fleet_recommendation
+from .instrumentation import span
+from .llm import agenerate_text_from_gpt, generate_text_from_gpt, max_tokens_for
+from .llm_queue import INTERACTIVE
+from .mongodb import get_database
+from .recommendations import (
+    SCHEMA_VERSION, RecommendationParseError, StreamingRecommendations, answer_templates,
+    assemble_metrics_document, make_template, make_templates, narrate_instance, parse_llm_output, render_template
+)
+from .rightsizing import analyze_instances, render_findings_table
+from .series import MetricSeries
+from .summary import summarize_instances
+from .timeseries import get_datapoint_store, write_instance_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshError(Exception):
+    pass
+
+
+# CloudWatch keeps updating the current period and publishes with a short delay, so
+# collection stops at the last period that has settled
+SETTLE_DELAY = timedelta(minutes=10)
+
+
+def get_collection_window(now=None):
+    now = now or datetime.now(timezone.utc)
+    end_time = (now - SETTLE_DELAY).replace(minute=0, second=0, microsecond=0)
+    start_time = end_time - timedelta(days=1)  # 24 hours before end time
+    return start_time, end_time
+
+
+def collect_metric_window(customer_credentials, start_time, end_time, progress=None):
+    # Only ask CloudWatch for datapoints newer than what was collected on earlier
+    # refreshes, store them, then read the whole window back from the datapoint store.
+    if not getattr(settings, 'OPTICLOUD_INCREMENTAL_COLLECTION', True):
+        instances = collect_ec2_metrics(customer_credentials, start_time, end_time, progress=progress)
+        write_instance_metrics(instances)
+        return instances
+
+    account_id = customer_credentials.get('account_id')
+    store = get_datapoint_store()
+    watermarks = store.get_watermarks(account_id)
+
+    def start_time_for(account, instance_id):
+        marks = [watermarks.get((instance_id, metric_name)) for metric_name in METRICS_TO_FETCH]
+        if any(mark is None for mark in marks):
+            return start_time
+        return max(start_time, min(marks))
+
+    instances = collect_ec2_metrics(
+        customer_credentials, start_time, end_time, start_time_for=start_time_for, progress=progress
+    )
+    unstored = write_instance_metrics(instances, store)
+
+    # Advance the watermarks of every instance that was collected and stored without
+    # errors; the others are fetched again from their old watermark on the next refresh
+    store.set_watermarks(account_id, {
+        (instance['instance_id'], metric_name): end_time
+        for instance in instances if not instance['error'] and instance['instance_id'] not in unstored
+        for metric_name in METRICS_TO_FETCH
+    })
+
+    # The datapoints of instances whose write failed are only in the fetched series, so
+    # those are merged into what the store already had instead of being replaced by it
+    window = store.read_window(account_id, start_time, end_time)
+    for instance in instances:
+        fetched = instance['metrics']
+        metrics = {}
+        for metric_name in METRICS_TO_FETCH:
+            series = window.get((instance['instance_id'], metric_name)) or MetricSeries()
+            if instance['instance_id'] in unstored and fetched.get(metric_name):
+                series, _ = series.merge(fetched[metric_name])
+            metrics[metric_name] = series
+        instance['metrics'] = metrics
+    return instances
+
+
+def prepare_recommendation_input(customer_credentials, progress=None):
+    # Collection and statistics. Returns (instances, summaries), or None when the
+    # account has no instances.
+    start_time, end_time = get_collection_window()
+
+    # Discover instances in every collection region, fetch new datapoints in parallel and
+    # merge them into the stored window
+    with span('pipeline.collect'):
+        instances = collect_metric_window(customer_credentials, start_time, end_time, progress)
+
+    if not instances:
+        logger.info("No EC2 instances found for account %s", customer_credentials.get('account_id'))
+        return None
+
+    # Reduce every hourly series to a few statistics
+    with span('pipeline.summarize'):
+        summaries = summarize_instances(instances)
+    notify(progress, 'metrics_collected', {'count': len(instances)})
+    for instance in instances:
+        notify(progress, 'instance_summary', {
+            'instance_id': instance['instance_id'],
+            'region': instance['region'],
+            'instance_type': instance['instance_type'],
+            'summary': summaries.get(instance['instance_id'], {}),
+        })
+    return instances, summaries
+
+
+def compute_recommendations(instances, summaries, progress=None, previous=None):
+    # The numbers and actions for the dashboard, computed locally: {instance_id: document}.
+    # Instances that have not changed since their stored wording (`previous`, the stored
+    # aws_metrics instances) keep it, so only the others go to the LLM.
+    with span('pipeline.rightsize'):
+        documents = analyze_instances(instances, summaries)
+    with span('pipeline.detect_changes'):
+        documents = apply_previous_narrations(documents, previous)
+    if previous:
+        logger.info("%d of %d instances changed since their last narration",
+                    len(needs_narration(documents)), len(documents))
+    for instance_id, document in documents.items():
+        notify(progress, 'instance_recommendation', {'instance_id': instance_id, 'recommendation': document})
+    return documents
+
+
+def should_narrate(documents):
+    # Nothing to word when no instance has a recommendation without wording
+    return getattr(settings, 'OPTICLOUD_LLM_NARRATION', True) and bool(needs_narration(documents))
+
+
+def should_stream():
+    return getattr(settings, 'OPTICLOUD_LLM_STREAM', True)
+
+
+class RecommendationStream:
+    # Glue between a streamed narration and the rest of the pipeline: every piece of the
+    # answer goes through the incremental parser, and each reworded metric and instance
+    # is announced, for every member of the representative's cluster, as soon as it is
+    # complete. on_instance(instance_id, document) is where partial results get persisted.
+
+    def __init__(self, documents, clusters, progress=None, on_instance=None):
+        self.documents = documents
+        self.clusters = clusters
+        self.parser = StreamingRecommendations(clusters)
+        self.progress = progress
+        self.on_instance = on_instance
+        self.published = set()
+
+    def on_delta(self, text):
+        keep_reading = self.parser.feed(text)
+        metric_events, completed = self.parser.drain()
+        for representative, metric_name, narrated in metric_events:
+            # Same acceptance as for the finished instance: the wording must only quote
+            # the representative's figures, and is rendered with each member's own
+            entry = self.documents[representative]['Optimization_Recommendations'].get(metric_name)
+            template = make_template(narrated['Recommendation'], entry) if entry and narrated['Recommendation'] else None
+            if template is None:
+                continue
+            for instance_id in self.clusters[representative]:
+                entry = self.documents[instance_id]['Optimization_Recommendations'].get(metric_name)
+                text = render_template(template, entry) if entry else None
+                if text is None:
+                    continue
+                notify(self.progress, 'metric_recommendation', {
+                    'instance_id': instance_id, 'metric': metric_name,
+                    'recommendation': dict(entry, Recommendation=text),
+                })
+        for representative in completed:
+            templates = make_templates(self.documents[representative], self.parser.instances[representative])
+            for instance_id in self.clusters[representative]:
+                document, applied = narrate_instance(self.documents[instance_id], templates)
+                if not applied:
+                    continue
+                document = mark_narrated(document, applied)
+                self.published.add(instance_id)
+                notify(self.progress, 'instance_narrated', {'instance_id': instance_id, 'recommendation': document})
+                if self.on_instance:
+                    self.on_instance(instance_id, document)
+        if not keep_reading and self.parser.stop_reason != 'complete':
+            logger.warning("Stopped reading the LLM answer early: %s", self.parser.stop_reason)
+        return keep_reading
+
+
+def finish_narration(response, documents, clusters, progress=None, stream=None):
+    # Everything after the LLM call. The computed recommendations stand on their own, so
+    # a failed or broken narration keeps the draft texts instead of failing the refresh.
+    parsed = None
+    if response is not None:
+        try:
+            with span('pipeline.parse'):
+                parsed = parse_llm_output(response)
+        except RecommendationParseError as e:
+            logger.warning("Invalid narration from the LLM: %s", e)
+    if parsed is None and stream and stream.parser.instances:
+        # A cut-off answer still has every instance that was complete
+        parsed = stream.parser.result()
+    if parsed is None:
+        logger.warning("Keeping the draft recommendation texts")
+        return assemble_metrics_document(documents)
+
+    # The representatives' wordings, rendered with every member's own figures; instances
+    # none of whose wordings were accepted keep their drafts and stay to be narrated
+    narrated = dict(documents)
+    for instance_id, templates in fan_out(answer_templates(documents, parsed), clusters).items():
+        document, applied = narrate_instance(documents[instance_id], templates)
+        if applied:
+            narrated[instance_id] = mark_narrated(document, applied)
+    published = stream.published if stream else set()
+    for instance_id, document in narrated.items():
+        if instance_id not in published and document is not documents[instance_id]:
+            notify(progress, 'instance_narrated', {'instance_id': instance_id, 'recommendation': document})
+    notify(progress, 'narration_ready', {'count': len(narrated)})
+    return assemble_metrics_document(narrated, narrated=fully_narrated(narrated))
+
+
+def plan_narration(documents):
+    # Only instances without wording, and of those only one representative per cluster of
+    # similar instances, go to the LLM, so the prompt grows with the number of distinct
+    # changed behaviours rather than instances. Returns (clusters, findings table, max_tokens).
+    pending = needs_narration(documents)
+    with span('pipeline.cluster'):
+        clusters = cluster_documents(pending)
+    findings = render_findings_table({representative: documents[representative] for representative in clusters})
+    logger.info("Narrating %d representatives for %d instances", len(clusters), len(pending))
+    logger.debug("Findings table:\n%s", findings)
+    return clusters, findings, max_tokens_for(len(clusters))
+
+
+def narrate_recommendations(documents, progress=None, on_instance=None, tenant=None, priority=INTERACTIVE):
+    # Ask the LLM to word the computed recommendations; tenant and priority place the
+    # call in the LLM dispatch queue
+    clusters, findings, max_tokens = plan_narration(documents)
+    if not should_stream():
+        response = generate_text_from_gpt(findings, max_tokens=max_tokens, tenant=tenant, priority=priority)
+        return finish_narration(response, documents, clusters, progress)
+
+    stream = RecommendationStream(documents, clusters, progress, on_instance)
+    response = generate_text_from_gpt(
+        findings, on_delta=stream.on_delta, max_tokens=max_tokens, tenant=tenant, priority=priority
+    )
+    return finish_narration(response, documents, clusters, progress, stream)
+
+
+# Use the instance IDs to get CloudWatch metrics. on_computed(document) gets the
+# recommendations before they are narrated, so the numbers are stored before
+# recommendations_ready without waiting for the LLM. `previous` is the stored
+# aws_metrics instances, whose wording is reused where nothing changed. The LLM call is
+# queued as the customer's account with `priority`.
+def get_ec2_metrics_for_all_instances(customer_credentials, progress=None, on_instance=None, on_computed=None,
+                                      previous=None, priority=INTERACTIVE):
+    prepared = prepare_recommendation_input(customer_credentials, progress)
+    if prepared is None:
+        return
+    documents = compute_recommendations(*prepared, progress, previous)
+    narrate = should_narrate(documents)
+    if narrate and on_computed:
+        on_computed(assemble_metrics_document(documents))
+    notify(progress, 'recommendations_ready', {'count': len(documents)})
+    if not narrate:
+        return assemble_metrics_document(documents, narrated=fully_narrated(documents))
+    return narrate_recommendations(
+        documents, progress, on_instance, customer_credentials.get('account_id'), priority
+    )
+
+
+def get_customer_credentials(role_arn, fresh_credentials=False, progress=None):
+    if fresh_credentials:
+        # The customer may have just updated the role, so don't reuse cached credentials
+        forget_customer_role(role_arn)
+
+    customer_credentials = assume_customer_role(role_arn)
+    if not customer_credentials:
+        raise RefreshError("Could not assume role, please check the role ARN and permissions.")
+    notify(progress, 'role_assumed', {'account_id': customer_credentials.get('account_id')})
+    return customer_credentials
+
+
+def load_previous_instances(user_id):
+    # The per-instance documents of the user's last refresh, {} when there are none or
+    # they are in an older schema
+    try:
+        user = get_database()['test_collection'].find_one(
+            {"id": user_id}, {"aws_metrics.schema_version": 1, "aws_metrics.instances": 1}
+        )
+    except PyMongoError as e:
+        logger.warning("Failed to load the previous recommendations of %s: %s", user_id, e)
+        return {}
+    aws_metrics = (user or {}).get('aws_metrics') or {}
+    if aws_metrics.get('schema_version') != SCHEMA_VERSION:
+        return {}
+    return aws_metrics.get('instances') or {}
+
+
+def store_partial_recommendation(user_id, instance_id, document):
+    # Make each instance's recommendation readable while the rest is still being
+    # generated; the final write replaces the whole document
+    try:
+        get_database()['test_collection'].update_one(
+            {"id": user_id},
+            {
+                "$set": {f"aws_metrics.instances.{instance_id}": document,
+                         "aws_metrics_updated_at": datetime.now(timezone.utc)},
+                "$inc": {"aws_metrics_version": 1},
+            }
+        )
+        update_fleet_recommendation(user_id, instance_id, document)
+    except PyMongoError as e:
+        logger.warning("Failed to store the partial recommendation for %s: %s", instance_id, e)
+
+
+def store_user_metrics(user_id, ec2_metrics):
+    collection = get_database()['test_collection']
+    # The version and the update time drive the ETag and Last-Modified of the cacheable
+    # metrics endpoint; both change on every write, partial ones included
+    collection.update_one(
+        {"id": user_id},
+        {"$set": {"aws_metrics": ec2_metrics, "aws_metrics_updated_at": datetime.now(timezone.utc)},
+         "$inc": {"aws_metrics_version": 1}}
+    )
+    sync_fleet(user_id, ec2_metrics)
+
+
+# The whole refresh pipeline: STS -> EC2/CloudWatch -> rightsizing -> MongoDB, then the
+# OpenAI narration -> MongoDB. Runs on the job worker pool, never on a request thread.
+def refresh_metrics(role_arn, user_id=None, fresh_credentials=False, progress=None, priority=INTERACTIVE):
+    with span('pipeline.refresh'):
+        customer_credentials = get_customer_credentials(role_arn, fresh_credentials, progress)
+        on_instance = partial(store_partial_recommendation, user_id) if user_id else None
+        on_computed = partial(store_user_metrics, user_id) if user_id else None
+        previous = load_previous_instances(user_id) if user_id else None
+        ec2_metrics = get_ec2_metrics_for_all_instances(
+            customer_credentials, progress, on_instance, on_computed, previous, priority
+        )
+        if user_id:
+            store_user_metrics(user_id, ec2_metrics)
+    return ec2_metrics
+
+
+# Same pipeline for the event loop: the AWS and MongoDB stages run on the bounded
+# blocking pool and the OpenAI call is awaited natively, so a refresh only holds a
+# thread while it is actually talking to AWS or MongoDB.
+async def arefresh_metrics(role_arn, user_id=None, fresh_credentials=False, progress=None, priority=INTERACTIVE):
+    with span('pipeline.refresh'):
+        customer_credentials = await run_blocking(get_customer_credentials, role_arn, fresh_credentials, progress)
+        prepared = await run_blocking(prepare_recommendation_input, customer_credentials, progress)
+        ec2_metrics = None
+        if prepared is not None:
+            previous = await run_blocking(load_previous_instances, user_id) if user_id else None
+            documents = compute_recommendations(*prepared, progress, previous)
+            narrate = should_narrate(documents)
+            if narrate and user_id:
+                await run_blocking(store_user_metrics, user_id, assemble_metrics_document(documents))
+            notify(progress, 'recommendations_ready', {'count': len(documents)})
+            if narrate:
+                ec2_metrics = await anarrate_recommendations(
+                    documents, user_id, progress, customer_credentials.get('account_id'), priority
+                )
+            else:
+                ec2_metrics = assemble_metrics_document(documents, narrated=fully_narrated(documents))
+        if user_id:
+            await run_blocking(store_user_metrics, user_id, ec2_metrics)
+    return ec2_metrics
+
+
+async def anarrate_recommendations(documents, user_id=None, progress=None, tenant=None, priority=INTERACTIVE):
+    clusters, findings, max_tokens = plan_narration(documents)
+    if not should_stream():
+        response = await agenerate_text_from_gpt(findings, max_tokens=max_tokens, tenant=tenant, priority=priority)
+        return finish_narration(response, documents, clusters, progress)
+
+    # Partial results are written from the blocking pool while the stream goes on
+    loop = asyncio.get_running_loop()
+    pending_writes = []
+
+    def on_instance(instance_id, document):
+        pending_writes.append(loop.run_in_executor(
+            get_blocking_executor(), store_partial_recommendation, user_id, instance_id, document
+        ))
+
+    stream = RecommendationStream(documents, clusters, progress, on_instance if user_id else None)
+    response = await agenerate_text_from_gpt(findings, stream.on_delta, max_tokens, tenant, priority)
+    await asyncio.gather(*pending_writes)
+    return finish_narration(response, documents, clusters, progress, stream)
@@ -0,0 +1,358 @@
+import ast
+import json
+import re
+from datetime import datetime, timezone
+
+
+# Stored aws_metrics document, written once per refresh and read with projections:
+#
+# {
+#   'schema_version': 2,
+#   'generated_at': datetime,
+#   'narrated': bool,
+#   'Optimization_Recommendations': {<metric>: {'Recommendation': str,
+#                                               'Current_Usage': float,
+#                                               'Optimized_Usage': float}},
+#   'Carbon_Footprint_Reduction': {'Reduction_Percentage': float},
+#   'instances': {
+#     <instance id>: {'region': str, 'instance_type': str,
+#                     'Optimization_Recommendations': {...same as above...},
+#                     'Carbon_Footprint_Reduction': {...same as above...},
+#                     'Rightsizing': {'action': str, 'target_type': str or None,
+#                                     'scheduled_fraction': float, 'cpu_p95': float or None},
+#                     'Narration': {'profile': [float], 'prompt_version': int,
+#                                   'generated_at': datetime,
+#                                   'templates': {<metric>: {'text': str, 'shape': str}}}}
+#   }
+# }
+#
+# The numbers and actions come from rightsizing.py; 'narrated' says whether the
+# Recommendation texts were reworded by the LLM, and 'Narration' is only present on
+# instances whose texts were (see changes.py). Its templates are those texts with
+# placeholders for the figures (make_template), so they can be rendered for new ones.
+# The top-level Optimization_Recommendations / Carbon_Footprint_Reduction summarize the
+# whole fleet and keep the shape the dashboard already reads. Next to it on the user
+# document, aws_metrics_version and aws_metrics_updated_at change on every write,
+# including the per-instance writes made while a refresh is narrating.
+SCHEMA_VERSION = 2
+
+RECOMMENDATION_METRICS = ['CPU_Utilization', 'Disk_IO', 'Network_Usage', 'Instance_Health']
+
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+# Numbers as they appear in texts, thousands separators included; digits that are part
+# of a word (m5.large, 2xlarge, 95th) are not figures
+_FIGURE = re.compile(r'(?<![\w.])\d+(?:,\d{3})*(?:\.\d+)?(?!\w)')
+_FIELD_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class RecommendationParseError(ValueError):
+    pass
+
+
+def is_valid_field_name(name):
+    # Instance ids and metric names end up in projection paths, so no dots or dollars
+    return bool(name) and bool(_FIELD_NAME.match(name))
+
+
+def parse_llm_output(text):
+    # The prompt asks for JSON but models regularly answer with code fences or
+    # single-quoted Python literals, so accept both.
+    if not text:
+        raise RecommendationParseError("Empty LLM response")
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end <= start:
+        raise RecommendationParseError("No JSON object in LLM response")
+    body = text[start:end + 1]
+    try:
+        return json.loads(body)
+    except json.JSONDecodeError:
+        pass
+    try:
+        value = ast.literal_eval(body)
+    except (ValueError, SyntaxError) as e:
+        raise RecommendationParseError(f"Could not parse LLM response: {e}")
+    if not isinstance(value, dict):
+        raise RecommendationParseError("LLM response is not an object")
+    return value
+
+
+def _to_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = _NUMBER.search(value.replace(',', ''))
+        if match:
+            return float(match.group())
+    return None
+
+
+def validate_recommendation(raw):
+    # Keep only the known metrics and coerce usages to numbers
+    raw = raw if isinstance(raw, dict) else {}
+    metrics = raw.get('Optimization_Recommendations')
+    metrics = metrics if isinstance(metrics, dict) else {}
+
+    recommendations = {}
+    for metric_name in RECOMMENDATION_METRICS:
+        entry = metrics.get(metric_name)
+        if not isinstance(entry, dict):
+            continue
+        recommendations[metric_name] = {
+            'Recommendation': str(entry.get('Recommendation') or '').strip(),
+            'Current_Usage': _to_number(entry.get('Current_Usage')) or 0.0,
+            'Optimized_Usage': _to_number(entry.get('Optimized_Usage')) or 0.0,
+        }
+
+    reduction = raw.get('Carbon_Footprint_Reduction')
+    reduction = reduction if isinstance(reduction, dict) else {}
+    return {
+        'Optimization_Recommendations': recommendations,
+        'Carbon_Footprint_Reduction': {
+            'Reduction_Percentage': _to_number(reduction.get('Reduction_Percentage')) or 0.0
+        }
+    }
+
+
+def summarize_fleet(instance_documents):
+    # Fleet-wide view for the dashboard: average usages per metric, the recommendation of
+    # the instance with the largest possible reduction, and the average carbon reduction.
+    fleet = {}
+    for metric_name in RECOMMENDATION_METRICS:
+        entries = [
+            document['Optimization_Recommendations'][metric_name]
+            for document in instance_documents
+            if metric_name in document['Optimization_Recommendations']
+        ]
+        if not entries:
+            continue
+        top = max(entries, key=lambda entry: entry['Current_Usage'] - entry['Optimized_Usage'])
+        fleet[metric_name] = {
+            'Recommendation': top['Recommendation'],
+            'Current_Usage': round(sum(entry['Current_Usage'] for entry in entries) / len(entries), 2),
+            'Optimized_Usage': round(sum(entry['Optimized_Usage'] for entry in entries) / len(entries), 2),
+        }
+
+    reductions = [document['Carbon_Footprint_Reduction']['Reduction_Percentage'] for document in instance_documents]
+    return {
+        'Optimization_Recommendations': fleet,
+        'Carbon_Footprint_Reduction': {
+            'Reduction_Percentage': round(sum(reductions) / len(reductions), 2) if reductions else 0.0
+        }
+    }
+
+
+def _figures(entry):
+    # (value, decimals) of the figures an entry's wording may quote: the numbers of its
+    # draft Recommendation (which renders its figures) in order, then its usages
+    figures = []
+    for match in _FIGURE.findall(entry['Recommendation']):
+        figures.append((float(match.replace(',', '')), len(match.partition('.')[2])))
+    figures += [(abs(entry['Current_Usage']), None), (abs(entry['Optimized_Usage']), None)]
+    return figures
+
+
+def draft_shape(entry):
+    # An entry's draft with its numbers blanked out; drafts of the same shape list the
+    # same figures in the same order, so a wording template fits all of them
+    return _FIGURE.sub('#', entry['Recommendation'])
+
+
+def make_template(text, entry):
+    # The wording `text` of a computed entry with every number it quotes replaced by a
+    # placeholder for that figure, at the precision the text gives it, so it can be
+    # rendered again for other figures:
+    #   {'text': 'Averaging {0:.0f}% CPU, ...', 'shape': draft_shape(entry)}
+    # None when the text quotes a number that is not one of the entry's figures ("CPU
+    # averaged 12.3%" for an entry at 12.7, or an invented one).
+    figures = _figures(entry)
+    parts = []
+    position = 0
+    for match in _FIGURE.finditer(text):
+        value = float(match.group().replace(',', ''))
+        decimals = len(match.group().partition('.')[2])
+        candidates = [
+            index for index, (figure, _) in enumerate(figures) if abs(round(figure, decimals) - value) < 1e-9
+        ]
+        if not candidates:
+            return None
+        # A figure written just like that in the draft ("24 hours") before a rounded one
+        exact = [index for index in candidates if figures[index][1] == decimals]
+        parts.append(text[position:match.start()].replace('{', '{{').replace('}', '}}'))
+        separator = ',' if ',' in match.group() else ''
+        parts.append(f"{{{(exact or candidates)[0]}:{separator}.{decimals}f}}")
+        position = match.end()
+    parts.append(text[position:].replace('{', '{{').replace('}', '}}'))
+    return {'text': ''.join(parts), 'shape': draft_shape(entry)}
+
+
+def render_template(template, entry):
+    # A template's wording with the figures of `entry`; None when the entry's draft is
+    # shaped differently from the one the template was made from (other units or clauses)
+    if draft_shape(entry) != template['shape']:
+        return None
+    return template['text'].format(*[value for value, _ in _figures(entry)])
+
+
+def make_templates(document, raw):
+    # {metric: template} of the LLM's wording of one computed per-instance document,
+    # for every metric whose wording only quotes the document's own figures
+    worded = validate_recommendation(raw)['Optimization_Recommendations']
+    templates = {}
+    for metric_name, entry in document['Optimization_Recommendations'].items():
+        text = worded.get(metric_name, {}).get('Recommendation')
+        template = make_template(text, entry) if text else None
+        if template:
+            templates[metric_name] = template
+    return templates
+
+
+def answer_templates(documents, parsed):
+    # {instance_id: {metric: template}} of a parsed narration answer
+    # ({'Instances': {id: {...}}}) for the instances of `documents` it covers
+    per_instance = parsed.get('Instances') if isinstance(parsed, dict) else None
+    if not isinstance(per_instance, dict):
+        return {}
+    return {
+        instance_id: make_templates(documents[instance_id], raw)
+        for instance_id, raw in per_instance.items() if instance_id in documents
+    }
+
+
+def narrate_instance(document, templates):
+    # (copy of a computed per-instance document with each metric's wording rendered for
+    # its own figures, {metric: template} of the wordings that were applied). Numbers
+    # always stay the computed ones; a metric without a fitting template keeps its draft.
+    recommendations = {}
+    applied = {}
+    for metric_name, entry in document['Optimization_Recommendations'].items():
+        template = templates.get(metric_name)
+        text = render_template(template, entry) if template else None
+        if text:
+            recommendations[metric_name] = dict(entry, Recommendation=text)
+            applied[metric_name] = template
+        else:
+            recommendations[metric_name] = entry
+    return dict(document, Optimization_Recommendations=recommendations), applied
+
+
+def assemble_metrics_document(documents, narrated=False):
+    # The stored aws_metrics document for {instance_id: per-instance document}
+    documents = {instance_id: document for instance_id, document in documents.items() if is_valid_field_name(instance_id)}
+    fleet = summarize_fleet(list(documents.values()))
+    return {
+        'schema_version': SCHEMA_VERSION,
+        'generated_at': datetime.now(timezone.utc),
+        'narrated': narrated,
+        'Optimization_Recommendations': fleet['Optimization_Recommendations'],
+        'Carbon_Footprint_Reduction': fleet['Carbon_Footprint_Reduction'],
+        'instances': documents,
+    }
+
+
+class IncrementalObjectParser:
+    # Scans JSON text as it arrives and reports every object as soon as its closing brace
+    # has been seen, together with the keys leading to it, e.g.
+    #   ('Instances', 'i-0abc', 'Optimization_Recommendations', 'CPU_Utilization')
+    # Text before the first '{' (code fences, prose) is skipped and scanning stops once
+    # the top-level object is closed.
+
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.stack = []  # (key, start offset) per open object or array
+        self.key = None
+        self.last_string = None
+        self.string_start = None
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+
+    def feed(self, text):
+        self.buffer += text
+        completed = []
+        buffer = self.buffer
+        while self.position < len(buffer) and not self.done:
+            char = buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    self.last_string = buffer[self.string_start:self.position + 1]
+            elif not self.stack:
+                if char == '{':
+                    self.stack.append((None, self.position))
+            elif char == '"':
+                self.in_string = True
+                self.string_start = self.position
+            elif char == ':':
+                try:
+                    self.key = json.loads(self.last_string)
+                except (TypeError, json.JSONDecodeError):
+                    self.key = None
+            elif char == ',':
+                self.key = None
+            elif char in '{[':
+                self.stack.append((self.key, self.position))
+                self.key = None
+            elif char in '}]':
+                key, start = self.stack.pop()
+                self.key = None
+                if char == '}':
+                    path = tuple(parent_key for parent_key, _ in self.stack[1:])
+                    if self.stack:
+                        path += (key,)
+                    completed.append((path, buffer[start:self.position + 1]))
+                if not self.stack:
+                    self.done = True
+            self.position += 1
+        return completed
+
+
+class StreamingRecommendations:
+    # Consumes a streamed LLM answer and collects each instance's recommendation as soon
+    # as it is complete. feed() returns False once reading further is pointless: the
+    # answer is complete, or the model has started repeating or inventing instances.
+
+    def __init__(self, instance_ids):
+        self.expected = set(instance_ids)
+        self.parser = IncrementalObjectParser()
+        self.instances = {}  # instance id -> raw recommendation
+        self.metric_events = []  # (instance id, metric, validated entry) not yet handed out
+        self.completed = []  # instance ids not yet handed out
+        self.stop_reason = None
+
+    def feed(self, text):
+        for path, raw in self.parser.feed(text):
+            try:
+                value = json.loads(raw)
+            except json.JSONDecodeError:
+                continue  # not JSON; the full answer is still parsed at the end
+            if len(path) == 4 and path[0] == 'Instances' and path[2] == 'Optimization_Recommendations':
+                if path[1] in self.expected and path[3] in RECOMMENDATION_METRICS:
+                    entry = validate_recommendation({'Optimization_Recommendations': {path[3]: value}})
+                    self.metric_events.append((path[1], path[3], entry['Optimization_Recommendations'][path[3]]))
+            elif len(path) == 2 and path[0] == 'Instances':
+                instance_id = path[1]
+                if instance_id not in self.expected or instance_id in self.instances:
+                    self.stop_reason = f"unexpected instance {instance_id!r} in the answer"
+                    return False
+                self.instances[instance_id] = value
+                self.completed.append(instance_id)
+        if self.parser.done:
+            self.stop_reason = self.stop_reason or 'complete'
+            return False
+        return True
+
+    def drain(self):
+        metric_events, completed = self.metric_events, self.completed
+        self.metric_events, self.completed = [], []
+        return metric_events, completed
+
+    def result(self):
+        return {'Instances': dict(self.instances)}
@@ -0,0 +1,307 @@
+from django.conf import settings
+
+
+# Local rightsizing: turns the per-metric statistics from summary.py into the numbers the
+# dashboard shows (Current_Usage, Optimized_Usage, Reduction_Percentage), a suggested
+# action and a one-line recommendation per metric. Deterministic and fast; the LLM is
+# only asked to word the recommendations (see llm.py).
+#
+# CloudWatch has no memory metrics without the agent, so downsizing stays within the
+# instance family and goes at most MAX_DOWNSIZE_STEPS sizes down.
+
+SIZES = ['nano', 'micro', 'small', 'medium', 'large', 'xlarge', '2xlarge', '4xlarge',
+         '8xlarge', '12xlarge', '16xlarge', '24xlarge']
+
+# AWS size normalization factors, used as a proxy for an instance's footprint
+NORMALIZATION_UNITS = {
+    'nano': 0.25, 'micro': 0.5, 'small': 1, 'medium': 2, 'large': 4, 'xlarge': 8,
+    '2xlarge': 16, '4xlarge': 32, '8xlarge': 64, '12xlarge': 96, '16xlarge': 128, '24xlarge': 192,
+}
+
+# Burstable sizes: (vCPUs, memory GiB, baseline CPU per vCPU)
+BURSTABLE_SIZES = {
+    'nano': (2, 0.5, 0.05), 'micro': (2, 1, 0.10), 'small': (2, 2, 0.20), 'medium': (2, 4, 0.20),
+    'large': (2, 8, 0.30), 'xlarge': (4, 16, 0.40), '2xlarge': (8, 32, 0.40),
+}
+BURSTABLE_FAMILIES = ['t2', 't3', 't3a', 't4g']
+
+# Fixed-performance families by memory per vCPU; large is 2 vCPUs and each size up doubles
+FIXED_FAMILIES = {
+    2: ['c5', 'c5a', 'c6i', 'c6a', 'c6g', 'c7i', 'c7g'],
+    4: ['m5', 'm5a', 'm6i', 'm6a', 'm6g', 'm7i', 'm7g'],
+    8: ['r5', 'r5a', 'r6i', 'r6a', 'r6g', 'r7i', 'r7g'],
+}
+FIXED_VCPUS = {
+    'large': 2, 'xlarge': 4, '2xlarge': 8, '4xlarge': 16, '8xlarge': 32, '12xlarge': 48,
+    '16xlarge': 64, '24xlarge': 96,
+}
+
+
+def _build_catalog():
+    catalog = {}
+    for family in BURSTABLE_FAMILIES:
+        for size, (vcpus, memory, baseline) in BURSTABLE_SIZES.items():
+            catalog[f"{family}.{size}"] = {
+                'family': family, 'size': size, 'vcpus': vcpus, 'memory': memory, 'baseline': baseline,
+            }
+    for memory_per_vcpu, families in FIXED_FAMILIES.items():
+        for family in families:
+            for size, vcpus in FIXED_VCPUS.items():
+                catalog[f"{family}.{size}"] = {
+                    'family': family, 'size': size, 'vcpus': vcpus, 'memory': vcpus * memory_per_vcpu,
+                    'baseline': 1.0,
+                }
+    return catalog
+
+
+CATALOG = _build_catalog()
+
+# An instance is idle when nearly every hour is idle for CPU and network
+IDLE_INSTANCE_FRACTION = 0.95
+IDLE_PEAK_CPU = 5.0
+# Instances idle for at least this share of the window are worth scheduling
+SCHEDULE_FRACTION = 0.3
+# Sustained peaks above this call for a bigger instance
+UPSIZE_PEAK_CPU = 90.0
+MAX_DOWNSIZE_STEPS = 2
+
+ACTIONS = ['stop', 'downsize', 'upsize', 'schedule', 'keep']
+
+
+def get_instance_type(instance_type):
+    return CATALOG.get(instance_type or '')
+
+
+def _units(instance_type):
+    return NORMALIZATION_UNITS[CATALOG[instance_type]['size']]
+
+
+def units_saved(document):
+    # Size units freed by the recommendation, so savings compare across instance sizes
+    if not get_instance_type(document.get('instance_type')):
+        return None
+    return round(_units(document['instance_type']) * document['Carbon_Footprint_Reduction']['Reduction_Percentage'] / 100, 4)
+
+
+def _fits(candidate, peak_vcpus, mean_vcpus, target):
+    if candidate['vcpus'] * target < peak_vcpus:
+        return False
+    # A burstable instance has to sustain the average load on its baseline
+    return candidate['baseline'] >= 1.0 or candidate['vcpus'] * candidate['baseline'] >= mean_vcpus
+
+
+def find_target_type(instance_type, cpu_mean, cpu_p95, target_cpu=None):
+    # Smallest instance of the same family that keeps the 95th percentile CPU under the
+    # target utilization, or the next size up when the current one runs too hot. None
+    # when the type is unknown or already right.
+    current = get_instance_type(instance_type)
+    if current is None or cpu_p95 is None:
+        return None
+    if target_cpu is None:
+        target_cpu = getattr(settings, 'OPTICLOUD_RIGHTSIZING_TARGET_CPU', 60.0)
+    target = target_cpu / 100
+    peak_vcpus = current['vcpus'] * cpu_p95 / 100
+    mean_vcpus = current['vcpus'] * (cpu_mean or 0.0) / 100
+
+    family_sizes = [size for size in SIZES if f"{current['family']}.{size}" in CATALOG]
+    index = family_sizes.index(current['size'])
+
+    if cpu_p95 >= UPSIZE_PEAK_CPU:
+        return f"{current['family']}.{family_sizes[index + 1]}" if index + 1 < len(family_sizes) else None
+
+    chosen = None
+    for size in reversed(family_sizes[max(index - MAX_DOWNSIZE_STEPS, 0):index]):
+        candidate = CATALOG[f"{current['family']}.{size}"]
+        if not _fits(candidate, peak_vcpus, mean_vcpus, target):
+            break
+        chosen = f"{current['family']}.{size}"
+    return chosen
+
+
+def _value(summaries, metric_name, statistic):
+    summary = summaries.get(metric_name)
+    return summary.get(statistic) if summary and summary['points'] else None
+
+
+def _total(summaries, metric_names, statistic):
+    values = [_value(summaries, metric_name, statistic) for metric_name in metric_names]
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+
+def _idle(summaries, metric_names):
+    # Idle fraction of the busiest of the given metrics; None when none has data
+    fractions = [summaries.get(name, {}).get('idle_fraction') for name in metric_names]
+    fractions = [fraction for fraction in fractions if fraction is not None]
+    return min(fractions) if fractions else None
+
+
+def _round(value):
+    return round(value or 0.0, 2)
+
+
+def _format_bytes(value):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(value) < 1024:
+            return f"{value:.0f} {unit}"
+        value /= 1024
+    return f"{value:.0f} TB"
+
+
+def analyze_instance(instance, summaries, target_cpu=None):
+    # Rightsizing for one collector instance record and its {metric: summary} statistics,
+    # in the shape of a stored per-instance recommendation (see recommendations.py)
+    instance_type = instance.get('instance_type')
+    document = {
+        'region': instance.get('region'),
+        'instance_type': instance_type,
+        'Optimization_Recommendations': {},
+        'Carbon_Footprint_Reduction': {'Reduction_Percentage': 0.0},
+        'Rightsizing': {'action': 'keep', 'target_type': None, 'scheduled_fraction': 0.0, 'cpu_p95': None},
+    }
+    if instance.get('error'):
+        return document
+
+    cpu_mean = _value(summaries, 'CPUUtilization', 'mean')
+    cpu_p95 = _value(summaries, 'CPUUtilization', 'p95')
+    cpu_idle = _idle(summaries, ['CPUUtilization'])
+    network_idle = _idle(summaries, ['NetworkIn', 'NetworkOut'])
+
+    idle = (
+        cpu_idle is not None and cpu_idle >= IDLE_INSTANCE_FRACTION and (cpu_p95 or 0.0) <= IDLE_PEAK_CPU
+        and (network_idle is None or network_idle >= IDLE_INSTANCE_FRACTION)
+    )
+    target_type = None if idle else find_target_type(instance_type, cpu_mean, cpu_p95, target_cpu)
+    scheduled = cpu_idle if not idle and cpu_idle is not None and cpu_idle >= SCHEDULE_FRACTION else 0.0
+
+    if idle:
+        action = 'stop'
+    elif target_type and cpu_p95 >= UPSIZE_PEAK_CPU:
+        action = 'upsize'
+    elif target_type:
+        action = 'downsize'
+    elif scheduled:
+        action = 'schedule'
+    else:
+        action = 'keep'
+
+    # Footprint after the change relative to now, from size units and hours running
+    if action == 'stop':
+        remaining = 0.0
+    else:
+        remaining = 1.0 - scheduled
+        if action == 'downsize':
+            remaining *= _units(target_type) / _units(instance_type)
+    reduction = max(0.0, 1.0 - remaining) * 100
+
+    recommendations = document['Optimization_Recommendations']
+    if cpu_mean is not None:
+        recommendations['CPU_Utilization'] = _cpu_recommendation(
+            action, instance_type, target_type, cpu_mean, cpu_p95, scheduled
+        )
+    disk = _disk_recommendation(action, summaries)
+    if disk:
+        recommendations['Disk_IO'] = disk
+    network = _network_recommendation(action, summaries)
+    if network:
+        recommendations['Network_Usage'] = network
+    health = _health_recommendation(summaries)
+    if health:
+        recommendations['Instance_Health'] = health
+
+    document['Carbon_Footprint_Reduction']['Reduction_Percentage'] = _round(reduction)
+    document['Rightsizing'] = {
+        'action': action, 'target_type': target_type, 'scheduled_fraction': _round(scheduled),
+        'cpu_p95': None if cpu_p95 is None else _round(cpu_p95),
+    }
+    return document
+
+
+def _cpu_recommendation(action, instance_type, target_type, cpu_mean, cpu_p95, scheduled):
+    if action == 'stop':
+        text = (f"CPU averaged {cpu_mean:.1f}% and never went above {cpu_p95:.1f}% in the last 24 hours; "
+                f"stop or terminate the instance if it is no longer needed.")
+        optimized = 0.0
+    elif action in ('downsize', 'upsize'):
+        ratio = CATALOG[instance_type]['vcpus'] / CATALOG[target_type]['vcpus']
+        text = (f"CPU averaged {cpu_mean:.1f}% with a 95th percentile of {cpu_p95:.1f}%; "
+                f"{action} from {instance_type} to {target_type}.")
+        if scheduled:
+            text += f" It was idle {scheduled:.0%} of the time, so also schedule it to stop outside working hours."
+        optimized = min(cpu_mean * ratio, 100.0)
+    elif action == 'schedule':
+        text = (f"CPU was idle {scheduled:.0%} of the time; schedule the instance to stop "
+                f"outside working hours.")
+        optimized = cpu_mean
+    else:
+        text = f"CPU averaged {cpu_mean:.1f}% with a 95th percentile of {cpu_p95:.1f}%; the instance size fits the load."
+        optimized = cpu_mean
+    return {'Recommendation': text, 'Current_Usage': _round(cpu_mean), 'Optimized_Usage': _round(optimized)}
+
+
+def _disk_recommendation(action, summaries):
+    current = _total(summaries, ['DiskReadOps', 'DiskWriteOps'], 'hourly_sum')
+    if current is None:
+        return None
+    idle = _idle(summaries, ['DiskReadOps', 'DiskWriteOps'])
+    if action == 'stop':
+        text = "Snapshot and delete the attached volumes once the instance is stopped."
+    elif idle is not None and idle >= IDLE_INSTANCE_FRACTION:
+        text = "No disk activity in the last 24 hours; check for unused EBS volumes."
+    else:
+        text = f"Disk activity averaged {current:.0f} operations per hour; no change needed."
+    return {
+        'Recommendation': text,
+        'Current_Usage': _round(current),
+        'Optimized_Usage': 0.0 if action == 'stop' else _round(current),
+    }
+
+
+def _network_recommendation(action, summaries):
+    current = _total(summaries, ['NetworkIn', 'NetworkOut'], 'hourly_sum')
+    if current is None:
+        return None
+    if action == 'stop':
+        text = f"Network traffic averaged {_format_bytes(current)} per hour; nothing depends on this instance."
+    else:
+        text = f"Network traffic averaged {_format_bytes(current)} per hour; no change needed."
+    return {
+        'Recommendation': text,
+        'Current_Usage': _round(current),
+        'Optimized_Usage': 0.0 if action == 'stop' else _round(current),
+    }
+
+
+def _health_recommendation(summaries):
+    failed = _value(summaries, 'StatusCheckFailed', 'mean')
+    if failed is None:
+        return None
+    passing = max(0.0, 1.0 - failed) * 100
+    if passing >= 100:
+        text = "All status checks passed in the last 24 hours."
+    else:
+        text = f"Status checks failed in {100 - passing:.0f}% of the last 24 hours; investigate or replace the instance."
+    return {'Recommendation': text, 'Current_Usage': _round(passing), 'Optimized_Usage': 100.0}
+
+
+def analyze_instances(instances, summaries, target_cpu=None):
+    # {instance_id: document} for every collector instance record
+    return {
+        instance['instance_id']: analyze_instance(instance, summaries.get(instance['instance_id'], {}), target_cpu)
+        for instance in instances
+    }
+
+
+def render_findings_table(documents):
+    # Compact pipe-separated table for the narration prompt: one row per instance and
+    # metric with the computed numbers and the draft recommendation
+    lines = ["instance|type|action|target_type|metric|current|optimized|draft"]
+    for instance_id, document in documents.items():
+        rightsizing = document['Rightsizing']
+        prefix = (f"{instance_id}|{document.get('instance_type') or '-'}|{rightsizing['action']}|"
+                  f"{rightsizing['target_type'] or '-'}")
+        for metric_name, entry in document['Optimization_Recommendations'].items():
+            lines.append(
+                f"{prefix}|{metric_name}|{entry['Current_Usage']:g}|{entry['Optimized_Usage']:g}|{entry['Recommendation']}"
+            )
+    return "\n".join(lines)
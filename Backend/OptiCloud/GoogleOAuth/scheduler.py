@@ -0,0 +1,193 @@
+import logging
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from pymongo.errors import PyMongoError
+
+from .aws import get_account_id
+from .mongodb import get_database
+from .jobs import refresh_and_wait
+
+logger = logging.getLogger(__name__)
+
+
+# Background refresh of every user with a role ARN, so dashboard reads find fresh
+# metrics instead of paying for the pipeline. Each user document carries its schedule:
+#
+#   'metrics_refresh': {'status': 'running' | 'succeeded' | 'failed',
+#                       'next_run_at': datetime, 'lease_until': datetime,
+#                       'last_started_at': datetime, 'last_finished_at': datetime,
+#                       'last_duration': float, 'last_error': str | None}
+#
+# A user is claimed by setting a lease, so several collectors can run side by side
+# without refreshing the same user twice.
+
+
+def get_users_collection():
+    return get_database()['test_collection']
+
+
+def next_run_time(now, interval, jitter):
+    # Jitter spreads refreshes out so users added together don't stay in lockstep
+    return now + timedelta(seconds=interval + random.uniform(0, jitter))
+
+
+def find_due_users(now, limit):
+    # Users that have never been refreshed come first, then the most overdue
+    return list(get_users_collection().find(
+        {
+            'roleArn': {'$type': 'string'},
+            'metrics_refresh.lease_until': {'$not': {'$gt': now}},
+            '$or': [
+                {'metrics_refresh.next_run_at': {'$exists': False}},
+                {'metrics_refresh.next_run_at': {'$lte': now}},
+            ],
+        },
+        {'id': 1, 'roleArn': 1, '_id': 0},
+        sort=[('metrics_refresh.next_run_at', 1)],
+        limit=limit,
+    ))
+
+
+def interleave_by_account(users):
+    # Round-robin over AWS accounts so one tenant with many users can't starve the rest
+    queues = OrderedDict()
+    for user in users:
+        queues.setdefault(get_account_id(user['roleArn']), []).append(user)
+    ordered = []
+    while queues:
+        for account_id in list(queues):
+            ordered.append(queues[account_id].pop(0))
+            if not queues[account_id]:
+                del queues[account_id]
+    return ordered
+
+
+def claim_user(user_id, now, lease):
+    # Take the user unless another collector holds an unexpired lease on it
+    return get_users_collection().find_one_and_update(
+        {
+            'id': user_id,
+            '$or': [
+                {'metrics_refresh.lease_until': {'$exists': False}},
+                {'metrics_refresh.lease_until': {'$lte': now}},
+            ],
+        },
+        {'$set': {
+            'metrics_refresh.status': 'running',
+            'metrics_refresh.lease_until': now + timedelta(seconds=lease),
+            'metrics_refresh.last_started_at': now,
+        }},
+        projection={'id': 1, 'roleArn': 1, '_id': 0},
+    )
+
+
+def record_result(user_id, started_at, error, interval, jitter):
+    finished_at = datetime.now(timezone.utc)
+    get_users_collection().update_one({'id': user_id}, {
+        '$set': {
+            'metrics_refresh.status': 'failed' if error else 'succeeded',
+            'metrics_refresh.last_finished_at': finished_at,
+            'metrics_refresh.last_duration': (finished_at - started_at).total_seconds(),
+            'metrics_refresh.last_error': error,
+            'metrics_refresh.next_run_at': next_run_time(finished_at, interval, jitter),
+        },
+        '$unset': {'metrics_refresh.lease_until': ''},
+    })
+
+
+def run_scheduled_refresh(user, started_at, interval, jitter):
+    # Shares the refresh with a dashboard request for the same user that is already running
+    try:
+        error = refresh_and_wait(user['roleArn'], user['id'])
+    except Exception as e:
+        logger.exception("Scheduled refresh for user %s failed", user['id'])
+        error = str(e)
+    try:
+        record_result(user['id'], started_at, error, interval, jitter)
+    except PyMongoError as e:
+        # The lease runs out and the user is picked up again later
+        logger.error("Failed to record the refresh of user %s: %s", user['id'], e)
+    return error
+
+
+class RefreshScheduler:
+    # Runs refreshes on a fixed-size pool: at most `concurrency` at a time overall and
+    # at most `per_account` at a time against any one AWS account.
+
+    def __init__(self, interval=None, jitter=None, concurrency=None, per_account=None,
+                 lease=None, poll_interval=None):
+        self.interval = interval if interval is not None else getattr(settings, 'OPTICLOUD_REFRESH_INTERVAL', 3600)
+        self.jitter = jitter if jitter is not None else getattr(settings, 'OPTICLOUD_REFRESH_JITTER', 300)
+        self.concurrency = concurrency or getattr(settings, 'OPTICLOUD_SCHEDULER_CONCURRENCY', 4)
+        self.per_account = per_account or getattr(settings, 'OPTICLOUD_SCHEDULER_PER_ACCOUNT', 1)
+        self.lease = lease or getattr(settings, 'OPTICLOUD_SCHEDULER_LEASE', 1800)
+        self.poll_interval = poll_interval or getattr(settings, 'OPTICLOUD_SCHEDULER_POLL_INTERVAL', 30)
+        self.stopping = threading.Event()
+        self.running = {}  # future -> (user id, account id)
+
+    def stop(self):
+        self.stopping.set()
+
+    def account_load(self):
+        load = {}
+        for _, account_id in self.running.values():
+            load[account_id] = load.get(account_id, 0) + 1
+        return load
+
+    def dispatch(self, executor):
+        # Start as many due refreshes as the global and per-account limits allow
+        free = self.concurrency - len(self.running)
+        if free <= 0:
+            return 0
+        now = datetime.now(timezone.utc)
+        busy_users = {user_id for user_id, _ in self.running.values()}
+        load = self.account_load()
+        started = 0
+        # Fetch more than the free slots so busy accounts can be skipped over
+        for user in interleave_by_account(find_due_users(now, free * 4)):
+            if started >= free:
+                break
+            account_id = get_account_id(user['roleArn'])
+            if user['id'] in busy_users or load.get(account_id, 0) >= self.per_account:
+                continue
+            claimed = claim_user(user['id'], now, self.lease)
+            if not claimed or not claimed.get('roleArn'):
+                continue
+            future = executor.submit(run_scheduled_refresh, claimed, now, self.interval, self.jitter)
+            self.running[future] = (user['id'], account_id)
+            load[account_id] = load.get(account_id, 0) + 1
+            started += 1
+        return started
+
+    def reap(self, timeout):
+        if not self.running:
+            self.stopping.wait(timeout)
+            return []
+        done, _ = wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+        finished = []
+        for future in done:
+            user_id, _ = self.running.pop(future)
+            finished.append((user_id, future.result()))
+        return finished
+
+    def run(self, once=False, on_finished=None):
+        # Loop until stop() is called; with once=True, refresh whatever is due now and
+        # return when those refreshes are done
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='opticloud-scheduler') as executor:
+            while not self.stopping.is_set():
+                started = self.dispatch(executor)
+                if once and not started and not self.running:
+                    break
+                for user_id, error in self.reap(self.poll_interval if not once else None):
+                    if on_finished:
+                        on_finished(user_id, error)
+            # Let refreshes that are already running finish and record their status
+            while self.running:
+                for user_id, error in self.reap(None):
+                    if on_finished:
+                        on_finished(user_id, error)
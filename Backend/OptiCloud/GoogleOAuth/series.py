@@ -0,0 +1,129 @@
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+# CloudWatch statistic name -> column (and stored field) name
+STAT_FIELDS = {
+    'Average': 'average',
+    'Minimum': 'minimum',
+    'Maximum': 'maximum',
+    'Sum': 'sum',
+    'SampleCount': 'sample_count',
+}
+
+NAN = math.nan
+
+
+def to_epoch(timestamp):
+    # pymongo hands back naive UTC datetimes; CloudWatch gives aware ones
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def from_epoch(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+class MetricSeries:
+    # One metric of one instance, kept as columns: ascending, unique timestamps in seconds
+    # since the epoch and one column of doubles per statistic, NaN where there is no
+    # value. A datapoint costs 48 bytes instead of a dict and a datetime, and the columns
+    # go straight into NumPy (values()). The CloudWatch shape, {'Timestamp': datetime,
+    # 'Average': float, ...}, is only rendered on demand by datapoints().
+    #
+    # values() returns views on the columns, and an array cannot grow while a view on it
+    # is alive, so only take views of series that are no longer appended to.
+
+    __slots__ = ('timestamps',) + tuple(STAT_FIELDS.values())
+
+    def __init__(self):
+        self.timestamps = array('d')
+        for field in STAT_FIELDS.values():
+            setattr(self, field, array('d'))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __repr__(self):
+        return f"<MetricSeries {len(self)} datapoints>"
+
+    def append(self, timestamp, values):
+        # timestamp: seconds since the epoch, later than every one already in the series;
+        # values: {column name: value}, e.g. a stored datapoint document
+        self.timestamps.append(timestamp)
+        for field in STAT_FIELDS.values():
+            value = values.get(field)
+            getattr(self, field).append(NAN if value is None else value)
+
+    @classmethod
+    def from_results(cls, results):
+        # {statistic: (timestamps, values)} as returned by GetMetricData, one entry per
+        # statistic of the same metric; statistics may be missing at some timestamps
+        epochs = {stat: [to_epoch(timestamp) for timestamp in timestamps] for stat, (timestamps, _) in results.items()}
+        series = cls()
+        series.timestamps = array('d', sorted(set().union(*epochs.values())))
+        position = {timestamp: index for index, timestamp in enumerate(series.timestamps)}
+        for stat, field in STAT_FIELDS.items():
+            column = array('d', [NAN]) * len(series.timestamps)
+            if stat in results:
+                for timestamp, value in zip(epochs[stat], results[stat][1]):
+                    column[position[timestamp]] = value
+            setattr(series, field, column)
+        return series
+
+    @classmethod
+    def from_datapoints(cls, datapoints):
+        # From CloudWatch-shaped datapoints in any order
+        series = cls()
+        for datapoint in sorted(datapoints, key=lambda point: to_epoch(point['Timestamp'])):
+            series.append(to_epoch(datapoint['Timestamp']), {
+                field: datapoint.get(stat) for stat, field in STAT_FIELDS.items()
+            })
+        return series
+
+    def values(self, column):
+        # NumPy view of 'timestamps' or a statistic column, without copying
+        return np.frombuffer(getattr(self, column), dtype=np.float64)
+
+    def datapoints(self):
+        # Lazily render the CloudWatch shape, leaving out missing statistics
+        columns = [(stat, getattr(self, field)) for stat, field in STAT_FIELDS.items()]
+        for index, timestamp in enumerate(self.timestamps):
+            datapoint = {'Timestamp': from_epoch(timestamp)}
+            for stat, column in columns:
+                if not math.isnan(column[index]):
+                    datapoint[stat] = column[index]
+            yield datapoint
+
+    def slice(self, start=None, end=None):
+        # Copy of the datapoints with start <= timestamp <= end (seconds since the epoch)
+        first = 0 if start is None else bisect_left(self.timestamps, start)
+        last = len(self.timestamps) if end is None else bisect_right(self.timestamps, end)
+        series = MetricSeries()
+        for column in self.__slots__:
+            setattr(series, column, getattr(self, column)[first:last])
+        return series
+
+    def merge(self, other):
+        # (series, added): this series with the datapoints of `other` at timestamps it does
+        # not have yet. Appending newer datapoints, the usual case, extends it in place.
+        if not len(other):
+            return self, 0
+        if not len(self) or other.timestamps[0] > self.timestamps[-1]:
+            for column in self.__slots__:
+                getattr(self, column).extend(getattr(other, column))
+            return self, len(other)
+
+        known = set(self.timestamps)
+        rows = [(timestamp, self, index) for index, timestamp in enumerate(self.timestamps)]
+        rows += [(timestamp, other, index) for index, timestamp in enumerate(other.timestamps) if timestamp not in known]
+        rows.sort(key=lambda row: row[0])
+        merged = MetricSeries()
+        for column in self.__slots__:
+            setattr(merged, column, array('d', [getattr(source, column)[index] for _, source, index in rows]))
+        return merged, len(rows) - len(self)
@@ -48,11 +48,13 @@ INSTALLED_APPS = [
     'allauth.socialaccount',
     'allauth.socialaccount.providers.google',
     'corsheaders',
+    'GoogleOAuth',  # for the collect_metrics management command
       # Ensure static files is listed after corsheaders # Google provider
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'GoogleOAuth.middleware.CompressionMiddleware',  # brotli or gzip for large responses
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -178,3 +180,90 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Metric collection
+# Query every region enabled on the customer's account instead of only the default region
+OPTICLOUD_COLLECT_ALL_REGIONS = os.getenv('OPTICLOUD_COLLECT_ALL_REGIONS', 'False') == 'True'
+# Upper bound on concurrent DescribeInstances / GetMetricData calls per refresh
+OPTICLOUD_COLLECTION_WORKERS = int(os.getenv('OPTICLOUD_COLLECTION_WORKERS', '8'))
+# Assumed-role credentials are refreshed this many seconds before they expire
+OPTICLOUD_CREDENTIALS_REFRESH_MARGIN = int(os.getenv('OPTICLOUD_CREDENTIALS_REFRESH_MARGIN', '300'))
+# Maximum number of cached per-tenant boto3 clients (one per credentials/service/region),
+# and of cached assumed-role credentials
+OPTICLOUD_CLIENT_CACHE_SIZE = int(os.getenv('OPTICLOUD_CLIENT_CACHE_SIZE', '256'))
+# Number of refresh jobs (STS + EC2 + CloudWatch + OpenAI) run concurrently per worker process
+OPTICLOUD_JOB_WORKERS = int(os.getenv('OPTICLOUD_JOB_WORKERS', '4'))
+# LLM recommendations are cached by a hash of the metrics input, model and prompt version
+OPTICLOUD_LLM_CACHE_TTL = int(os.getenv('OPTICLOUD_LLM_CACHE_TTL', '21600'))
+OPTICLOUD_LLM_CACHE_SIZE = int(os.getenv('OPTICLOUD_LLM_CACHE_SIZE', '1024'))
+# Also keep cached recommendations in MongoDB so they are shared between workers
+OPTICLOUD_LLM_CACHE_MONGO = os.getenv('OPTICLOUD_LLM_CACHE_MONGO', 'False') == 'True'
+# Where raw CloudWatch datapoints are kept: 'mongo' (time-series collection) or 'memory'
+OPTICLOUD_DATAPOINT_STORE = os.getenv('OPTICLOUD_DATAPOINT_STORE', 'mongo')
+# Retention of raw datapoints and of the hourly / daily rollups, in days
+OPTICLOUD_DATAPOINT_RETENTION_DAYS = int(os.getenv('OPTICLOUD_DATAPOINT_RETENTION_DAYS', '14'))
+OPTICLOUD_HOURLY_ROLLUP_RETENTION_DAYS = int(os.getenv('OPTICLOUD_HOURLY_ROLLUP_RETENTION_DAYS', '90'))
+OPTICLOUD_DAILY_ROLLUP_RETENTION_DAYS = int(os.getenv('OPTICLOUD_DAILY_ROLLUP_RETENTION_DAYS', '730'))
+# Only fetch datapoints newer than the last refresh and merge them into the stored window
+OPTICLOUD_INCREMENTAL_COLLECTION = os.getenv('OPTICLOUD_INCREMENTAL_COLLECTION', 'True') == 'True'
+# Threads per worker process for the blocking boto3 / MongoDB calls of the async views
+OPTICLOUD_ASYNC_IO_WORKERS = int(os.getenv('OPTICLOUD_ASYNC_IO_WORKERS', '32'))
+# Scheduled collection (manage.py collect_metrics): seconds between refreshes of a user,
+# plus up to OPTICLOUD_REFRESH_JITTER seconds so refreshes don't line up
+OPTICLOUD_REFRESH_INTERVAL = int(os.getenv('OPTICLOUD_REFRESH_INTERVAL', '3600'))
+OPTICLOUD_REFRESH_JITTER = int(os.getenv('OPTICLOUD_REFRESH_JITTER', '300'))
+# Refreshes run at the same time by one collector, overall and against one AWS account
+OPTICLOUD_SCHEDULER_CONCURRENCY = int(os.getenv('OPTICLOUD_SCHEDULER_CONCURRENCY', '4'))
+OPTICLOUD_SCHEDULER_PER_ACCOUNT = int(os.getenv('OPTICLOUD_SCHEDULER_PER_ACCOUNT', '1'))
+# A claimed user is released after this many seconds if its collector dies mid-refresh
+OPTICLOUD_SCHEDULER_LEASE = int(os.getenv('OPTICLOUD_SCHEDULER_LEASE', '1800'))
+# Seconds between checks for users that are due
+OPTICLOUD_SCHEDULER_POLL_INTERVAL = int(os.getenv('OPTICLOUD_SCHEDULER_POLL_INTERVAL', '30'))
+# Target 95th percentile CPU utilization (percent) when picking a smaller instance type
+OPTICLOUD_RIGHTSIZING_TARGET_CPU = float(os.getenv('OPTICLOUD_RIGHTSIZING_TARGET_CPU', '60'))
+# Have the LLM reword the computed recommendations; the numbers never depend on it
+OPTICLOUD_LLM_NARRATION = os.getenv('OPTICLOUD_LLM_NARRATION', 'True') == 'True'
+# How far apart instances may behave and still share one narration (0: identical only)
+OPTICLOUD_CLUSTER_TOLERANCE = float(os.getenv('OPTICLOUD_CLUSTER_TOLERANCE', '1.0'))
+# How far an instance may drift from the behaviour its stored wording was written for,
+# relative to the cluster tolerances, before it is narrated again
+OPTICLOUD_CHANGE_TOLERANCE = float(os.getenv('OPTICLOUD_CHANGE_TOLERANCE', '0.5'))
+# Days after which a stored wording is regenerated even if nothing changed
+OPTICLOUD_NARRATION_MAX_AGE = int(os.getenv('OPTICLOUD_NARRATION_MAX_AGE', '7'))
+# Seconds a refresh may hold its user's lease; concurrent refreshes join it meanwhile
+OPTICLOUD_REFRESH_LEASE = int(os.getenv('OPTICLOUD_REFRESH_LEASE', '900'))
+# Refresh streams (server-sent events) a WSGI worker process serves at once; each one
+# holds a server thread until its refresh ends. Streams under asgi.py hold no thread.
+OPTICLOUD_WSGI_REFRESH_STREAMS = int(os.getenv('OPTICLOUD_WSGI_REFRESH_STREAMS', '4'))
+# Stream LLM completions and parse recommendations as they arrive
+OPTICLOUD_LLM_STREAM = os.getenv('OPTICLOUD_LLM_STREAM', 'True') == 'True'
+# LLM dispatch queue: completions running at once per process, tokens granted per minute
+# (0: no budget; set it to the account's OpenAI limit) and retries after a 429
+OPTICLOUD_LLM_WORKERS = int(os.getenv('OPTICLOUD_LLM_WORKERS', '4'))
+OPTICLOUD_LLM_TOKENS_PER_MINUTE = int(os.getenv('OPTICLOUD_LLM_TOKENS_PER_MINUTE', '0'))
+OPTICLOUD_LLM_MAX_RETRIES = int(os.getenv('OPTICLOUD_LLM_MAX_RETRIES', '4'))
+# Load the AWS and OpenAI SDKs and open MongoDB connections when a worker starts instead
+# of on its first requests (see warmup.py); connections: how many to open
+OPTICLOUD_WARMUP = os.getenv('OPTICLOUD_WARMUP', 'False') == 'True'
+OPTICLOUD_WARMUP_CONNECTIONS = int(os.getenv('OPTICLOUD_WARMUP_CONNECTIONS', '4'))
+# Bearer token required to scrape /metrics; leave empty to allow any scraper
+OPTICLOUD_METRICS_TOKEN = os.getenv('OPTICLOUD_METRICS_TOKEN', '')
+
+# Application logs go to the console; DEBUG also logs the summary table and LLM output
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'standard': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'standard'},
+    },
+    'loggers': {
+        'GoogleOAuth': {
+            'handlers': ['console'],
+            'level': os.getenv('OPTICLOUD_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,155 @@
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from .collector import notify
+from .mongodb import get_database
+
+logger = logging.getLogger(__name__)
+
+
+# At most one refresh per user and role ARN at a time. Within a process, concurrent
+# requests join the Flight already running and get its progress events; across
+# processes, a lease document in refresh_leases names the job that holds the refresh:
+#
+#   {'_id': <refresh key>, 'job_id': str, 'holder': 'host:pid', 'lease_until': datetime}
+#
+# The lease is released when the refresh finishes and expires on its own if the holder
+# dies, so it has to outlast the slowest refresh (OPTICLOUD_REFRESH_LEASE). A Flight has
+# the same deadline: one still registered after it (its runner died without publishing
+# an outcome) is failed and replaced by the next request instead of being joined.
+
+LEASES_COLLECTION = 'refresh_leases'
+
+FINAL_EVENTS = ('done', 'failed')
+
+_flights = {}  # refresh key -> Flight
+_flights_lock = threading.Lock()
+
+
+def refresh_key(role_arn, user_id=None):
+    return f"user:{user_id}:{role_arn}" if user_id else f"role:{role_arn}"
+
+
+class Flight:
+    # One refresh in progress in this process and everyone waiting on it. Events are
+    # kept so a request that joins late still sees the whole run.
+
+    def __init__(self, key, job_id, seconds=None):
+        self.key = key
+        self.job_id = job_id
+        if seconds is None:
+            seconds = getattr(settings, 'OPTICLOUD_REFRESH_LEASE', 900)
+        self.deadline = time.monotonic() + seconds
+        self.remote = False  # the refresh runs in another process
+        self.error = None
+        self.ready = threading.Event()  # set once job_id is final
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._history = []
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        return not self.finished.is_set() and time.monotonic() >= self.deadline
+
+    def subscribe(self, progress):
+        if progress is None:
+            return
+        with self._lock:
+            for event, data in self._history:
+                notify(progress, event, data)
+            if not self.finished.is_set():
+                self._subscribers.append(progress)
+
+    def publish(self, event, data):
+        # Progress callback of the refresh itself; fans every event out to the subscribers
+        with self._lock:
+            self._history.append((event, data))
+            for progress in self._subscribers:
+                notify(progress, event, data)
+            if event in FINAL_EVENTS:
+                self._subscribers = []
+                if event == 'failed':
+                    self.error = data.get('error') or 'Refresh failed'
+                land(self)
+                self.finished.set()
+
+
+def start_or_join(key, job_id, progress=None):
+    # (flight, started): the flight in progress for `key`, or a new one under `job_id`
+    with _flights_lock:
+        flight = _flights.get(key)
+        stale = flight if flight is not None and flight.expired() else None
+        started = flight is None or stale is not None
+        if started:
+            flight = _flights[key] = Flight(key, job_id)
+    if stale is not None:
+        logger.warning("Refresh job %s outlived its lease without finishing; starting a new one", stale.job_id)
+        stale.publish('failed', {'job_id': stale.job_id, 'error': 'The refresh timed out'})
+    flight.subscribe(progress)
+    return flight, started
+
+
+def land(flight):
+    # Requests from here on start a new refresh
+    with _flights_lock:
+        if _flights.get(flight.key) is flight:
+            del _flights[flight.key]
+
+
+def get_leases_collection():
+    return get_database()[LEASES_COLLECTION]
+
+
+def lease_holder():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(key, job_id, seconds=None):
+    # None when the lease is ours (or MongoDB is unavailable, so the refresh runs
+    # anyway), otherwise the id of the job holding it
+    if seconds is None:
+        seconds = getattr(settings, 'OPTICLOUD_REFRESH_LEASE', 900)
+    collection = get_leases_collection()
+    for _ in range(3):
+        now = datetime.now(timezone.utc)
+        try:
+            # Matches only an expired lease; with none at all the upsert inserts ours,
+            # and an unexpired one makes the insert fail on the duplicate _id
+            collection.update_one(
+                {'_id': key, 'lease_until': {'$lte': now}},
+                {'$set': {'job_id': job_id, 'holder': lease_holder(), 'lease_until': now + timedelta(seconds=seconds)}},
+                upsert=True
+            )
+            return None
+        except DuplicateKeyError:
+            lease = collection.find_one({'_id': key}, {'job_id': 1})
+            if lease:
+                return lease['job_id']
+            # Released in the meantime; try again
+        except PyMongoError as e:
+            logger.warning("Failed to take the refresh lease %s: %s", key, e)
+            return None
+    return None
+
+
+def release_lease(key, job_id):
+    try:
+        get_leases_collection().delete_one({'_id': key, 'job_id': job_id})
+    except PyMongoError as e:
+        logger.warning("Failed to release the refresh lease %s: %s", key, e)
+
+
+def lease_is_held(key, job_id):
+    return get_leases_collection().find_one(
+        {'_id': key, 'job_id': job_id, 'lease_until': {'$gt': datetime.now(timezone.utc)}}, {'_id': 1}
+    ) is not None
@@ -0,0 +1,110 @@
+import numpy as np
+
+from .cloudwatch import PERIOD
+
+
+# A datapoint counts as idle when its hourly average is at or below these values.
+# Status checks have no notion of idle and are left out.
+IDLE_THRESHOLDS = {
+    'CPUUtilization': 5.0,          # percent
+    'DiskReadOps': 1.0,
+    'DiskWriteOps': 1.0,
+    'DiskReadBytes': 10000.0,
+    'DiskWriteBytes': 10000.0,
+    'NetworkIn': 10000.0,           # bytes
+    'NetworkOut': 10000.0,
+}
+
+
+def _series_matrix(series_list, column):
+    # Pad every series to the same length with NaN so all of them are reduced at once
+    width = max((len(series) for series in series_list), default=0)
+    values = np.full((len(series_list), max(width, 1)), np.nan)
+    hours = np.full_like(values, np.nan)
+    for row, series in enumerate(series_list):
+        if not series:
+            continue
+        timestamps = series.values('timestamps')
+        values[row, :len(series)] = series.values(column)
+        hours[row, :len(series)] = (timestamps - timestamps[0]) / 3600
+    return values, hours
+
+
+def summarize_series(series_list, metric_names):
+    # Per-series statistics over MetricSeries of hourly datapoints, computed for every series in one pass:
+    # mean / p50 / p95 of the hourly averages, the highest maximum, the least-squares
+    # trend (change per hour) and the fraction of idle hours. The averages are per
+    # CloudWatch sample (1 or 5 minutes), so for counters (operations, bytes)
+    # hourly_sum gives the mean total per hour, from the Sum of each period.
+    if not series_list:
+        return []
+
+    averages, hours = _series_matrix(series_list, 'average')
+    maximums, _ = _series_matrix(series_list, 'maximum')
+    sums, _ = _series_matrix(series_list, 'sum')
+    present = ~np.isnan(averages)
+    points = present.sum(axis=1)
+
+    has_data = points > 0
+    mean = np.full(len(series_list), np.nan)
+    p50 = np.full(len(series_list), np.nan)
+    p95 = np.full(len(series_list), np.nan)
+    peak = np.full(len(series_list), np.nan)
+    if has_data.any():
+        mean[has_data] = np.nanmean(averages[has_data], axis=1)
+        p50[has_data] = np.nanpercentile(averages[has_data], 50, axis=1)
+        p95[has_data] = np.nanpercentile(averages[has_data], 95, axis=1)
+        peak[has_data] = np.nanmax(np.fmax(maximums[has_data], averages[has_data]), axis=1)
+
+    hourly_sum = np.full(len(series_list), np.nan)
+    summed = (~np.isnan(sums)).any(axis=1)
+    if summed.any():
+        hourly_sum[summed] = np.nanmean(sums[summed], axis=1) * (3600 / PERIOD)
+
+    # Closed-form least-squares slope, ignoring padded cells
+    n = np.maximum(points, 1)
+    x = np.where(present, hours, 0.0)
+    y = np.where(present, averages, 0.0)
+    dx = np.where(present, x - (x.sum(axis=1) / n)[:, None], 0.0)
+    dy = np.where(present, y - (y.sum(axis=1) / n)[:, None], 0.0)
+    denominator = (dx * dx).sum(axis=1)
+    trend = np.full(len(series_list), np.nan)
+    sloped = (points > 1) & (denominator > 0)
+    trend[sloped] = (dx * dy).sum(axis=1)[sloped] / denominator[sloped]
+
+    thresholds = np.array([IDLE_THRESHOLDS.get(name, np.nan) for name in metric_names])
+    idle = (present & (averages <= thresholds[:, None])).sum(axis=1) / n
+    idle[np.isnan(thresholds) | ~has_data] = np.nan
+
+    summaries = []
+    for row in range(len(series_list)):
+        summaries.append({
+            'mean': _number(mean[row]),
+            'p50': _number(p50[row]),
+            'p95': _number(p95[row]),
+            'max': _number(peak[row]),
+            'hourly_sum': _number(hourly_sum[row]),
+            'trend': _number(trend[row]),
+            'idle_fraction': _number(idle[row]),
+            'points': int(points[row]),
+        })
+    return summaries
+
+
+def _number(value):
+    return None if np.isnan(value) else float(value)
+
+
+def summarize_instances(instances):
+    # {instance_id: {metric_name: summary}} for collector instance records
+    keys = []
+    series_list = []
+    for instance in instances:
+        for metric_name, series in instance['metrics'].items():
+            keys.append((instance['instance_id'], metric_name))
+            series_list.append(series)
+
+    summaries = {instance['instance_id']: {} for instance in instances}
+    for (instance_id, metric_name), summary in zip(keys, summarize_series(series_list, [k[1] for k in keys])):
+        summaries[instance_id][metric_name] = summary
+    return summaries
@@ -0,0 +1,20 @@
+import os
+
+import mongomock
+
+from .. import mongodb
+from ..benchmark import patch_mongomock_bulk_write
+
+patch_mongomock_bulk_write(mongomock)
+
+
+def use_mongomock(test_case):
+    # Point get_database() at a fresh in-memory MongoDB for the length of one test
+    client = mongomock.MongoClient()
+    previous = mongodb._client, mongodb._client_pid
+    mongodb._client, mongodb._client_pid = client, os.getpid()
+
+    def restore():
+        mongodb._client, mongodb._client_pid = previous
+    test_case.addCleanup(restore)
+    return client[mongodb.db_name]
@@ -0,0 +1,57 @@
+import os
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from moto import mock_aws
+
+from .. import aws
+from ..aws import assume_customer_role, forget_customer_role
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/OptiCloudRole{}'
+
+FAKE_ENVIRONMENT = {
+    'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing', 'AWS_DEFAULT_REGION': 'us-east-1',
+}
+
+
+class AssumeCustomerRoleTests(SimpleTestCase):
+
+    def setUp(self):
+        environment = mock.patch.dict(os.environ, FAKE_ENVIRONMENT)
+        environment.start()
+        self.addCleanup(environment.stop)
+        moto = mock_aws()
+        moto.start()
+        self.addCleanup(moto.stop)
+        aws._credentials_cache.clear()
+        self.addCleanup(aws._credentials_cache.clear)
+        self.sts_calls = 0
+        new_client = aws._new_client
+
+        def counting_new_client(service_name, **kwargs):
+            if service_name == 'sts':
+                self.sts_calls += 1
+            return new_client(service_name, **kwargs)
+        patcher = mock.patch.object(aws, '_new_client', counting_new_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_credentials_are_reused_until_forgotten(self):
+        credentials = assume_customer_role(ROLE_ARN.format(1))
+        self.assertEqual(credentials['account_id'], '123456789012')
+        self.assertIs(assume_customer_role(ROLE_ARN.format(1)), credentials)
+        self.assertEqual(self.sts_calls, 1)
+
+        forget_customer_role(ROLE_ARN.format(1))
+        assume_customer_role(ROLE_ARN.format(1))
+        self.assertEqual(self.sts_calls, 2)
+
+    @override_settings(OPTICLOUD_CLIENT_CACHE_SIZE=3)
+    def test_the_cache_keeps_the_most_recently_assumed_roles(self):
+        for index in range(5):
+            assume_customer_role(ROLE_ARN.format(index))
+        assume_customer_role(ROLE_ARN.format(2))  # still cached, no STS call
+        assume_customer_role(ROLE_ARN.format(5))
+
+        self.assertEqual(list(aws._credentials_cache), [ROLE_ARN.format(index) for index in (3, 4, 5)])
+        self.assertEqual(self.sts_calls, 6)
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+from django.test import SimpleTestCase
+
+from ..cloudwatch import (
+    MAX_QUERIES_PER_REQUEST, METRICS_TO_FETCH, STATISTICS, chunk_instance_ids, get_metric_data_batch,
+    get_metric_data_for_instances,
+)
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeCloudWatch:
+    # Answers GetMetricData with one datapoint per query, `pages` pages per request;
+    # every page carries a share of the results and the last one has no NextToken
+
+    def __init__(self, pages=1, failing=()):
+        self.pages = pages
+        self.failing = set(failing)
+        self.calls = []
+
+    def get_metric_data(self, **kwargs):
+        self.calls.append(kwargs)
+        queries = kwargs['MetricDataQueries']
+        if len(queries) > MAX_QUERIES_PER_REQUEST:
+            raise AssertionError(f"{len(queries)} queries in one request")
+        instance_ids = {query['MetricStat']['Metric']['Dimensions'][0]['Value'] for query in queries}
+        if instance_ids & self.failing:
+            raise ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'GetMetricData')
+        page = int(kwargs.get('NextToken') or 0)
+        results = [
+            {'Id': query['Id'], 'Timestamps': [START + timedelta(hours=page)], 'Values': [float(page)]}
+            for query in queries
+        ]
+        response = {'MetricDataResults': results}
+        if page + 1 < self.pages:
+            response['NextToken'] = str(page + 1)
+        return response
+
+
+class ChunkInstanceIdsTests(SimpleTestCase):
+
+    def test_packs_whole_instances_under_the_query_limit(self):
+        instance_ids = [f"i-{index}" for index in range(25)]
+        per_instance = len(METRICS_TO_FETCH) * len(STATISTICS)
+        batches = chunk_instance_ids(instance_ids)
+        self.assertEqual([instance_id for batch in batches for instance_id in batch], instance_ids)
+        self.assertEqual(len(batches[0]), MAX_QUERIES_PER_REQUEST // per_instance)
+        self.assertTrue(all(len(batch) * per_instance <= MAX_QUERIES_PER_REQUEST for batch in batches))
+
+    def test_an_instance_with_too_many_queries_gets_its_own_batch(self):
+        metrics = [f"Metric{index}" for index in range(MAX_QUERIES_PER_REQUEST)]
+        self.assertEqual(chunk_instance_ids(['i-1', 'i-2'], metrics), [['i-1'], ['i-2']])
+
+
+class GetMetricDataTests(SimpleTestCase):
+
+    def test_follows_next_token_and_joins_the_pages(self):
+        client = FakeCloudWatch(pages=3)
+        metrics = get_metric_data_batch(client, ['i-1', 'i-2'], START, START + timedelta(days=1))
+
+        self.assertEqual(len(client.calls), 3)
+        self.assertNotIn('NextToken', client.calls[0])
+        self.assertEqual([call.get('NextToken') for call in client.calls[1:]], ['1', '2'])
+        series = metrics['i-2']['CPUUtilization']
+        self.assertEqual(len(series), 3)
+        self.assertEqual(list(series.values('average')), [0.0, 1.0, 2.0])
+        self.assertEqual(set(metrics['i-1']), set(METRICS_TO_FETCH))
+
+    def test_one_call_per_batch(self):
+        instance_ids = [f"i-{index}" for index in range(25)]
+        client = FakeCloudWatch()
+        metrics, errors = get_metric_data_for_instances(client, instance_ids, START, START + timedelta(days=1))
+
+        self.assertEqual(len(client.calls), len(chunk_instance_ids(instance_ids)))
+        self.assertEqual(set(metrics), set(instance_ids))
+        self.assertEqual(errors, {})
+
+    def test_a_failed_batch_is_reported_per_instance(self):
+        instance_ids = [f"i-{index}" for index in range(25)]
+        failed_batch = chunk_instance_ids(instance_ids)[1]
+        client = FakeCloudWatch(failing=[failed_batch[0]])
+        metrics, errors = get_metric_data_for_instances(client, instance_ids, START, START + timedelta(days=1))
+
+        self.assertEqual(set(errors), set(failed_batch))
+        self.assertIn('Rate exceeded', errors[failed_batch[0]])
+        self.assertEqual(set(metrics), set(instance_ids) - set(failed_batch))
@@ -0,0 +1,48 @@
+from django.test import SimpleTestCase
+
+from ..fleet import FleetQueryError, decode_cursor, encode_cursor, get_fleet_collection, query_fleet
+from . import use_mongomock
+
+CPU_P95 = {'i-a': None, 'i-b': 10.0, 'i-c': None, 'i-d': 30.0, 'i-e': 10.0, 'i-f': 50.0, 'i-g': None}
+
+
+class FleetPaginationTests(SimpleTestCase):
+
+    def setUp(self):
+        use_mongomock(self)
+        get_fleet_collection().insert_many([
+            {'_id': f"user:{instance_id}", 'user_id': 'user', 'instance_id': instance_id, 'cpu_p95': cpu_p95}
+            for instance_id, cpu_p95 in CPU_P95.items()
+        ] + [{'_id': 'other:i-z', 'user_id': 'other', 'instance_id': 'i-z', 'cpu_p95': 20.0}])
+
+    def pages(self, sort, limit):
+        params = {'sort': sort, 'limit': str(limit)}
+        pages = []
+        while True:
+            page = query_fleet('user', params)
+            pages.append([instance['instance_id'] for instance in page['instances']])
+            if not page['next_cursor']:
+                return pages
+            params['cursor'] = page['next_cursor']
+
+    def test_nulls_come_first_ascending(self):
+        pages = self.pages('cpu_p95', 2)
+        self.assertEqual(pages, [['i-a', 'i-c'], ['i-g', 'i-b'], ['i-e', 'i-d'], ['i-f']])
+
+    def test_nulls_come_last_descending(self):
+        pages = self.pages('-cpu_p95', 2)
+        self.assertEqual(pages, [['i-f', 'i-d'], ['i-e', 'i-b'], ['i-g', 'i-c'], ['i-a']])
+
+    def test_every_page_size_visits_every_instance_once(self):
+        for sort in ('cpu_p95', '-cpu_p95'):
+            expected = sum(self.pages(sort, len(CPU_P95)), [])
+            for limit in range(1, len(CPU_P95)):
+                with self.subTest(sort=sort, limit=limit):
+                    self.assertEqual(sum(self.pages(sort, limit), []), expected)
+
+    def test_cursors_only_carry_plain_values(self):
+        self.assertEqual(decode_cursor(encode_cursor(None, 'user:i-a')), (None, 'user:i-a'))
+        with self.assertRaises(FleetQueryError):
+            decode_cursor(encode_cursor({'$gt': 0}, 'user:i-a'))
+        with self.assertRaises(FleetQueryError):
+            decode_cursor('not a cursor')
@@ -0,0 +1,105 @@
+import queue
+
+from django.test import SimpleTestCase
+
+from ..llm_queue import BACKGROUND, BUDGET_WINDOW, INTERACTIVE, LLMDispatcher, Ticket
+
+# Long enough for the dispatcher thread to get to a ticket
+GRANT_TIMEOUT = 5
+
+
+class RecordedTicket(Ticket):
+    # A ticket that reports its grant to a queue shared with the test
+
+    def __init__(self, tenant, priority, tokens, grants):
+        super().__init__(tenant, priority, tokens)
+        self.grants = grants
+
+    def grant(self):
+        super().grant()
+        self.grants.put(self)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LLMDispatcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def dispatcher(self, workers=1, tokens_per_minute=0):
+        return LLMDispatcher(workers=workers, tokens_per_minute=tokens_per_minute, clock=self.clock)
+
+    def assertGranted(self, ticket):
+        self.assertTrue(ticket._event.wait(GRANT_TIMEOUT), f"{ticket.tenant} was not granted a slot")
+        ticket._event.clear()
+
+    def test_interactive_calls_go_before_background_ones(self):
+        dispatcher = self.dispatcher()
+        running = Ticket('a', BACKGROUND, 0)
+        dispatcher.acquire(running)
+        background = Ticket('b', BACKGROUND, 0)
+        interactive = Ticket('c', INTERACTIVE, 0)
+        dispatcher.submit(background)
+        dispatcher.submit(interactive)
+
+        dispatcher.release(running)
+        self.assertGranted(interactive)
+        self.assertFalse(background.granted)
+        dispatcher.release(interactive)
+        self.assertGranted(background)
+
+    def test_tenants_take_turns(self):
+        dispatcher = self.dispatcher()
+        running = Ticket('x', INTERACTIVE, 0)
+        dispatcher.acquire(running)
+        grants = queue.Queue()
+        tickets = [RecordedTicket(tenant, INTERACTIVE, 0, grants) for tenant in 'aaab']
+        for ticket in tickets:
+            dispatcher.submit(ticket)
+
+        order = []
+        dispatcher.release(running)
+        for _ in tickets:
+            order.append(grants.get(timeout=GRANT_TIMEOUT))
+            dispatcher.release(order[-1])
+        self.assertEqual(order, [tickets[0], tickets[3], tickets[1], tickets[2]])
+
+    def test_calls_wait_for_the_token_budget(self):
+        dispatcher = self.dispatcher(workers=2, tokens_per_minute=100)
+        first = Ticket('a', INTERACTIVE, 60)
+        dispatcher.acquire(first)
+        dispatcher.release(first, tokens=70)
+        second = Ticket('a', INTERACTIVE, 40)
+        dispatcher.submit(second)
+
+        self.assertFalse(second._event.wait(0.2))
+        self.assertEqual(dispatcher.stats()['tokens_last_minute'], 70)
+        self.clock.now += BUDGET_WINDOW
+        dispatcher.backoff(0)  # wakes the dispatcher up
+        self.assertGranted(second)
+        self.assertEqual(dispatcher.stats()['tokens_last_minute'], 40)
+
+    def test_a_call_over_the_whole_budget_runs_alone(self):
+        dispatcher = self.dispatcher(workers=2, tokens_per_minute=100)
+        large = Ticket('a', INTERACTIVE, 500)
+        dispatcher.acquire(large)
+        self.assertTrue(large.granted)
+
+    def test_nothing_is_granted_while_backing_off(self):
+        dispatcher = self.dispatcher()
+        dispatcher.backoff(30)
+        ticket = Ticket('a', INTERACTIVE, 0)
+        dispatcher.submit(ticket)
+
+        self.assertFalse(ticket._event.wait(0.2))
+        self.clock.now += 30
+        dispatcher.backoff(0)
+        self.assertGranted(ticket)
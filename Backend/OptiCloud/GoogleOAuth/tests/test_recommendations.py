@@ -0,0 +1,110 @@
+import json
+
+from django.test import SimpleTestCase
+
+from ..recommendations import (
+    IncrementalObjectParser, StreamingRecommendations, make_template, narrate_instance, render_template,
+)
+
+ANSWER = json.dumps({
+    'Instances': {
+        'i-1': {'Optimization_Recommendations': {
+            'CPU_Utilization': {'Recommendation': 'Keep it {as is}, "quoted" too', 'Current_Usage': 12}
+        }},
+        'i-2': {'Optimization_Recommendations': {}, 'Notes': ['a } in a list', {'nested': '{'}]},
+    }
+})
+
+
+def cpu_entry(current, optimized):
+    return {
+        'Recommendation': f"CPU averages {current:.1f}%; downsizing would bring it to {optimized:.1f}%.",
+        'Current_Usage': current,
+        'Optimized_Usage': optimized,
+    }
+
+
+class IncrementalObjectParserTests(SimpleTestCase):
+
+    def feed(self, chunks):
+        parser = IncrementalObjectParser()
+        completed = []
+        for chunk in chunks:
+            completed += parser.feed(chunk)
+        return parser, completed
+
+    def test_braces_inside_strings_are_not_structure(self):
+        parser, completed = self.feed([ANSWER])
+        paths = [path for path, _ in completed]
+        self.assertIn(('Instances', 'i-1', 'Optimization_Recommendations', 'CPU_Utilization'), paths)
+        self.assertIn(('Instances', 'i-2'), paths)
+        self.assertEqual(paths[-1], ())
+        self.assertTrue(parser.done)
+        for path, raw in completed:
+            json.loads(raw)  # every reported object is whole
+
+    def test_any_split_gives_the_same_objects(self):
+        _, expected = self.feed([ANSWER])
+        for size in (1, 2, 3, 7, 50):
+            with self.subTest(size=size):
+                _, completed = self.feed([ANSWER[i:i + size] for i in range(0, len(ANSWER), size)])
+                self.assertEqual(completed, expected)
+
+    def test_a_chunk_ending_on_an_escape_keeps_the_string_open(self):
+        text = '{"a": "x\\"}", "b": {"c": 1}}'
+        split = text.index('\\') + 1
+        _, completed = self.feed([text[:split], text[split:]])
+        self.assertEqual([path for path, _ in completed], [('b',), ()])
+
+    def test_text_around_the_object_is_ignored(self):
+        parser, completed = self.feed(['```json\n{"a": {"b": 1}}', '\n``` and {"more": {}}'])
+        self.assertEqual([raw for _, raw in completed], ['{"b": 1}', '{"a": {"b": 1}}'])
+        self.assertTrue(parser.done)
+
+
+class StreamingRecommendationsTests(SimpleTestCase):
+
+    def test_collects_instances_and_metrics_as_they_complete(self):
+        stream = StreamingRecommendations(['i-1', 'i-2'])
+        self.assertFalse(stream.feed(ANSWER))
+        metric_events, completed = stream.drain()
+
+        self.assertEqual(stream.stop_reason, 'complete')
+        self.assertEqual(completed, ['i-1', 'i-2'])
+        self.assertEqual([(instance_id, metric) for instance_id, metric, _ in metric_events], [('i-1', 'CPU_Utilization')])
+        self.assertEqual(metric_events[0][2]['Current_Usage'], 12.0)
+
+    def test_stops_at_an_instance_that_was_not_asked_for(self):
+        stream = StreamingRecommendations(['i-1'])
+        self.assertFalse(stream.feed(ANSWER))
+        self.assertEqual(stream.stop_reason, "unexpected instance 'i-2' in the answer")
+        self.assertEqual(list(stream.result()['Instances']), ['i-1'])
+
+
+class TemplateTests(SimpleTestCase):
+
+    def test_wording_is_rendered_with_new_figures(self):
+        template = make_template("Averaging 12.4% CPU on an m5.large, it can drop to 6% after resizing.", cpu_entry(12.4, 6.2))
+        self.assertEqual(
+            render_template(template, cpu_entry(20.0, 9.96)),
+            "Averaging 20.0% CPU on an m5.large, it can drop to 10% after resizing."
+        )
+
+    def test_wording_with_other_numbers_is_rejected(self):
+        self.assertIsNone(make_template("CPU averages 12.9% and peaks at 80%.", cpu_entry(12.4, 6.2)))
+
+    def test_a_differently_shaped_draft_does_not_fit(self):
+        template = make_template("CPU averages 12.4%.", cpu_entry(12.4, 6.2))
+        entry = dict(cpu_entry(12.4, 6.2), Recommendation="Keep as is: CPU averages 12.4% over 30 days.")
+        self.assertIsNone(render_template(template, entry))
+
+    def test_unfitting_metrics_keep_their_draft(self):
+        document = {'Optimization_Recommendations': {'CPU_Utilization': cpu_entry(12.4, 6.2)}}
+        narrated, applied = narrate_instance(document, {})
+        self.assertEqual(narrated, document)
+        self.assertEqual(applied, {})
+
+        template = make_template("CPU sits at 12.4%.", cpu_entry(12.4, 6.2))
+        narrated, applied = narrate_instance(document, {'CPU_Utilization': template})
+        self.assertEqual(narrated['Optimization_Recommendations']['CPU_Utilization']['Recommendation'], "CPU sits at 12.4%.")
+        self.assertEqual(applied, {'CPU_Utilization': template})
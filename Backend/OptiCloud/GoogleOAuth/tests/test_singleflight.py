@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta, timezone
+
+from django.test import SimpleTestCase, override_settings
+
+from .. import singleflight
+from ..singleflight import LEASES_COLLECTION, acquire_lease, lease_is_held, release_lease, start_or_join
+from . import use_mongomock
+
+
+class StartOrJoinTests(SimpleTestCase):
+
+    def setUp(self):
+        singleflight._flights.clear()
+        self.addCleanup(singleflight._flights.clear)
+
+    def test_joins_the_flight_in_progress_and_replays_its_events(self):
+        flight, started = start_or_join('key', 'job-1')
+        flight.publish('progress', {'stage': 'collecting'})
+        events = []
+        joined, joined_started = start_or_join('key', 'job-2', lambda event, data: events.append(event))
+
+        self.assertTrue(started)
+        self.assertFalse(joined_started)
+        self.assertIs(joined, flight)
+        self.assertEqual(events, ['progress'])
+        flight.publish('done', {'job_id': 'job-1'})
+        self.assertEqual(events, ['progress', 'done'])
+
+    def test_a_landed_flight_is_not_joined(self):
+        flight, _ = start_or_join('key', 'job-1')
+        flight.publish('done', {'job_id': 'job-1'})
+        second, started = start_or_join('key', 'job-2')
+
+        self.assertTrue(started)
+        self.assertIsNot(second, flight)
+
+    @override_settings(OPTICLOUD_REFRESH_LEASE=0)
+    def test_a_flight_past_its_deadline_is_failed_and_replaced(self):
+        stale, _ = start_or_join('key', 'job-1')
+        events = []
+        stale.subscribe(lambda event, data: events.append((event, data)))
+        with self.assertLogs('GoogleOAuth.singleflight', 'WARNING'):
+            flight, started = start_or_join('key', 'job-2')
+
+        self.assertTrue(started)
+        self.assertIsNot(flight, stale)
+        self.assertEqual(flight.job_id, 'job-2')
+        self.assertTrue(stale.finished.is_set())
+        self.assertEqual(stale.error, 'The refresh timed out')
+        self.assertEqual(events, [('failed', {'job_id': 'job-1', 'error': 'The refresh timed out'})])
+        # Landing the stale flight must not unregister its replacement
+        self.assertIs(singleflight._flights['key'], flight)
+
+
+class LeaseTests(SimpleTestCase):
+
+    def setUp(self):
+        self.db = use_mongomock(self)
+
+    def test_a_held_lease_names_its_job(self):
+        self.assertIsNone(acquire_lease('key', 'job-1'))
+        # The upsert fails on the duplicate _id and reports the holder
+        self.assertEqual(acquire_lease('key', 'job-2'), 'job-1')
+        self.assertTrue(lease_is_held('key', 'job-1'))
+        self.assertFalse(lease_is_held('key', 'job-2'))
+
+    def test_an_expired_lease_is_taken_over(self):
+        self.db[LEASES_COLLECTION].insert_one({
+            '_id': 'key', 'job_id': 'job-1', 'holder': 'gone:1',
+            'lease_until': datetime.now(timezone.utc) - timedelta(seconds=1),
+        })
+        self.assertIsNone(acquire_lease('key', 'job-2'))
+        self.assertEqual(self.db[LEASES_COLLECTION].find_one({'_id': 'key'})['job_id'], 'job-2')
+        self.assertFalse(lease_is_held('key', 'job-1'))
+
+    def test_only_the_holder_releases_the_lease(self):
+        acquire_lease('key', 'job-1')
+        release_lease('key', 'job-2')
+        self.assertTrue(lease_is_held('key', 'job-1'))
+        release_lease('key', 'job-1')
+        self.assertIsNone(acquire_lease('key', 'job-2'))
@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta, timezone
+
+from django.test import SimpleTestCase
+from pymongo.errors import AutoReconnect
+
+from ..series import MetricSeries
+from ..timeseries import InMemoryDatapointStore, MongoDatapointStore, write_instance_metrics
+from . import use_mongomock
+
+# Recent enough not to be expired by the retention period
+MIDNIGHT = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=2)
+
+
+def hourly(hours, start=MIDNIGHT, minutes=0):
+    # One datapoint per hour, averaging the hour's index
+    return MetricSeries.from_datapoints([
+        {
+            'Timestamp': start + timedelta(hours=hour, minutes=minutes),
+            'Average': float(hour), 'Minimum': float(hour), 'Maximum': float(hour) + 1,
+            'Sum': float(hour) * 4, 'SampleCount': 4.0,
+        }
+        for hour in hours
+    ])
+
+
+class InMemoryDatapointStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.store = InMemoryDatapointStore()
+
+    def test_rollups_cover_every_bucket(self):
+        self.store.write('account', {('i-1', 'CPUUtilization'): hourly(range(30))})
+
+        hours = self.store.read_rollups('account', 'i-1', 'CPUUtilization', 'hour', MIDNIGHT)
+        days = self.store.read_rollups('account', 'i-1', 'CPUUtilization', 'day', MIDNIGHT)
+        self.assertEqual(len(hours), 30)
+        self.assertEqual(list(days.values('sample_count')), [24 * 4.0, 6 * 4.0])
+        self.assertEqual(list(days.values('average')), [11.5, 26.5])
+        self.assertEqual(list(days.values('minimum')), [0.0, 24.0])
+        self.assertEqual(list(days.values('maximum')), [24.0, 30.0])
+
+    def test_later_writes_recompute_the_buckets_they_touch(self):
+        self.store.write('account', {('i-1', 'CPUUtilization'): hourly(range(12))})
+        # A second datapoint within hour 11, and the rest of the day
+        written = self.store.write('account', {('i-1', 'CPUUtilization'): hourly(range(11, 24), minutes=30)})
+
+        self.assertEqual(written, 13)
+        hour = self.store.read_rollups('account', 'i-1', 'CPUUtilization', 'hour', MIDNIGHT + timedelta(hours=11), MIDNIGHT + timedelta(hours=11))
+        self.assertEqual(list(hour.values('sample_count')), [8.0])
+        days = self.store.read_rollups('account', 'i-1', 'CPUUtilization', 'day', MIDNIGHT)
+        self.assertEqual(list(days.values('sample_count')), [25 * 4.0])
+
+    def test_datapoints_already_stored_are_skipped(self):
+        self.store.write('account', {('i-1', 'CPUUtilization'): hourly(range(6))})
+        self.assertEqual(self.store.write('account', {('i-1', 'CPUUtilization'): hourly(range(6))}), 0)
+        self.assertEqual(len(self.store.read('account', 'i-1', 'CPUUtilization', MIDNIGHT)), 6)
+
+    def test_read_window_is_per_account(self):
+        self.store.write('account', {('i-1', 'CPUUtilization'): hourly(range(6)), ('i-1', 'NetworkIn'): hourly(range(3))})
+        self.store.write('other', {('i-2', 'CPUUtilization'): hourly(range(6))})
+
+        window = self.store.read_window('account', MIDNIGHT + timedelta(hours=4))
+        self.assertEqual(set(window), {('i-1', 'CPUUtilization')})
+        self.assertEqual(len(window[('i-1', 'CPUUtilization')]), 2)
+
+    def test_watermarks_only_move_forward(self):
+        self.store.set_watermarks('account', {('i-1', 'CPUUtilization'): MIDNIGHT + timedelta(hours=2)})
+        self.store.set_watermarks('account', {('i-1', 'CPUUtilization'): MIDNIGHT + timedelta(hours=1)})
+        self.assertEqual(self.store.get_watermarks('account'), {('i-1', 'CPUUtilization'): MIDNIGHT + timedelta(hours=2)})
+        self.assertEqual(self.store.get_watermarks('other'), {})
+
+
+class MongoDatapointStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.store = MongoDatapointStore(use_mongomock(self))
+
+    def test_watermarks_only_move_forward(self):
+        self.store.set_watermarks('account', {
+            ('i-1', 'CPUUtilization'): MIDNIGHT + timedelta(hours=2),
+            ('i-2', 'CPUUtilization'): MIDNIGHT,
+        })
+        self.store.set_watermarks('account', {('i-1', 'CPUUtilization'): MIDNIGHT + timedelta(hours=1)})
+        self.store.set_watermarks('other', {('i-1', 'CPUUtilization'): MIDNIGHT + timedelta(hours=5)})
+
+        self.assertEqual(self.store.get_watermarks('account'), {
+            ('i-1', 'CPUUtilization'): MIDNIGHT + timedelta(hours=2),
+            ('i-2', 'CPUUtilization'): MIDNIGHT,
+        })
+
+
+class FailingStore:
+
+    def write(self, account_id, series):
+        if account_id == 'down':
+            raise AutoReconnect('connection reset')
+        return sum(len(metric_series) for metric_series in series.values())
+
+
+class WriteInstanceMetricsTests(SimpleTestCase):
+
+    def test_reports_the_instances_that_could_not_be_stored(self):
+        instances = [
+            {'instance_id': 'i-1', 'account_id': 'up', 'metrics': {'CPUUtilization': hourly(range(3))}},
+            {'instance_id': 'i-2', 'account_id': 'down', 'metrics': {'CPUUtilization': hourly(range(3))}},
+            {'instance_id': 'i-3', 'account_id': 'down', 'metrics': {'CPUUtilization': MetricSeries()}},
+        ]
+        with self.assertLogs('GoogleOAuth.timeseries', 'ERROR'):
+            failed = write_instance_metrics(instances, FailingStore())
+        # i-3 had nothing to store
+        self.assertEqual(failed, {'i-2'})
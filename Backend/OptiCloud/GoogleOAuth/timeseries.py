@@ -0,0 +1,343 @@
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from django.conf import settings
+from pymongo import ASCENDING, InsertOne, UpdateOne
+from pymongo.errors import CollectionInvalid, ConnectionFailure, PyMongoError
+
+from .mongodb import create_index, get_database
+from .series import STAT_FIELDS, MetricSeries, from_epoch, to_epoch
+
+logger = logging.getLogger(__name__)
+
+
+DATAPOINTS_COLLECTION = 'metric_datapoints'
+ROLLUPS_COLLECTION = 'metric_rollups'
+WATERMARKS_COLLECTION = 'metric_watermarks'
+
+ROLLUP_GRANULARITIES = ['hour', 'day']
+
+
+def get_retention_days(granularity=None):
+    if granularity == 'hour':
+        return getattr(settings, 'OPTICLOUD_HOURLY_ROLLUP_RETENTION_DAYS', 90)
+    if granularity == 'day':
+        return getattr(settings, 'OPTICLOUD_DAILY_ROLLUP_RETENTION_DAYS', 730)
+    return getattr(settings, 'OPTICLOUD_DATAPOINT_RETENTION_DAYS', 14)
+
+
+def _utc(timestamp):
+    # pymongo hands back naive UTC datetimes; CloudWatch gives aware ones
+    return timestamp.replace(tzinfo=timezone.utc) if timestamp.tzinfo is None else timestamp.astimezone(timezone.utc)
+
+
+def _bucket_start(timestamp, granularity):
+    timestamp = _utc(timestamp)
+    if granularity == 'day':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def ensure_timeseries_collections(db=None):
+    # Raw datapoints go to a time-series collection that MongoDB expires on its own;
+    # rollups are ordinary documents with a TTL index on expires_at.
+    db = db if db is not None else get_database()
+    created = True
+    try:
+        db.create_collection(
+            DATAPOINTS_COLLECTION,
+            timeseries={'timeField': 'timestamp', 'metaField': 'meta', 'granularity': 'hours'},
+            expireAfterSeconds=get_retention_days() * 86400,
+        )
+    except CollectionInvalid:
+        pass  # already exists
+    except ConnectionFailure:
+        raise
+    except PyMongoError as e:
+        logger.error("Failed to create the %s time-series collection: %s", DATAPOINTS_COLLECTION, e)
+        created = False
+    rollups = db[ROLLUPS_COLLECTION]
+    return all([
+        created,
+        create_index(
+            rollups,
+            [('_id.account_id', ASCENDING), ('_id.instance_id', ASCENDING), ('_id.metric', ASCENDING),
+             ('_id.granularity', ASCENDING), ('_id.bucket', ASCENDING)],
+            name='series_bucket'
+        ),
+        create_index(rollups, [('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+        # Watermarks are looked up per account at the start of every refresh
+        create_index(db[WATERMARKS_COLLECTION], [('_id.account_id', ASCENDING)], name='account_id'),
+    ])
+
+
+class MongoDatapointStore:
+    # CloudWatch datapoints keyed by account / instance / metric, with hourly and daily
+    # rollups recomputed for the buckets touched by each write.
+
+    def __init__(self, db=None):
+        self._db = db
+
+    @property
+    def db(self):
+        return self._db if self._db is not None else get_database()
+
+    def write(self, account_id, series):
+        # series: {(instance_id, metric_name): MetricSeries}. Datapoints already stored for
+        # the same series and timestamp are skipped.
+        series = {key: metric_series for key, metric_series in series.items() if metric_series}
+        if not series:
+            return 0
+
+        start = from_epoch(min(metric_series.timestamps[0] for metric_series in series.values()))
+        end = from_epoch(max(metric_series.timestamps[-1] for metric_series in series.values()))
+        collection = self.db[DATAPOINTS_COLLECTION]
+        existing = {
+            (document['meta']['instance_id'], document['meta']['metric'], _utc(document['timestamp']))
+            for document in collection.find(
+                {'meta.account_id': account_id, 'timestamp': {'$gte': start, '$lte': end}},
+                {'meta': 1, 'timestamp': 1, '_id': 0}
+            )
+        }
+
+        operations = []
+        for (instance_id, metric_name), metric_series in series.items():
+            for datapoint in metric_series.datapoints():
+                if (instance_id, metric_name, datapoint['Timestamp']) in existing:
+                    continue
+                document = {
+                    'timestamp': datapoint['Timestamp'],
+                    'meta': {'account_id': account_id, 'instance_id': instance_id, 'metric': metric_name},
+                }
+                for stat, field in STAT_FIELDS.items():
+                    if stat in datapoint:
+                        document[field] = datapoint[stat]
+                operations.append(InsertOne(document))
+
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+            self.rollup(account_id, start, end)
+        return len(operations)
+
+    def rollup(self, account_id, start, end):
+        # Recompute every hourly and daily bucket overlapping [start, end] from raw datapoints
+        for granularity in ROLLUP_GRANULARITIES:
+            bucket_start = _bucket_start(start, granularity)
+            step = timedelta(days=1) if granularity == 'day' else timedelta(hours=1)
+            self.db[DATAPOINTS_COLLECTION].aggregate([
+                {'$match': {'meta.account_id': account_id, 'timestamp': {'$gte': bucket_start, '$lt': _bucket_start(end, granularity) + step}}},
+                {'$group': {
+                    '_id': {
+                        'account_id': '$meta.account_id',
+                        'instance_id': '$meta.instance_id',
+                        'metric': '$meta.metric',
+                        'granularity': granularity,
+                        'bucket': {'$dateTrunc': {'date': '$timestamp', 'unit': granularity}},
+                    },
+                    'minimum': {'$min': '$minimum'},
+                    'maximum': {'$max': '$maximum'},
+                    'sum': {'$sum': '$sum'},
+                    'sample_count': {'$sum': '$sample_count'},
+                }},
+                {'$set': {
+                    'average': {'$cond': [{'$gt': ['$sample_count', 0]}, {'$divide': ['$sum', '$sample_count']}, None]},
+                    'expires_at': {'$dateAdd': {'startDate': '$_id.bucket', 'unit': 'day', 'amount': get_retention_days(granularity)}},
+                }},
+                {'$merge': {'into': ROLLUPS_COLLECTION, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+            ])
+
+    def read(self, account_id, instance_id, metric_name, start, end=None):
+        query = {
+            'meta.account_id': account_id,
+            'meta.instance_id': instance_id,
+            'meta.metric': metric_name,
+            'timestamp': {'$gte': start} if end is None else {'$gte': start, '$lte': end},
+        }
+        series = MetricSeries()
+        for document in self.db[DATAPOINTS_COLLECTION].find(query, {'_id': 0, 'meta': 0}).sort('timestamp', ASCENDING):
+            series.append(to_epoch(document['timestamp']), document)
+        return series
+
+    def read_window(self, account_id, start, end=None):
+        # Every stored series of an account in one query: {(instance_id, metric): MetricSeries}
+        query = {
+            'meta.account_id': account_id,
+            'timestamp': {'$gte': start} if end is None else {'$gte': start, '$lte': end},
+        }
+        window = {}
+        for document in self.db[DATAPOINTS_COLLECTION].find(query, {'_id': 0}).sort('timestamp', ASCENDING):
+            key = (document['meta']['instance_id'], document['meta']['metric'])
+            if key not in window:
+                window[key] = MetricSeries()
+            window[key].append(to_epoch(document['timestamp']), document)
+        return window
+
+    def get_watermarks(self, account_id):
+        # {(instance_id, metric): time up to which CloudWatch has already been collected}
+        return {
+            (document['_id']['instance_id'], document['_id']['metric']): _utc(document['collected_until'])
+            for document in self.db[WATERMARKS_COLLECTION].find({'_id.account_id': account_id})
+        }
+
+    def set_watermarks(self, account_id, watermarks):
+        operations = [
+            UpdateOne(
+                {'_id': {'account_id': account_id, 'instance_id': instance_id, 'metric': metric_name}},
+                {'$max': {'collected_until': collected_until}},
+                upsert=True
+            )
+            for (instance_id, metric_name), collected_until in watermarks.items()
+        ]
+        if operations:
+            self.db[WATERMARKS_COLLECTION].bulk_write(operations, ordered=False)
+
+    def read_rollups(self, account_id, instance_id, metric_name, granularity, start, end=None):
+        query = {
+            '_id.account_id': account_id,
+            '_id.instance_id': instance_id,
+            '_id.metric': metric_name,
+            '_id.granularity': granularity,
+            '_id.bucket': {'$gte': start} if end is None else {'$gte': start, '$lte': end},
+        }
+        series = MetricSeries()
+        for document in self.db[ROLLUPS_COLLECTION].find(query).sort('_id.bucket', ASCENDING):
+            series.append(to_epoch(document['_id']['bucket']), document)
+        return series
+
+
+class InMemoryDatapointStore:
+    # Stand-in for MongoDatapointStore in tests and benchmarks; same interface and
+    # rollup semantics, no MongoDB required.
+
+    def __init__(self):
+        self._points = {}   # (account, instance, metric) -> MetricSeries
+        self._rollups = {}  # (account, instance, metric, granularity) -> {bucket: {field: value}}
+        self._watermarks = {}  # (account, instance, metric) -> collected_until
+        self._lock = threading.Lock()
+
+    def write(self, account_id, series):
+        written = 0
+        with self._lock:
+            for (instance_id, metric_name), metric_series in series.items():
+                key = (account_id, instance_id, metric_name)
+                stored, added = self._points.get(key, MetricSeries()).merge(metric_series)
+                self._points[key] = stored
+                written += added
+                if added:
+                    self._rollup(key, metric_series.timestamps[0])
+        return written
+
+    def _rollup(self, key, start):
+        # Recompute every hourly and daily bucket from the one holding `start` (seconds
+        # since the epoch) on; buckets are aligned to UTC like $dateTrunc
+        for granularity in ROLLUP_GRANULARITIES:
+            step = 86400 if granularity == 'day' else 3600
+            members = self._points[key].slice(start // step * step)
+            buckets = members.values('timestamps') // step * step
+            starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+            totals = np.add.reduceat(np.nan_to_num(members.values('sum')), starts)
+            samples = np.add.reduceat(np.nan_to_num(members.values('sample_count')), starts)
+            minimums = np.fmin.reduceat(members.values('minimum'), starts)
+            maximums = np.fmax.reduceat(members.values('maximum'), starts)
+            stored = self._rollups.setdefault(key + (granularity,), {})
+            for index, bucket in enumerate(buckets[starts].tolist()):
+                rollup = {'sum': float(totals[index]), 'sample_count': float(samples[index])}
+                if samples[index]:
+                    rollup['average'] = rollup['sum'] / rollup['sample_count']
+                if not np.isnan(minimums[index]):
+                    rollup['minimum'] = float(minimums[index])
+                if not np.isnan(maximums[index]):
+                    rollup['maximum'] = float(maximums[index])
+                stored[bucket] = rollup
+
+    def _expire(self, now=None):
+        now = now or datetime.now(timezone.utc)
+        cutoff = to_epoch(now - timedelta(days=get_retention_days()))
+        for key, stored in self._points.items():
+            if stored and stored.timestamps[0] < cutoff:
+                self._points[key] = stored.slice(cutoff)
+        for key, stored in self._rollups.items():
+            cutoff = to_epoch(now - timedelta(days=get_retention_days(key[3])))
+            for bucket in [bucket for bucket in stored if bucket < cutoff]:
+                del stored[bucket]
+
+    def read(self, account_id, instance_id, metric_name, start, end=None):
+        with self._lock:
+            self._expire()
+            stored = self._points.get((account_id, instance_id, metric_name), MetricSeries())
+            return stored.slice(to_epoch(start), None if end is None else to_epoch(end))
+
+    def read_window(self, account_id, start, end=None):
+        with self._lock:
+            self._expire()
+            window = {}
+            for (account, instance_id, metric_name), stored in self._points.items():
+                if account != account_id:
+                    continue
+                series = stored.slice(to_epoch(start), None if end is None else to_epoch(end))
+                if series:
+                    window[(instance_id, metric_name)] = series
+            return window
+
+    def get_watermarks(self, account_id):
+        with self._lock:
+            return {
+                (instance_id, metric_name): collected_until
+                for (account, instance_id, metric_name), collected_until in self._watermarks.items()
+                if account == account_id
+            }
+
+    def set_watermarks(self, account_id, watermarks):
+        with self._lock:
+            for (instance_id, metric_name), collected_until in watermarks.items():
+                key = (account_id, instance_id, metric_name)
+                current = self._watermarks.get(key)
+                self._watermarks[key] = collected_until if current is None else max(current, collected_until)
+
+    def read_rollups(self, account_id, instance_id, metric_name, granularity, start, end=None):
+        with self._lock:
+            self._expire()
+            stored = self._rollups.get((account_id, instance_id, metric_name, granularity), {})
+            series = MetricSeries()
+            for bucket in sorted(stored):
+                if bucket >= to_epoch(start) and (end is None or bucket <= to_epoch(end)):
+                    series.append(bucket, stored[bucket])
+            return series
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_datapoint_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if getattr(settings, 'OPTICLOUD_DATAPOINT_STORE', 'mongo') == 'memory':
+                    _store = InMemoryDatapointStore()
+                else:
+                    _store = MongoDatapointStore()
+    return _store
+
+
+def write_instance_metrics(instances, store=None):
+    # Persist collector instance records, grouped per account. Returns the ids of the
+    # instances whose datapoints could not be stored.
+    store = store or get_datapoint_store()
+    by_account = {}
+    for instance in instances:
+        series = by_account.setdefault(instance.get('account_id'), {})
+        for metric_name, metric_series in instance['metrics'].items():
+            if metric_series:
+                series[(instance['instance_id'], metric_name)] = metric_series
+    failed = set()
+    for account_id, series in by_account.items():
+        try:
+            store.write(account_id, series)
+        except PyMongoError as e:
+            logger.error("Failed to store datapoints for account %s: %s", account_id, e)
+            failed.update(instance_id for instance_id, _ in series)
+    return failed
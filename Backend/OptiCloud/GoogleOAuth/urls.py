@@ -17,7 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from django.urls import include  # Make sure to include 'include'
-from . import views
+from . import async_views, views
 
 
 urlpatterns = [
@@ -26,6 +26,21 @@ urlpatterns = [
     path('api/receive-role-arn/', views.receive_role_arn, name='receive_role_arn'),
     path('api/get-user-role-arn/', views.get_user_role_arn, name='get_user_role_arn'),
     path('api/get-user-metrics/', views.get_user_metrics, name='get-user-metrics'),
+    path('api/user-metrics/<str:user_id>/', views.get_user_metrics_cached, name='user-metrics'),
+    path('api/get-metric-history/', views.get_metric_history, name='get-metric-history'),
+    path('api/fleet/<str:user_id>/', views.get_fleet, name='fleet'),
+    path('api/refresh-stream/', views.refresh_stream, name='refresh-stream'),
+    path('api/refresh-jobs/<str:job_id>/', views.refresh_job_status, name='refresh-job-status'),
     path('user-data/', views.user_data_view, name='user-data'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    # Async versions of the API for asgi.py
+    path('api/async/receive-role-arn/', async_views.receive_role_arn, name='async-receive-role-arn'),
+    path('api/async/get-user-role-arn/', async_views.get_user_role_arn, name='async-get-user-role-arn'),
+    path('api/async/get-user-metrics/', async_views.get_user_metrics, name='async-get-user-metrics'),
+    path('api/async/user-metrics/<str:user_id>/', async_views.get_user_metrics_cached, name='async-user-metrics'),
+    path('api/async/get-metric-history/', async_views.get_metric_history, name='async-get-metric-history'),
+    path('api/async/fleet/<str:user_id>/', async_views.get_fleet, name='async-fleet'),
+    path('api/async/refresh-jobs/<str:job_id>/', async_views.refresh_job_status, name='async-refresh-job-status'),
+    path('api/async/user-data/', async_views.user_data_view, name='async-user-data'),
     # path('api/generate-text/', views.generate_text_from_gpt, name='generate-text'),
 ]
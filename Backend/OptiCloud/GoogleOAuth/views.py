@@ -1,16 +1,29 @@
 # views.py
-from django.http import JsonResponse
+import logging
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from .mongodb import insert_user_data
 from django.views.decorators.csrf import csrf_exempt
 import json
-import boto3
-from datetime import datetime, timedelta
 from .mongodb import get_database
-from bson import ObjectId  # For handling MongoDB ObjectId
-import requests
+from .jobs import enqueue_refresh, get_job
+from .fleet import FleetQueryError, query_fleet
+from .recommendations import is_valid_field_name
+from .aws import get_account_id
+from .timeseries import get_datapoint_store
+from datetime import datetime, timedelta, timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.core.serializers.json import DjangoJSONEncoder
+from .aio import ProgressQueue
+from .instrumentation import registry
+from .singleflight import FINAL_EVENTS
+import queue
+import threading
 from django.views.decorators.http import require_http_methods
-import os
-import openai
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -34,13 +47,12 @@ def get_user_role_arn(request):
 
 
             if user and 'roleArn' in user:
-                # Return the roleArn if found
-                customer_credentials = assume_customer_role(user['roleArn'])
-                ec2_metrics = get_ec2_metrics_for_all_instances(customer_credentials)
-                        # Update the user's roleArn
-                print("Done")
-                collection.update_one({"id": user_id}, {"$set": {"aws_metrics": ec2_metrics}})
-                return JsonResponse({'roleArn': user['roleArn']}, status=200)
+                # Return the roleArn if found and refresh the metrics in the background,
+                # unless the caller follows the refresh through refresh-stream instead
+                if not body.get('refresh', True):
+                    return JsonResponse({'roleArn': user['roleArn']}, status=200)
+                job_id = enqueue_refresh(user['roleArn'], user_id)
+                return JsonResponse({'roleArn': user['roleArn'], 'job_id': job_id}, status=202)
             else:
                 # User or roleArn not found
                 return JsonResponse({'message': 'User or Role ARN not found'}, status=404)
@@ -48,40 +60,128 @@ def get_user_role_arn(request):
         except json.JSONDecodeError:
             return JsonResponse({'message': 'Invalid JSON'}, status=400)
         except Exception as e:
-            print(f"Error fetching Role ARN: {e}")
+            logger.exception("Error fetching Role ARN")
             return JsonResponse({'message': 'Internal server error', 'error': str(e)}, status=500)
     else:
         return JsonResponse({'message': 'Method not allowed'}, status=405)
 
+NOT_FOUND = object()
+
+
+def get_metrics_field(instance_id=None, metric=None):
+    # Projection path for the whole document, one instance, or one metric of an instance
+    if (instance_id and not is_valid_field_name(instance_id)) or (metric and not is_valid_field_name(metric)):
+        return None
+    if metric and not instance_id:
+        return None
+    field = 'aws_metrics'
+    if instance_id:
+        field += f'.instances.{instance_id}'
+    if metric:
+        field += f'.Optimization_Recommendations.{metric}'
+    return field
+
+
+def read_user_metrics(user_id, field, instance_id=None, metric=None):
+    # Metrics are stored already parsed, so fetch only the requested part
+    collection = get_database()['test_collection']
+    user = collection.find_one({"id": user_id, field: {"$exists": True}}, {field: 1, "_id": 0})
+    if not user:
+        return NOT_FOUND
+    aws_metrics = user['aws_metrics']
+    if instance_id:
+        aws_metrics = aws_metrics['instances'][instance_id]
+    if metric:
+        aws_metrics = aws_metrics['Optimization_Recommendations'][metric]
+    return aws_metrics
+
+
+def find_metrics_version(user_id, field):
+    # The fields behind the ETag and Last-Modified, if the user has the requested part
+    return get_database()['test_collection'].find_one(
+        {"id": user_id, field: {"$exists": True}},
+        {"aws_metrics_version": 1, "aws_metrics_updated_at": 1, "_id": 0}
+    )
+
+
+def metrics_validators(user, instance_id=None, metric=None):
+    # (ETag, Last-Modified timestamp or None) of a read of the stored metrics
+    version = user.get('aws_metrics_version', 0)
+    etag = quote_etag(f"{version}:{instance_id or ''}:{metric or ''}")
+    updated_at = user.get('aws_metrics_updated_at')
+    last_modified = updated_at.replace(tzinfo=timezone.utc).timestamp() if updated_at else None
+    return etag, last_modified
+
+
+def set_metrics_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # Let the browser keep the body but revalidate it on every use
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+# Metric history reaches back at most this many days (hourly rollups are kept 90 days
+# by default)
+MAX_HISTORY_DAYS = 90
+
+
+class HistoryQueryError(ValueError):
+    pass
+
+
+def parse_history_query(body):
+    # (user_id, instance_id, metric, granularity, start_time) of a metric history
+    # request; raises HistoryQueryError with the message for a 400
+    user_id = body.get('user_id')
+    instance_id = body.get('instance_id')
+    metric = body.get('metric')
+    granularity = body.get('granularity', 'hour')  # 'raw', 'hour' or 'day'
+    if not user_id or not instance_id or not metric:
+        raise HistoryQueryError('User ID, instance ID and metric are required')
+    if granularity not in ('raw', 'hour', 'day'):
+        raise HistoryQueryError('Invalid granularity')
+    try:
+        days = int(body.get('days', 7))
+    except (TypeError, ValueError):
+        raise HistoryQueryError('days must be a whole number')
+    if not 1 <= days <= MAX_HISTORY_DAYS:
+        raise HistoryQueryError(f'days must be between 1 and {MAX_HISTORY_DAYS}')
+    return user_id, instance_id, metric, granularity, datetime.now(timezone.utc) - timedelta(days=days)
+
+
+def read_metric_history(role_arn, instance_id, metric, granularity, start_time):
+    # Datapoints are stored per AWS account, taken from the user's role ARN
+    account_id = get_account_id(role_arn)
+    store = get_datapoint_store()
+    if granularity == 'raw':
+        series = store.read(account_id, instance_id, metric, start_time)
+    else:
+        series = store.read_rollups(account_id, instance_id, metric, granularity, start_time)
+    return list(series.datapoints())
+
+
 @csrf_exempt
 def get_user_metrics(request):
     if request.method == 'POST':
         try:
             # Parse the JSON body from the request
-            print ("the request is",request)
             body = json.loads(request.body)
             user_id = body.get('user_id')  # Extract the user_id from the request
 
             if not user_id:
                 return JsonResponse({'message': 'User ID not provided'}, status=400)
 
-            # Access the MongoDB database and collection
-            db = get_database()
-            collection = db['test_collection']  # Your MongoDB collection
-
-            # Find the user by their 'id' field (not '_id')
-            user = collection.find_one({"id": user_id})
-
+            # Optionally narrow the read down to one instance, or one metric of it
+            instance_id = body.get('instance_id')
+            metric = body.get('metric')
+            field = get_metrics_field(instance_id, metric)
+            if field is None:
+                return JsonResponse({'message': 'Invalid instance or metric'}, status=400)
 
-            if user and 'aws_metrics' in user:
-                # Return the metrics if found
-                try:
-                    aws_metrics = json.loads(user['aws_metrics'])  # Assuming it's stored as a string
-                    print("Returning this:",aws_metrics)
-                except (TypeError, json.JSONDecodeError):
-                    # If aws_metrics is already a dictionary, no need to parse
-                    aws_metrics = user['aws_metrics']
-                    print("Returning this:",aws_metrics)
+            aws_metrics = read_user_metrics(user_id, field, instance_id, metric)
+            if aws_metrics is not NOT_FOUND:
                 return JsonResponse({'aws_metrics': aws_metrics}, status=200)
             else:
                 # User or roleArn not found
@@ -90,11 +190,190 @@ def get_user_metrics(request):
         except json.JSONDecodeError:
             return JsonResponse({'message': 'Invalid JSON'}, status=400)
         except Exception as e:
-            print(f"Error fetching Role ARN: {e}")
+            logger.exception("Error fetching Role ARN")
+            return JsonResponse({'message': 'Internal server error', 'error': str(e)}, status=500)
+    else:
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+
+@csrf_exempt
+def get_metric_history(request):
+    if request.method == 'POST':
+        try:
+            user_id, instance_id, metric, granularity, start_time = parse_history_query(json.loads(request.body))
+
+            user = get_database()['test_collection'].find_one({"id": user_id}, {"roleArn": 1})
+            if not user or 'roleArn' not in user:
+                return JsonResponse({'message': 'User or Role ARN not found'}, status=404)
+
+            datapoints = read_metric_history(user['roleArn'], instance_id, metric, granularity, start_time)
+            return JsonResponse({'datapoints': datapoints}, status=200)
+
+        except HistoryQueryError as e:
+            return JsonResponse({'message': str(e)}, status=400)
+        except json.JSONDecodeError:
+            return JsonResponse({'message': 'Invalid JSON'}, status=400)
+        except Exception as e:
+            logger.exception("Error fetching metric history")
             return JsonResponse({'message': 'Internal server error', 'error': str(e)}, status=500)
     else:
         return JsonResponse({'message': 'Method not allowed'}, status=405)
 
+# Cacheable read of the stored metrics: the ETag follows the document version, so an
+# unchanged document costs one small query and a 304 instead of a full read.
+def get_user_metrics_cached(request, user_id):
+    if request.method != 'GET':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+
+    instance_id = request.GET.get('instance_id')
+    metric = request.GET.get('metric')
+    field = get_metrics_field(instance_id, metric)
+    if field is None:
+        return JsonResponse({'message': 'Invalid instance or metric'}, status=400)
+
+    user = find_metrics_version(user_id, field)
+    if not user:
+        return JsonResponse({'message': 'User or Metrics not found'}, status=404)
+
+    etag, last_modified = metrics_validators(user, instance_id, metric)
+    # Only the ETag decides a 304: Last-Modified has a resolution of one second, and a
+    # refresh can write several times within one
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        aws_metrics = read_user_metrics(user_id, field, instance_id, metric)
+        if aws_metrics is NOT_FOUND:
+            return JsonResponse({'message': 'User or Metrics not found'}, status=404)
+        response = JsonResponse({'aws_metrics': aws_metrics}, status=200)
+    return set_metrics_validators(response, etag, last_modified)
+
+# One page of a user's instances, filtered and sorted in MongoDB:
+#   GET api/fleet/<user_id>/?region=&instance_type=&action=&max_cpu_p95=&min_savings=
+#       &sort=-savings_percent&limit=50&cursor=
+# next_cursor in the response fetches the following page.
+def get_fleet(request, user_id):
+    if request.method != 'GET':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+    try:
+        return JsonResponse(query_fleet(user_id, request.GET), status=200)
+    except FleetQueryError as e:
+        return JsonResponse({'message': str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Error querying the fleet")
+        return JsonResponse({'message': 'Internal server error', 'error': str(e)}, status=500)
+
+# Server-sent events for one refresh: per-stage progress and per-instance results as
+# they become available. The refresh runs on the job pool and hands its events over
+# through a ProgressQueue. Under asgi.py the stream is an async generator and holds no
+# thread while it waits. Under WSGI (runserver, gunicorn) it is a plain generator, and
+# every open stream holds one of the server's threads for the whole refresh, so a
+# process serves at most OPTICLOUD_WSGI_REFRESH_STREAMS of them; past that the client
+# gets a 503 and follows the refresh by polling refresh-jobs instead.
+def refresh_stream(request):
+    if request.method != 'GET':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+
+    user_id = request.GET.get('user_id')
+    if not user_id:
+        return JsonResponse({'message': 'User ID not provided'}, status=400)
+
+    user = get_database()['test_collection'].find_one({"id": user_id}, {"roleArn": 1})
+    if not user or 'roleArn' not in user:
+        return JsonResponse({'message': 'User or Role ARN not found'}, status=404)
+
+    asgi = isinstance(request, ASGIRequest)
+    if not asgi and not claim_stream_slot():
+        response = JsonResponse({
+            'message': 'Too many refresh streams, start the refresh with get-user-role-arn '
+                       'and poll refresh-jobs for its job instead'
+        }, status=503)
+        response['Retry-After'] = str(SSE_KEEPALIVE)
+        return response
+
+    events = ProgressQueue()
+    try:
+        job_id = enqueue_refresh(user['roleArn'], user_id, progress=events)
+    except Exception:
+        if not asgi:
+            release_stream_slot()
+        raise
+    stream = aevent_stream(job_id, events) if asgi else WSGIEventStream(job_id, events)
+
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Seconds without an event after which the stream sends a comment line, which keeps
+# proxies from closing it
+SSE_KEEPALIVE = 15
+
+# Refresh streams open in this process under WSGI
+_wsgi_streams = 0
+_wsgi_streams_lock = threading.Lock()
+
+
+def claim_stream_slot():
+    global _wsgi_streams
+    with _wsgi_streams_lock:
+        if _wsgi_streams >= getattr(settings, 'OPTICLOUD_WSGI_REFRESH_STREAMS', 4):
+            return False
+        _wsgi_streams += 1
+        return True
+
+
+def release_stream_slot():
+    global _wsgi_streams
+    with _wsgi_streams_lock:
+        _wsgi_streams -= 1
+
+
+class WSGIEventStream:
+    # event_stream() holding a stream slot until Django closes the response, which it
+    # also does when the client goes away before the refresh ends
+
+    def __init__(self, job_id, events):
+        self.stream = event_stream(job_id, events)
+        self.closed = False
+
+    def __iter__(self):
+        return self.stream
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.stream.close()
+            release_stream_slot()
+
+
+def event_stream(job_id, events):
+    yield format_sse('queued', {'job_id': job_id})
+    while True:
+        try:
+            event, data = events.get(SSE_KEEPALIVE)
+        except queue.Empty:
+            yield ': keep-alive\n\n'
+            continue
+        yield format_sse(event, data)
+        if event in FINAL_EVENTS:
+            break
+
+
+async def aevent_stream(job_id, events):
+    yield format_sse('queued', {'job_id': job_id})
+    while True:
+        try:
+            event, data = await events.aget(SSE_KEEPALIVE)
+        except queue.Empty:
+            yield ': keep-alive\n\n'
+            continue
+        yield format_sse(event, data)
+        if event in FINAL_EVENTS:
+            break
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
 # update roleArn for a user
 def update_user_role_arn(user_id, role_arn):
     db = get_database()
@@ -112,75 +391,9 @@ def update_user_role_arn(user_id, role_arn):
         return False
 
     except Exception as e:
-        print(f"Error updating user role ARN: {e}")
+        logger.error("Error updating user role ARN: %s", e)
         return False
 
-@csrf_exempt
-def generate_text_from_gpt(final_output):
-    try:
-        # Parse the JSON data from request.body
-        print("final output is ",final_output)
-        # Prepare the prompt
-        prompt = r"""You are an AWS optimization and sustainability expert. Given the following CloudWatch metrics for an EC2 instance, provide specific recommendations to optimize resource usage and reduce the carbon footprint. The recommendations should target improvements in CPU, network usage, disk I/O, and overall health checks of the instance.
-
-For each metric, analyze the provided data and offer actionable steps to minimize resource consumption, identify idle resources, and suggest cost-efficient scaling or resizing. Also, recommend any AWS-specific features, such as auto-scaling, instance scheduling, or using more efficient instance types. Make your suggestions clear, concise, and focused on reducing carbon emissions and optimizing energy usage. Please keep the current usage and optimized usage to a single number since it will be visualized. the recommendation has to be one line strictly
-
-In addition, provide suggestions for what should be done for each metric and ensure that your output includes a very specific numeric metric summary that will be consistent each time so that they can be easily parsed. Follow the exact structure and format outlined below but the return file should be in JSON format with Current_Usage:  and Optimized_Usage: being strictly numbers and only numbers
-
-{final_output}
-Provide your response in the following specific format:
-{
-  'Optimization_Recommendations': {
-    'CPU_Utilization': {
-      'Recommendation': 'The average CPU usage is very low at 1.64%. Consider switching to a t3.micro instance or enabling auto-scaling to adapt to demand fluctuations.',
-      'Current_Usage': 1.64,
-      'Optimized_Usage': 0.5
-    },
-    'Disk_IO': {
-      'Recommendation': 'No disk operations detected. Review and detach unused EBS volumes to reduce costs and energy consumption.',
-      'Current_Usage': 0,
-      'Optimized_Usage': 0
-    },
-    'Network_Usage': {
-      'Recommendation': 'Network traffic shows consistent usage at 300 bytes per second on average. Implement VPC Endpoints and review data transfer to minimize unnecessary traffic.',
-      'Current_Usage': 300,
-      'Optimized_Usage': 150
-    },
-    'Instance_Health': {
-      'Recommendation': 'All health checks are passing. Implement instance scheduling to shut down the instance during non-peak hours to save energy.',
-      'Current_Usage': 100,
-      'Optimized_Usage': 50
-    }
-  },
-  'Carbon_Footprint_Reduction': {
-    'Reduction_Percentage': 30
-  }
-}"""
-
-        # API URL and key
-        api_url = "https://api.openai.com/v1/engines/davinci-codex/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}"
-        }
-
-        # Sending POST request to GPT-3.5
-
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "user", "content": f"{prompt}"}
-            ],
-            max_tokens=4096,
-            temperature=0.5,
-        )
-        refined_text = response.choices[0].message.content
-        print(refined_text)
-        return refined_text
-    except Exception as e:
-        print(e)
-        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
-
 @csrf_exempt
 def user_data_view(request):
     if request.method == 'OPTIONS':
@@ -194,7 +407,7 @@ def user_data_view(request):
             user_data['_id'] = str(user_id)
             return JsonResponse({'status': 'Success', 'data': user_data})
         except Exception as e:
-            print(e)
+            logger.warning("Failed to store user data: %s", e)
             return JsonResponse({'status': 'Error', 'message': str(e)}, status=400)
     else:
         return JsonResponse({'status': 'Error', 'message': 'Method not allowed'}, status=405)
@@ -229,156 +442,19 @@ def receive_role_arn(request):
 
 
             # Perform any logic with the role ARN (save it, process it, etc.)
-            print(f"Received Role ARN: {role_arn}")
-
-            customer_credentials = assume_customer_role(role_arn)
-            print("CC: ", customer_credentials)
-            if customer_credentials:
-                # Step 3: Use the customer's credentials to interact with EC2 and CloudWatch
-                ec2_metrics = get_ec2_metrics_for_all_instances(customer_credentials)
-                db = get_database()
-                print(db)
-                print(user_id)
-                collection = db['test_collection']
-                print(collection)
-                try:
-                    user = collection.find_one({"id": str(user_id)})
-                    print(user)
-                    collection.update_one({"id": user_id}, {"$set": {"aws_metrics": ec2_metrics}})
-                except e:
-                    print(e)
-                
-            else:
-                print("Could not assume role, please check the role ARN and permissions.")
+            logger.info("Received Role ARN for user %s", user_id)
+
+            # Assume the role, collect metrics and generate recommendations in the background
+            job_id = enqueue_refresh(role_arn, user_id, fresh_credentials=True)
 
             # Send a success response back to the client
-            return JsonResponse({'message': 'Role ARN received successfully'})
+            return JsonResponse({'message': 'Role ARN received successfully', 'job_id': job_id}, status=202)
 
         except json.JSONDecodeError:
             return JsonResponse({'message': 'Invalid JSON'}, status=400)
     else:
         return JsonResponse({'message': 'Method not allowed'}, status=405)
 
-# Function to assume the customer's IAM role and get temporary credentials
-def assume_customer_role(customer_role_arn):
-    sts_client = boto3.client('sts')  # Using OptiCloud's AWS credentials
-    try:
-        assumed_role = sts_client.assume_role(
-            RoleArn=customer_role_arn,  # Customer-provided role ARN
-            RoleSessionName="OptiCloudSession"
-        )
-        # Extract the temporary credentials from the response
-        credentials = assumed_role['Credentials']
-        return {
-            'access_key': credentials['AccessKeyId'],
-            'secret_key': credentials['SecretAccessKey'],
-            'session_token': credentials['SessionToken']
-        }
-    except boto3.exceptions.Boto3Error as e:
-        print(f"Failed to assume role: {e}")
-        return None
-
-# Function to create an AWS client using the customer's temporary credentials
-def create_customer_client(service_name, customer_credentials):
-    return boto3.client(
-        service_name,
-        aws_access_key_id=customer_credentials['access_key'],
-        aws_secret_access_key=customer_credentials['secret_key'],
-        aws_session_token=customer_credentials['session_token']
-    )
-
-def get_ec2_instance_ids(customer_credentials):
-    ec2_client = create_customer_client('ec2', customer_credentials)
-
-    try:
-        response = ec2_client.describe_instances()
-        instance_ids = []
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                instance_ids.append(instance['InstanceId'])
-        return instance_ids
-    except boto3.exceptions.Boto3Error as e:
-        print(f"Failed to fetch EC2 instances: {e}")
-        return []
-
-# Use the instance IDs to get CloudWatch metrics
-def get_ec2_metrics_for_all_instances(customer_credentials):
-    instance_ids = get_ec2_instance_ids(customer_credentials)
-    
-    if not instance_ids:
-        print("No EC2 instances found.")
-        return
-    
-    cloudwatch_client = create_customer_client('cloudwatch', customer_credentials)
-
-    # Define start and end times dynamically in UTC
-    end_time = datetime.utcnow()
-    start_time = end_time - timedelta(days=1)  # 24 hours before end time
-
-    # List of metrics to retrieve
-    metrics_to_fetch = [
-        'CPUUtilization',
-        'DiskReadOps',
-        'DiskWriteOps',
-        'DiskReadBytes',
-        'DiskWriteBytes',
-        'NetworkIn',
-        'NetworkOut',
-        'StatusCheckFailed',
-        'StatusCheckFailed_Instance',
-        'StatusCheckFailed_System'
-    ]
-
-    # Initialize a list to collect all the output strings
-    output = []
-
-    for instance_id in instance_ids:
-        instance_output = f"Metrics for EC2 instance {instance_id}:\n"
-        
-        for metric_name in metrics_to_fetch:
-            try:
-                response = cloudwatch_client.get_metric_statistics(
-                    Namespace='AWS/EC2',
-                    MetricName=metric_name,
-                    Dimensions=[
-                        {
-                            'Name': 'InstanceId',
-                            'Value': instance_id
-                        }
-                    ],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=3600,
-                    Statistics=['Average', 'Minimum', 'Maximum', 'Sum', 'SampleCount']
-                )
-
-                # If there are data points, add them to the output
-                if response['Datapoints']:
-                    instance_output += f"\nMetric: {metric_name}\n"
-                    for datapoint in sorted(response['Datapoints'], key=lambda x: x['Timestamp']):
-                        instance_output += (
-                            f"Time: {datapoint['Timestamp']}, "
-                            f"Avg: {datapoint.get('Average', 'N/A')}, "
-                            f"Min: {datapoint.get('Minimum', 'N/A')}, "
-                            f"Max: {datapoint.get('Maximum', 'N/A')}, "
-                            f"Sum: {datapoint.get('Sum', 'N/A')}, "
-                            f"SampleCount: {datapoint.get('SampleCount', 'N/A')}\n"
-                        )
-                else:
-                    instance_output += f"No data found for metric: {metric_name}\n"
-
-            except boto3.exceptions.Boto3Error as e:
-                instance_output += f"Failed to fetch metric {metric_name} for instance {instance_id}: {e}\n"
-
-        # Add the instance's metrics to the output list
-        output.append(instance_output)
-
-    # Combine all collected output into a single string
-    final_output = "\n".join(output)
-    print(final_output)
-    response = generate_text_from_gpt(final_output)
-    return response
-
 @csrf_exempt
 def get_cloudwatch_metrics(request):
     if request.method == 'POST':
@@ -386,13 +462,31 @@ def get_cloudwatch_metrics(request):
         roleArn = json.loads(request.body).get('roleArn')
 
         if roleArn:
-            # Fetch metrics
-            customer_credentials = assume_customer_role(roleArn)
-            metrics_data = get_ec2_metrics_for_all_instances(customer_credentials)
-
-            # Return the metrics data as JSON
-            return JsonResponse(metrics_data, safe=False)
+            # Fetch metrics in the background; the result is available from the job status
+            job_id = enqueue_refresh(roleArn)
+            return JsonResponse({'job_id': job_id}, status=202)
         else:
             return JsonResponse({"error": "No credentials provided"}, status=400)
 
     return JsonResponse({"error": "Invalid request method"}, status=405)
+
+# Prometheus scrape endpoint: stage latency histograms and call/error/throttle/byte
+# counters of this worker process
+def metrics_view(request):
+    if request.method != 'GET':
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
+    token = getattr(settings, 'OPTICLOUD_METRICS_TOKEN', '')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return JsonResponse({'message': 'Forbidden'}, status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@csrf_exempt
+def refresh_job_status(request, job_id):
+    if request.method == 'GET':
+        job = get_job(job_id)
+        if not job:
+            return JsonResponse({'message': 'Job not found'}, status=404)
+        job['job_id'] = job.pop('_id')
+        return JsonResponse(job, status=200)
+    else:
+        return JsonResponse({'message': 'Method not allowed'}, status=405)
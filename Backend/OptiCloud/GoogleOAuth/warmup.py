@@ -0,0 +1,69 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .aws import preload_service_models
+from .llm import get_client as get_openai_client
+from .mongodb import get_client as get_mongo_client
+
+logger = logging.getLogger(__name__)
+
+
+# Work a fresh worker would otherwise do on its first requests: boto3 and openai are only
+# imported when first used (a good part of a second together), each AWS service model is
+# read from disk on its first client, and MongoDB connections are opened (DNS, TLS, auth)
+# when a request needs one. With OPTICLOUD_WARMUP, wsgi.py / asgi.py run it before the
+# worker serves traffic. A failing step is logged and skipped; it never stops a worker
+# from starting.
+
+
+def warm_mongo_pool():
+    # Concurrent pings, so the pool holds up to OPTICLOUD_WARMUP_CONNECTIONS connections
+    connections = max(1, getattr(settings, 'OPTICLOUD_WARMUP_CONNECTIONS', 4))
+    client = get_mongo_client()
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        list(executor.map(lambda _: client.admin.command('ping'), range(connections)))
+
+
+def warm_aws():
+    preload_service_models()
+
+
+def warm_openai():
+    # Imports openai and builds the sync client; async clients are per event loop, but
+    # they only need the import
+    get_openai_client()
+
+
+WARMUP_STEPS = (
+    ('mongodb', warm_mongo_pool),
+    ('aws', warm_aws),
+    ('openai', warm_openai),
+)
+
+
+def warm_up():
+    # {step: seconds} of the steps that succeeded
+    timings = {}
+    started = time.perf_counter()
+    for name, step in WARMUP_STEPS:
+        step_started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning("Warm-up step %s failed: %s", name, e)
+            continue
+        timings[name] = time.perf_counter() - step_started
+    logger.info(
+        "Worker warmed up in %.2fs (%s)", time.perf_counter() - started,
+        ', '.join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+    )
+    return timings
+
+
+def warm_up_if_enabled():
+    if getattr(settings, 'OPTICLOUD_WARMUP', False):
+        return warm_up()
+    return None
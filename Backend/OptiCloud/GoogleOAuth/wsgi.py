@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'GoogleOAuth.settings')
 
 application = get_wsgi_application()
+
+# Indexes are created by `manage.py ensure_indexes` on deploy, not by every worker
+
+# Optionally load the SDKs and open connections now rather than on the first requests
+from GoogleOAuth.warmup import warm_up_if_enabled  # noqa: E402
+
+warm_up_if_enabled()
@@ -71,6 +71,91 @@ async function sendDataToBackend(user: User) {
   }
 }
 
+// Follow a metrics refresh as it runs; calls onUpdate as stages complete
+function streamRefresh(
+  userId: string,
+  onStage: (message: string) => void,
+  onUpdate: () => void
+) {
+  const source = new EventSource(
+    `http://localhost:8000/api/refresh-stream/?user_id=${encodeURIComponent(userId)}`
+  );
+  source.addEventListener("instances_discovered", (event) => {
+    const data = JSON.parse((event as MessageEvent).data);
+    onStage(`Found ${data.count} instances in ${data.region}.`);
+  });
+  source.addEventListener("metrics_collected", () => {
+    onStage("Metrics collected, generating recommendations...");
+  });
+  source.addEventListener("recommendations_ready", () => {
+    onStage("Recommendations ready, refining the wording...");
+    onUpdate();
+  });
+  source.addEventListener("narration_ready", () => {
+    onStage("Recommendations ready.");
+    onUpdate();
+  });
+  source.addEventListener("failed", (event) => {
+    const data = JSON.parse((event as MessageEvent).data);
+    onStage(data.error || "Refresh failed.");
+    source.close();
+  });
+  source.addEventListener("done", () => {
+    onStage("Recommendations ready.");
+    onUpdate();
+    source.close();
+  });
+  // The server turns streams away (503) when too many are open; follow the refresh by
+  // polling its job then
+  let opened = false;
+  source.onopen = () => {
+    opened = true;
+  };
+  source.onerror = () => {
+    source.close();
+    if (!opened) {
+      pollRefresh(userId, onStage, onUpdate);
+    }
+  };
+  return source;
+}
+
+// Start a refresh and poll its job until it has finished
+async function pollRefresh(
+  userId: string,
+  onStage: (message: string) => void,
+  onUpdate: () => void
+) {
+  try {
+    const response = await fetch("http://localhost:8000/api/get-user-role-arn/", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({ user_id: userId }),
+    });
+    const { job_id } = await response.json();
+    if (!job_id) return;
+    onStage("Refreshing metrics...");
+    while (true) {
+      await new Promise((resolve) => setTimeout(resolve, 3000));
+      const status = await fetch(`http://localhost:8000/api/refresh-jobs/${job_id}/`);
+      const job = await status.json();
+      if (job.status === "succeeded") {
+        onStage("Recommendations ready.");
+        onUpdate();
+        return;
+      }
+      if (job.status === "failed" || !status.ok) {
+        onStage(job.error || "Refresh failed.");
+        return;
+      }
+    }
+  } catch (error) {
+    console.error("Error following the refresh:", error);
+  }
+}
+
 // Dashboard component
 export default function Dashboard() {
   const { data: session, status } = useSession();
@@ -95,6 +180,7 @@ export default function Dashboard() {
           },
           body: JSON.stringify({
             user_id: userId, // Send the user ID to the backend to fetch the roleArn
+            refresh: false, // The refresh is followed through refresh-stream below
           }),
         }
       );
@@ -105,6 +191,13 @@ export default function Dashboard() {
         setRoleArn(data.roleArn); // Set the fetched roleArn
 
         setResponseMessage("Role ARN fetched successfully.");
+
+        // Stored metrics are kept fresh by the scheduled collector; only refresh here
+        // when there is nothing to show yet
+        const hasMetrics = await fetchUserMetrics(userId);
+        if (!hasMetrics) {
+          streamRefresh(userId, setResponseMessage, () => fetchUserMetrics(userId));
+        }
       } else {
         const errorData = await response.json();
         setResponseMessage(errorData.message || "Failed to fetch Role ARN.");
@@ -119,25 +212,21 @@ export default function Dashboard() {
 const fetchUserMetrics = async(userId: string | null) => {
   if (!userId) return;
   try {
-    // Send POST request to the backend API
-    const response = await fetch("http://localhost:8000/api/get-user-metrics/", {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify({
-        user_id: userId,  // Pass the user.id in the request body
-      }),
-    });
+    // Cacheable GET: the browser revalidates with the ETag and gets a 304 when nothing changed
+    const response = await fetch(
+      `http://localhost:8000/api/user-metrics/${encodeURIComponent(userId)}/`
+    );
     if (response.ok) {
       const data = await response.json();
       
       setUserMetrics(data.aws_metrics);
       console.log("these are metrics:", data.aws_metrics); 
       console.log("these are metrics:", user_metrics); 
+      return true;
     } else {
       const errorData = await response.json();
       setResponseMessage(errorData.message || "Failed to fetch metrics.");
+      return false;
     }
 
     // if (response.ok) {
@@ -159,8 +248,7 @@ const fetchUserMetrics = async(userId: string | null) => {
   useEffect(() => {
     if (status === "authenticated" && user?.id) {
       console.log("triggered");
-      fetchRoleArn(user.id); // Fetch the roleArn once the user is authenticated
-      fetchUserMetrics(user.id);
+      fetchRoleArn(user.id); // Fetch the roleArn and the stored metrics once the user is authenticated
     }
   }, [status, user?.id]);
 